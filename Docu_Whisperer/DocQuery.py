@@ -1,66 +1,37 @@
 # Main Streamlit app, imports and uses the diffrent modules.
-import os, tempfile, subprocess, platform, certifi
-import httpx, io
+import os
+import time
 import streamlit as st
-import shutil
-from langchain_openai import OpenAIEmbeddings, ChatOpenAI
-from langchain_community.vectorstores import FAISS
-from langchain.chains import RetrievalQA
-import openai
-from openai import OpenAI, DefaultHttpxClient
-import os, subprocess, platform, sys, shutil
 from utils import (
-    DATA_FOLDER, save_web_urls, load_web_urls,
-    is_valid_docx, is_valid_pdf, is_valid_url
+    DATA_FOLDER, save_web_urls, load_web_urls, list_doc_paths,
+    is_valid_url
 )
-from docx_loader import load_docx_chunks
-from pdf_loader import load_pdf_chunks
-from web_loader import open_web_page, finalize_web_page, extract_page_content
-
-from env_setup import setup_environment, get_api_key
-# Set tiktoken cache directory to a writable location
-os.environ["TIKTOKEN_CACHE_DIR"] = "/tmp/tiktoken_cache"
+from index_manager import (
+    FAISS_INDEX_PATH, load_search_store, load_lexical_index, load_manifest, source_key, source_versions
+)
+from qa import RETRIEVAL_MODES, stream_answer
+from context_packer import retrieve_context
+from answer_cache import AnswerCache
+from retrieval_service import RETRIEVAL_SERVICE_URL, RetrievalClient
+from job_queue import JobQueue, JobWorker, describe_progress
+import metrics
 
-FAISS_INDEX_PATH = "faiss_index"  # Use /tmp for FAISS index
-setup_environment()
-api_key = get_api_key()
-api_base_url = "https://api.studio.genai"
+from env_setup import API_BASE_URL, setup_environment, get_api_key, make_embeddings, make_llm
 
 OPENAI_API_KEY_VERIFY_SSL = False
 
 #--- Environment Setup ---
-ca_bundle_path = "/Users/nilkamal.dey/PyCharmMiscProject/DocuWhisperer/ca_bundle.pem"
-
-if platform.system() == "Windows":
-    subprocess.run([
-        "powershell", "-Command",
-        "Get-ChildItem Cert:\\LocalMachine\\Root, Cert:\\LocalMachine\\CA, Cert:\\CurrentUser\\Root | "
-        "Where-Object { ! $_.PsIsContainer } | "
-        "ForEach-Object { $_.Export([System.Security.Cryptography.X509Certificates.X509ContentType]::Cert) } | "
-        f"Set-Content -Encoding ascii -Path {ca_bundle_path}"
-    ], check=True)
-
-elif platform.system() == "Darwin":
-    subprocess.run(
-        f"security find-certificate -a -p /Library/Keychains/System.keychain "
-        f"/System/Library/Keychains/SystemRootCertificates.keychain "
-        f"{os.path.expanduser('~/Library/Keychains/login.keychain-db')} > {ca_bundle_path}",
-        shell=True, check=True
-    )
-
-elif platform.system() == "Linux":
-    shutil.copyfile("/etc/ssl/certs/ca-certificates.crt", ca_bundle_path)
-
-os.environ.update({
-    "OPENAI_API_KEY": os.environ.get("OPENAI_API_KEY", ""),
-    "OPENAI_BASE_URL": "https://api.studio.genai",
-    "NO_PROXY": os.environ.get("NO_PROXY", "") + ("," if os.environ.get("NO_PROXY")),
-    "REQUESTS_CA_BUNDLE": ca_bundle_path,
-    # "SSL_CERT_FILE": ca_bundle_path
-})
+@st.cache_resource
+def bootstrap_environment():
+    # Streamlit re-runs this script on every click; the certificate export and
+    # environment setup only need to happen once per process.
+    setup_environment()
+    # METRICS_PORT / METRICS_FILE exporters, also once per process.
+    metrics.start_exporters()
+    return get_api_key()
 
-os.environ["OPENAI_BASE_URL"] = "https://api.studio.genai"
-os.environ["NO_PROXY"] = os.environ.get("NO_PROXY", "") + ("," if os.environ.get("NO_PROXY"))
+api_key = bootstrap_environment()
+api_base_url = API_BASE_URL
 
 # --- Streamlit Page Configuration --- Custom CSS for UI ---
 st.set_page_config(
@@ -81,32 +52,14 @@ st.markdown("""
     border: 1px solid #d3d3d3 !important;
     font-weight: normal !important;
 }
-.blink-green-red-bg {
-  animation: blinker 1s linear infinite;
-  color: #28a745;
-  background-color: #d9534f;
-  font-weight: bold;
-  padding: 4px 12px;
-  border-radius: 6px;
-  display: inline-block;
-}
-@keyframes blinker {
-  50% { opacity: 0; }
-}
 </style>
 """, unsafe_allow_html=True)
 
 # --- Streamlit UI State Initialization ---
 if "active_tab" not in st.session_state:
     st.session_state["active_tab"] = "Chat"
-if "web_urls" not in st.session_state:
-    st.session_state["web_urls"] = load_web_urls()
-if "pending_web_url" not in st.session_state:
-    st.session_state["pending_web_url"] = None
-if "selenium_driver" not in st.session_state:
-    st.session_state["selenium_driver"] = None
-if "show_reindex_msg" not in st.session_state:
-    st.session_state["show_reindex_msg"] = False
+# Re-read on every run: background jobs add the pages they index to the file.
+st.session_state["web_urls"] = load_web_urls()
 if "file_uploader_key" not in st.session_state:
     st.session_state["file_uploader_key"] = 0
 if "chat_history" not in st.session_state:
@@ -130,53 +83,144 @@ with col2:
 st.markdown("---")
 
 def get_doc_paths():
-    docx_files = [f for f in os.listdir(DATA_FOLDER) if f.lower().endswith(".docx")]
-    pdf_files = [f for f in os.listdir(DATA_FOLDER) if f.lower().endswith(".pdf")]
-    docx_paths = [os.path.join(DATA_FOLDER, f) for f in docx_files if is_valid_docx(os.path.join(DATA_FOLDER, f))]
-    pdf_paths = [os.path.join(DATA_FOLDER, f) for f in pdf_files if is_valid_pdf(os.path.join(DATA_FOLDER, f))]
-    return docx_paths, pdf_paths
+    return list_doc_paths(DATA_FOLDER)
 
 def get_all_doc_paths():
     docx_paths, pdf_paths = get_doc_paths()
     return docx_paths + pdf_paths
 
 @st.cache_resource
-def load_all_chunks():
-    all_chunks = []
-    for path in get_all_doc_paths():
-        if path.lower().endswith(".docx"):
-            all_chunks.extend(load_docx_chunks(path))
-        elif path.lower().endswith(".pdf"):
-            all_chunks.extend(load_pdf_chunks(path))
-    return all_chunks
+def get_embeddings():
+    # Cached per process so the embedding cache's hit/miss counters survive reruns.
+    return make_embeddings(api_key, api_base_url)
 
 @st.cache_resource
 def get_vector_store():
-    embeddings = OpenAIEmbeddings(model="text-embedding-ada-002_v2", openai_api_base=api_base_url, api_key=api_key)
-    if os.path.exists(FAISS_INDEX_PATH) and os.listdir(FAISS_INDEX_PATH):
-        return FAISS.load_local(FAISS_INDEX_PATH, embeddings, allow_dangerous_deserialization=True)
-    chunks = load_all_chunks()
-    if chunks:
-        vector_store = FAISS.from_documents(chunks, embeddings)
-        try:
-            vector_store.save_local(FAISS_INDEX_PATH)
-        except Exception as e:
-            st.error(f"Error saving FAISS index: {e}")
-            return None
-        return vector_store
-    return None
-
-def cleanup_selenium():
-    driver = st.session_state.get("selenium_driver")
-    if driver:
+    return load_search_store(get_embeddings(), FAISS_INDEX_PATH)
+
+@st.cache_resource
+def get_source_versions():
+    return source_versions(load_manifest(FAISS_INDEX_PATH))
+
+@st.cache_resource
+def get_lexical_index():
+    # Indexes saved before the lexical index existed (or out of step with it) are caught up once.
+    return load_lexical_index(get_vector_store(), FAISS_INDEX_PATH)
+
+@st.cache_resource
+def get_browser_pool():
+    # Warm headless Chrome instances shared by all sessions; only started when a page needs JavaScript.
+    from web_loader import BrowserPool
+    return BrowserPool()
+
+@st.cache_resource
+def get_answer_cache():
+    return AnswerCache()
+
+@st.cache_resource
+def get_retrieval_client():
+    # With RETRIEVAL_SERVICE_URL set, questions go to the shared retrieval_service.py instead of this process's index.
+    return RetrievalClient(RETRIEVAL_SERVICE_URL) if RETRIEVAL_SERVICE_URL else None
+
+def index_changed():
+    # Drops this process's cached index; the retrieval service (if any) is told to load the new one.
+    get_vector_store.clear()
+    get_source_versions.clear()
+    get_lexical_index.clear()
+    client = get_retrieval_client()
+    if client is not None:
         try:
-            driver.quit()
+            client.reload()
         except Exception:
+            # It also notices the new index on disk by itself within RETRIEVAL_RELOAD_INTERVAL.
             pass
-        st.session_state["selenium_driver"] = None
-        st.session_state["pending_web_url"] = None
 
-cleanup_selenium()
+@st.cache_resource
+def get_job_queue():
+    return JobQueue()
+
+@st.cache_resource
+def get_job_worker():
+    # One worker thread per app process runs uploads, removals, re-indexing and crawls, so no
+    # session waits on them and they carry on when the browser tab is closed.
+    return JobWorker(get_job_queue(), get_embeddings(), FAISS_INDEX_PATH, pool=get_browser_pool()).start()
+
+@st.cache_resource
+def get_seen_jobs():
+    # The last finished job this process has reloaded the index for.
+    return {"last": get_job_queue().last_finished()}
+
+def pick_up_finished_jobs():
+    # Jobs save the index on the worker thread; this process switches to it on its next run. True if it did.
+    latest = get_job_queue().last_finished()
+    seen = get_seen_jobs()
+    if latest == seen["last"]:
+        return False
+    seen["last"] = latest
+    index_changed()
+    return True
+
+def queue_job(kind, source=None, **payload):
+    job_id = get_job_queue().submit(kind, source, **payload)
+    metrics.count("jobs_queued_from_app", kind=kind)
+    return job_id
+
+@st.fragment(run_every=2)
+def show_jobs(rerun_on_finish=False):
+    # Polls the queue every 2 seconds; the Documents tab reruns fully when a job finishes, to list what changed.
+    if pick_up_finished_jobs() and rerun_on_finish:
+        st.rerun(scope="app")
+    jobs = get_job_queue().jobs(8)
+    active = [job for job in jobs if job["state"] in ("queued", "running")]
+    if not rerun_on_finish:
+        if active:
+            running = active[0]
+            st.caption(
+                f"Indexing in the background: {running['kind']} {os.path.basename(running['source'] or '')} "
+                f"{describe_progress(running)} ({len(active)} job(s) left). Answers use the current index until it is done."
+            )
+        return
+    if not jobs:
+        return
+    st.markdown("**Index jobs:**")
+    for job in jobs:
+        col1, col2 = st.columns([7, 2])
+        with col1:
+            source = job["source"] if job["source"] and job["source"].startswith("http") else \
+                os.path.basename(job["source"] or "")
+            st.markdown(f"{job['id']}. `{job['state']}` {job['kind']} {source}")
+            if job["state"] == "running":
+                progress = job["progress"] or {}
+                st.progress(progress["done"] / progress["total"] if progress.get("total") else 0.0,
+                            text=describe_progress(job) or "starting…")
+            elif job["error"]:
+                st.caption(f"❌ {job['error']}")
+            elif job["state"] == "done":
+                st.caption(f"✅ {job['seconds']:.1f}s {describe_progress(job)}")
+        with col2:
+            if job["state"] == "queued" and st.button("Cancel", key=f"cancel_job_{job['id']}"):
+                get_job_queue().cancel(job["id"])
+                st.rerun(scope="fragment")
+
+def show_sources(docs):
+    with st.expander("Sources", expanded=False):
+        for doc in docs:
+            doc_name = doc.metadata.get("doc_name", "Unknown")
+            page = doc.metadata.get("page", "N/A")
+            st.markdown(f"- **{doc_name}** (page {page}): `{doc.page_content[:100]}...`")
+
+@st.cache_resource
+def queue_first_index():
+    # First start: build the index in the background; questions work once the job is done. Once per process,
+    # and not after a failed build, which the Documents tab shows ("Re-index Documents" tries again).
+    last = get_job_queue().last_job("reindex")
+    # An index saved before the manifest existed has no sources listed, but is there.
+    saved = get_source_versions() or os.path.exists(os.path.join(FAISS_INDEX_PATH, "index.faiss"))
+    if not saved and get_all_doc_paths() and (last is None or last["state"] != "failed"):
+        queue_job("reindex")
+
+get_job_worker()
+queue_first_index()
 
 # --- Chat Tab Logic ---
 if st.session_state["active_tab"] == "Chat":
@@ -188,41 +232,87 @@ if st.session_state["active_tab"] == "Chat":
         - The chatbot will search your indexed content and provide answers with sources.
         """
     )
+    show_jobs()
     user_query = st.text_input("Enter your question:")
-    vector_store = get_vector_store()
+    retrieval_mode = st.radio(
+        "Search mode", RETRIEVAL_MODES, horizontal=True, key="retrieval_mode",
+        help="vector: semantic search. lexical: exact keyword (BM25) search, good for IDs and "
+             "standard numbers. hybrid: both, fused."
+    )
+    retrieval_client = get_retrieval_client()
+    vector_store = None if retrieval_client else get_vector_store()
     # print(api_base_url)
     # print(api_key)
     if user_query:
-        if vector_store is not None:
-            llm = ChatOpenAI(
-                model_name="gpt-4o_v2024-11-20_USEAST",
-                openai_api_base=api_base_url,
-                api_key=api_key,
-                temperature=0.7
-            )
-            qa_chain = RetrievalQA.from_chain_type(
-                llm=llm,
-                chain_type="stuff",
-                retriever=vector_store.as_retriever(search_kwargs={"k": 2}),
-                return_source_documents=True
-            )
-            with st.spinner("Getting answer..."):
-                result = qa_chain.invoke({"query": user_query})
-                # Save conversation
+        if retrieval_client or vector_store is not None:
+            llm = make_llm(api_key, api_base_url)
+            started = time.perf_counter()
+            timings = {}
+            answer_cache = get_answer_cache()
+            versions = get_source_versions()
+            query_vector, cached = None, None
+            if retrieval_mode != "lexical":
+                # The question is embedded once, for both the answer cache and the vector search.
+                with metrics.span("query_embedding"):
+                    if retrieval_client:
+                        query_vector = retrieval_client.embed(user_query)
+                    else:
+                        query_vector = get_embeddings().embed_query(user_query)
+                with metrics.span("answer_cache_lookup"):
+                    cached = answer_cache.lookup(query_vector, versions, retrieval_mode)
+            if cached:
+                answer, sources, similarity = cached
+                timings["answer_s"] = time.perf_counter() - started
+                metrics.observe("stage_seconds", timings["answer_s"], stage="question", answered_by="cache")
+                show_sources(sources)
+                st.markdown(f"**Answer:**\n\n{answer}")
+                st.caption(
+                    f"Answered from cache in {timings['answer_s'] * 1000:.0f} ms "
+                    f"(similarity {similarity:.3f} to an earlier question)"
+                )
+            else:
+                # Show the sources as soon as the vector search is done, then stream the answer under them.
+                with st.spinner("Searching documents..."):
+                    if retrieval_client:
+                        sources = retrieval_client.retrieve_context(user_query, query_vector, retrieval_mode)
+                    else:
+                        sources = retrieve_context(vector_store, get_lexical_index(), user_query, query_vector, retrieval_mode)
+                timings["retrieval_s"] = time.perf_counter() - started
+                answer = None
+                if not sources:
+                    # Nothing matched: don't spend an LLM call on an empty context.
+                    st.info("No indexed passages match those keywords. Try the vector or hybrid search mode.")
+                else:
+                    show_sources(sources)
+                    st.markdown("**Answer:**")
+                    answer = st.write_stream(stream_answer(llm, user_query, sources, timings, started))
+                    metrics.observe("stage_seconds", timings["answer_s"], stage="question", answered_by="llm")
+                    st.caption(
+                        f"Sources after {timings['retrieval_s']:.2f}s, first token after "
+                        f"{timings.get('first_token_s', timings['answer_s']):.2f}s, full answer after {timings['answer_s']:.2f}s"
+                    )
+                used = {source_key(doc): versions.get(source_key(doc)) for doc in sources}
+                # Sources without a fingerprint (legacy index entries) cannot be invalidated, so don't cache.
+                if answer and query_vector is not None and None not in used.values():
+                    answer_cache.store(user_query, query_vector, answer, sources, used, retrieval_mode)
+            # Save conversation
+            if answer:
                 st.session_state["chat_history"].append({
                     "question": user_query,
-                    "answer": result['result'],
-                    "sources": result["source_documents"]
+                    "answer": answer,
+                    "sources": sources,
+                    "timings": timings
                 })
-                st.markdown(f"**Answer:**\n\n{result['result']}")
-                with st.expander("Sources", expanded=False):
-                    for doc in result["source_documents"]:
-                        doc_name = doc.metadata.get("doc_name", "Unknown")
-                        page = doc.metadata.get("page", "N/A")
-                        st.markdown(f"- **{doc_name}** (page {page}): `{doc.page_content[:100]}...`")
         else:
             st.info("No documents or web pages indexed yet. Please add some before asking questions.")
 
+    cache_stats = get_answer_cache().stats()
+    if cache_stats["hits"] + cache_stats["misses"]:
+        st.caption(
+            f"Answer cache: {cache_stats['hit_rate']:.0%} hit rate ({cache_stats['hits']} hits, "
+            f"{cache_stats['misses']} misses, {cache_stats['invalidated']} invalidated, {cache_stats['entries']} entries)"
+        )
+
     # Show chat history
     if st.session_state["chat_history"]:
         st.markdown("---")
@@ -230,15 +320,12 @@ if st.session_state["active_tab"] == "Chat":
         for i, chat in enumerate(reversed(st.session_state["chat_history"])):
             st.markdown(f"**Q:** {chat['question']}")
             st.markdown(f"**A:** {chat['answer']}")
-            with st.expander("Sources", expanded=False):
-                for doc in chat["sources"]:
-                    doc_name = doc.metadata.get("doc_name", "Unknown")
-                    page = doc.metadata.get("page", "N/A")
-                    st.markdown(f"- **{doc_name}** (page {page}): `{doc.page_content[:100]}...`")
+            show_sources(chat["sources"])
 
 # --- Documents Tab Logic ---
 if st.session_state["active_tab"] == "Documents":
     st.header("Document & Web Page Details")
+    show_jobs(rerun_on_finish=True)
     uploaded_files = st.file_uploader(
         "Upload Word (.docx) or PDF (.pdf) files",
         type=["docx", "pdf"],
@@ -250,8 +337,8 @@ if st.session_state["active_tab"] == "Documents":
             file_path = os.path.join(DATA_FOLDER, uploaded_file.name)
             with open(file_path, "wb") as f:
                 f.write(uploaded_file.getbuffer())
-        st.session_state["show_reindex_msg"] = True
-        st.success("Files uploaded. Please run re-indexing.")
+            queue_job("ingest", file_path)
+        st.toast(f"{len(uploaded_files)} file(s) uploaded and queued for indexing.")
         st.session_state["file_uploader_key"] += 1
         st.rerun()
 
@@ -269,8 +356,8 @@ if st.session_state["active_tab"] == "Documents":
             with col2:
                 if st.button("Remove", key=f"remove_docx_{i}"):
                     os.remove(os.path.join(DATA_FOLDER, t))
-                    st.session_state["show_reindex_msg"] = True
-                    st.success("File removed. Please run re-indexing.")
+                    queue_job("remove", os.path.join(DATA_FOLDER, t))
+                    st.toast(f"{t} removed; its chunks are being dropped from the index.")
                     st.rerun()
     else:
         st.markdown("_None_")
@@ -284,8 +371,8 @@ if st.session_state["active_tab"] == "Documents":
             with col2:
                 if st.button("Remove", key=f"remove_pdf_{i}"):
                     os.remove(os.path.join(DATA_FOLDER, t))
-                    st.session_state["show_reindex_msg"] = True
-                    st.success("File removed. Please run re-indexing.")
+                    queue_job("remove", os.path.join(DATA_FOLDER, t))
+                    st.toast(f"{t} removed; its chunks are being dropped from the index.")
                     st.rerun()
     else:
         st.markdown("_None_")
@@ -300,8 +387,8 @@ if st.session_state["active_tab"] == "Documents":
                 if st.button("Remove", key=f"remove_web_{i}"):
                     st.session_state["web_urls"].pop(i)
                     save_web_urls(st.session_state["web_urls"])
-                    st.session_state["show_reindex_msg"] = True
-                    st.success("Web page removed. Please run re-indexing.")
+                    queue_job("remove", t)
+                    st.toast("Web page removed; its chunks are being dropped from the index.")
                     st.rerun()
     else:
         st.markdown("_None_")
@@ -313,10 +400,22 @@ if st.session_state["active_tab"] == "Documents":
     vector_store = get_vector_store()
     if vector_store:
         try:
-            total = int(vector_store.index.ntotal)
+            total = len(vector_store.index_to_docstore_id)
         except Exception:
             total = "Unknown"
         st.write(f"Total indexed chunks: {total}")
+        cache_stats = get_embeddings().stats()
+        st.caption(
+            f"Embedding cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses "
+            f"({cache_stats['entries']} cached vectors)"
+        )
+        last_run = get_embeddings().embeddings.last_run
+        if last_run:
+            st.caption(
+                f"Last embedding run: {last_run['chunks']} chunks in {last_run['seconds']:.1f}s "
+                f"({last_run['chunks_per_s']:.0f} chunks/s, {last_run['tokens_per_s']:.0f} tokens/s, "
+                f"{last_run['rate_limited']} rate-limited retries)"
+            )
     else:
         st.write("Total indexed chunks: 0 (No documents indexed yet)")
 
@@ -339,70 +438,67 @@ if st.session_state["active_tab"] == "Documents":
             elif web_url in st.session_state["web_urls"]:
                 st.info("ℹ️ That URL is already indexed")
             else:
-                with st.spinner("Loading and indexing web page…"):
-                    driver, err = open_web_page(web_url, st.session_state, headless=True)
-                    if err:
-                        st.error(f"❌ Could not load page: {err}")
-                    else:
-                        try:
-                            # a) Extract & chunk
-                            chunks = extract_page_content(driver, web_url)
-                            if not chunks:
-                                raise ValueError("No text extracted from the page.")
-
-                            # b) Load or create FAISS index
-                            embeddings = OpenAIEmbeddings(
-                                model="text-embedding-ada-002_v2",
-                                openai_api_base=api_base_url,
-                                api_key=api_key,
-                            )
-                            if os.path.exists(FAISS_INDEX_PATH) and os.listdir(FAISS_INDEX_PATH):
-                                vs = FAISS.load_local(
-                                    FAISS_INDEX_PATH,
-                                    embeddings,
-                                    allow_dangerous_deserialization=True,
-                                )
-                            else:
-                                vs = FAISS.from_documents([], embeddings)
-
-                            # c) Append & save
-                            vs.add_documents(chunks)
-                            vs.save_local(FAISS_INDEX_PATH)
-
-                            # d) Persist URL
-                            st.session_state["web_urls"].append(web_url)
-                            save_web_urls(st.session_state["web_urls"])
-
-                            # e) Cleanup Selenium
-                            driver.quit()
-
-                            # f) Clear cached FAISS store
-                            get_vector_store.clear()
-
-                            # g) Report success
-                            st.success(f"✅ Indexed {len(chunks)} chunks from {web_url}")
-                            if hasattr(st, "experimental_rerun"):
-                                st.experimental_rerun()
-                        except Exception as e:
-                            try:
-                                driver.quit()
-                            except Exception:
-                                pass
-                            st.error(f"❌ Indexing failed: {e}")
+                # Fetched, chunked and embedded by the job worker; the URL is listed once it is indexed.
+                queue_job("ingest", web_url)
+                st.success("✅ Queued for indexing; progress is shown under Index jobs above.")
+
+        with st.expander("Bulk add web pages", expanded=False):
+            bulk_urls = st.text_area("URLs (one per line):", value="", key="bulk_urls_input")
+            sitemap_url = st.text_input("Sitemap URL:", value="", key="sitemap_url_input")
+            seed_url = st.text_input("Crawl a site starting from:", value="", key="seed_url_input")
+            col_depth, col_pages, col_domain = st.columns(3)
+            with col_depth:
+                max_depth = st.number_input("Link depth", min_value=0, max_value=5, value=1, key="crawl_depth")
+            with col_pages:
+                max_pages = st.number_input("Max pages", min_value=1, max_value=5000, value=200, key="crawl_max_pages")
+            with col_domain:
+                same_domain = st.checkbox("Same domain only", value=True, key="crawl_same_domain")
+            if st.button("Fetch & Index", key="bulk_web_btn"):
+                url_list = [u.strip() for u in bulk_urls.splitlines() if u.strip()]
+                invalid = [u for u in url_list + [sitemap_url, seed_url] if u and not is_valid_url(u)]
+                if invalid:
+                    st.error(f"❌ Invalid URL(s): {', '.join(invalid)}")
+                elif not (url_list or sitemap_url or seed_url):
+                    st.info("ℹ️ Enter URLs, a sitemap or a start page")
+                else:
+                    queue_job("crawl", urls=url_list, sitemap=sitemap_url or None, seed=seed_url or None,
+                              max_depth=int(max_depth), same_domain=same_domain, max_pages=int(max_pages))
+                    st.success("✅ Crawl queued; pages are added to the list as they are indexed.")
+
+        if st.session_state["web_urls"] and st.button("Refresh Web Pages", key="refresh_web_btn"):
+            # Conditional requests; only pages whose text changed are re-embedded.
+            queue_job("refresh")
+            st.success("✅ Refresh queued.")
 
     # Re-indexing button
     st.markdown("---")
-    col_a, col_b = st.columns([2, 8])
-    with col_a:
-        if st.button("Re-index Documents"):
-            if os.path.exists(FAISS_INDEX_PATH):
-                shutil.rmtree(FAISS_INDEX_PATH)
-            load_all_chunks.clear()
-            get_vector_store.clear()
-            st.session_state["show_reindex_msg"] = False
-            st.success("Re-indexing triggered. The app will reload.")
-            st.session_state["active_tab"] = "Documents"
+    if st.button("Re-index Documents"):
+        # Diffs data/ and the web URL list against the index manifest, embedding only what changed.
+        queue_job("reindex")
+        st.session_state["active_tab"] = "Documents"
+        st.rerun()
+
+# --- Debug Panel ---
+with st.sidebar:
+    if st.checkbox("Show pipeline metrics", key="show_metrics",
+                   help="Time spent per stage and counters since this app process started."):
+        stages = metrics.REGISTRY.stage_table()
+        if stages:
+            st.dataframe(
+                [{**row, **{k: round(v, 2) for k, v in row.items() if isinstance(v, float)}} for row in stages],
+                hide_index=True,
+            )
+        else:
+            st.caption("Nothing recorded yet.")
+        counters = metrics.REGISTRY.snapshot()["counters"]
+        if counters:
+            st.dataframe(
+                [{"counter": c["name"] + "".join(f" {k}={v}" for k, v in c["labels"].items()), "value": c["value"]}
+                 for c in counters],
+                hide_index=True,
+            )
+        st.download_button("Prometheus text", metrics.REGISTRY.to_prometheus(), "metrics.prom")
+        st.download_button("JSON", metrics.REGISTRY.to_json(), "metrics.json")
+        if st.button("Reset metrics"):
+            metrics.REGISTRY.reset()
             st.rerun()
-    with col_b:
-        if st.session_state.get("show_reindex_msg"):
-            st.markdown('<span class="blink-green-red-bg">Please run Re-indexing!</span>', unsafe_allow_html=True)
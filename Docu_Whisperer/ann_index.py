@@ -0,0 +1,265 @@
+# Optional approximate search index (IVF / HNSW / IVF-PQ) built from the flat FAISS index, plus a recall/latency report.
+import argparse
+import hashlib
+import json
+import math
+import os
+import time
+
+import faiss
+import numpy as np
+
+# "flat" keeps exact search; "ivf", "hnsw" and "ivfpq" build index.ann next to index.faiss.
+FAISS_INDEX_TYPE = os.environ.get("FAISS_INDEX_TYPE", "flat")
+INDEX_TYPES = ["flat", "ivf", "hnsw", "ivfpq"]
+# Below this many vectors flat search is fast enough and IVF training would be poor, so no ANN index is built.
+FAISS_ANN_MIN_VECTORS = int(os.environ.get("FAISS_ANN_MIN_VECTORS", "20000"))
+# 0 picks 4 * sqrt(n) inverted lists.
+FAISS_NLIST = int(os.environ.get("FAISS_NLIST", "0"))
+FAISS_NPROBE = int(os.environ.get("FAISS_NPROBE", "16"))
+FAISS_HNSW_M = int(os.environ.get("FAISS_HNSW_M", "32"))
+FAISS_EF_SEARCH = int(os.environ.get("FAISS_EF_SEARCH", "64"))
+# Bytes per vector for IVF-PQ (must divide the embedding dimension; 64 for 1536-d is ~96x smaller than float32).
+FAISS_PQ_M = int(os.environ.get("FAISS_PQ_M", "64"))
+# IVF-PQ candidates re-ranked with exact distances from index.faiss, as a multiple of k (0 turns it off).
+FAISS_REFINE_FACTOR = int(os.environ.get("FAISS_REFINE_FACTOR", "16"))
+# Memory-map index files read-only, so several app processes share one copy in the page cache.
+FAISS_MMAP = os.environ.get("FAISS_MMAP", "1") == "1"
+
+ANN_INDEX_FILE = "index.ann"
+ANN_META_FILE = "index.ann.json"
+# An IVF index is retrained once the corpus has grown this much since it was trained.
+RETRAIN_GROWTH = 4
+# k-means gets this many training points per inverted list.
+TRAIN_POINTS_PER_LIST = 64
+
+# Flat codes (flat, HNSW, PQ) map with MMAP_IFC; IVF inverted lists need MMAP. The two don't combine.
+MMAP_FLAGS = faiss.IO_FLAG_MMAP_IFC | faiss.IO_FLAG_READ_ONLY
+IVF_MMAP_FLAGS = faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY
+
+
+def auto_nlist(n):
+    return max(1, int(4 * math.sqrt(n)))
+
+
+def pq_subquantizers(dim, m=FAISS_PQ_M):
+    # The largest divisor of dim that is <= m.
+    return max(i for i in range(1, min(m, dim) + 1) if dim % i == 0)
+
+
+def factory_string(kind, dim, n, nlist=FAISS_NLIST, hnsw_m=FAISS_HNSW_M, pq_m=FAISS_PQ_M):
+    nlist = nlist or auto_nlist(n)
+    if kind == "flat":
+        return "Flat"
+    if kind == "ivf":
+        return f"IVF{nlist},Flat"
+    if kind == "hnsw":
+        return f"HNSW{hnsw_m},Flat"
+    if kind == "ivfpq":
+        return f"IVF{nlist},PQ{pq_subquantizers(dim, pq_m)}x8"
+    raise ValueError(f"Unknown FAISS index type {kind!r}; expected one of {', '.join(INDEX_TYPES)}")
+
+
+def set_search_params(index, nprobe=FAISS_NPROBE, ef_search=FAISS_EF_SEARCH):
+    """Applies nprobe (IVF) or efSearch (HNSW); parameters the index doesn't have are ignored."""
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        ivf.nprobe = min(nprobe, ivf.nlist)
+    if hasattr(index, "hnsw"):
+        index.hnsw.efSearch = ef_search
+    return index
+
+
+def refine_with(index, flat, k_factor=FAISS_REFINE_FACTOR):
+    """
+    Re-rank k * k_factor candidates of a compressed index with exact
+    distances from flat, which only touches those vectors (cheap when flat
+    is memory-mapped).
+    """
+    refined = faiss.IndexRefine(index, flat)
+    refined.k_factor = k_factor
+    # The wrapper doesn't own the two indexes; keep them alive with it.
+    refined.referenced_objects = [index, flat]
+    return refined
+
+
+def all_vectors(index):
+    return index.reconstruct_n(0, index.ntotal)
+
+
+def build_ann_index(vectors, kind, nlist=FAISS_NLIST, hnsw_m=FAISS_HNSW_M, pq_m=FAISS_PQ_M, seed=1234):
+    """A trained and populated index over vectors; vector i gets id i, like the flat index."""
+    n, dim = vectors.shape
+    index = faiss.index_factory(dim, factory_string(kind, dim, n, nlist, hnsw_m, pq_m), faiss.METRIC_L2)
+    if not index.is_trained:
+        ivf = faiss.extract_index_ivf(index)
+        # PQ codebooks need at least 256 points each, whatever nlist is.
+        sample = min(n, max(ivf.nlist * TRAIN_POINTS_PER_LIST, 10000))
+        rng = np.random.default_rng(seed)
+        index.train(vectors[rng.choice(n, sample, replace=False)] if sample < n else vectors)
+    index.add(vectors)
+    return index
+
+
+def ids_digest(index_to_docstore_id, count):
+    digest = hashlib.sha1()
+    for i in range(count):
+        digest.update(index_to_docstore_id[i].encode("utf-8"))
+        digest.update(b"\x00")
+    return digest.hexdigest()
+
+
+def _read_meta(index_path):
+    try:
+        with open(os.path.join(index_path, ANN_META_FILE), "r") as f:
+            return json.load(f)
+    except Exception:
+        return None
+
+
+def _remove_ann(index_path):
+    for name in (ANN_INDEX_FILE, ANN_META_FILE):
+        path = os.path.join(index_path, name)
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def sync_ann_index(vector_store, index_path, kind=FAISS_INDEX_TYPE):
+    """
+    Keeps index.ann in step with the flat index just saved. Pure appends are
+    added to the existing ANN index; deletes (which HNSW cannot do), a
+    changed configuration or enough growth to need retraining rebuild it.
+    Returns "none", "unchanged", "appended" or "rebuilt".
+    """
+    flat = vector_store.index
+    n = flat.ntotal
+    if kind == "flat" or n < FAISS_ANN_MIN_VECTORS:
+        _remove_ann(index_path)
+        return "none"
+
+    config = {"kind": kind, "nlist": FAISS_NLIST, "hnsw_m": FAISS_HNSW_M, "pq_m": FAISS_PQ_M}
+    meta = _read_meta(index_path)
+    ann_path = os.path.join(index_path, ANN_INDEX_FILE)
+    appendable = (
+        meta is not None and os.path.exists(ann_path)
+        and meta["config"] == config and meta["ntotal"] <= n
+        and n <= meta["trained_on"] * RETRAIN_GROWTH
+        and ids_digest(vector_store.index_to_docstore_id, meta["ntotal"]) == meta["ids_digest"]
+    )
+    if appendable and meta["ntotal"] == n:
+        return "unchanged"
+    if appendable:
+        index = faiss.read_index(ann_path)
+        index.add(flat.reconstruct_n(meta["ntotal"], n - meta["ntotal"]))
+        trained_on, status = meta["trained_on"], "appended"
+    else:
+        index = build_ann_index(all_vectors(flat), kind)
+        trained_on, status = n, "rebuilt"
+
+    tmp_path = ann_path + ".tmp"
+    faiss.write_index(index, tmp_path)
+    os.replace(tmp_path, ann_path)
+    meta = {"config": config, "ntotal": n, "trained_on": trained_on,
+            "ids_digest": ids_digest(vector_store.index_to_docstore_id, n)}
+    with open(os.path.join(index_path, ANN_META_FILE) + ".tmp", "w") as f:
+        json.dump(meta, f)
+    os.replace(os.path.join(index_path, ANN_META_FILE) + ".tmp", os.path.join(index_path, ANN_META_FILE))
+    return status
+
+
+def read_ann_index(index_path, flat, mmap=FAISS_MMAP):
+    """The ANN index saved in index_path, set up to search, without checking it against flat; None if there is none."""
+    meta = _read_meta(index_path)
+    ann_path = os.path.join(index_path, ANN_INDEX_FILE)
+    if meta is None or not os.path.exists(ann_path):
+        return None
+    kind = meta["config"]["kind"]
+    flags = (IVF_MMAP_FLAGS if kind in ("ivf", "ivfpq") else MMAP_FLAGS) if mmap else 0
+    index = set_search_params(faiss.read_index(ann_path, flags))
+    if kind == "ivfpq" and FAISS_REFINE_FACTOR:
+        index = refine_with(index, flat)
+    return index
+
+
+def load_ann_index(vector_store, index_path, mmap=FAISS_MMAP):
+    """The saved ANN index if it matches vector_store exactly, else None (search falls back to flat)."""
+    meta = _read_meta(index_path)
+    if meta is None or meta["ntotal"] != vector_store.index.ntotal:
+        return None
+    if ids_digest(vector_store.index_to_docstore_id, meta["ntotal"]) != meta["ids_digest"]:
+        return None
+    return read_ann_index(index_path, vector_store.index, mmap)
+
+
+def synthetic_vectors(n, dim, clusters=200, seed=0):
+    # Clustered like real embeddings, so IVF/HNSW behave as they would on a corpus rather than on noise.
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((clusters, dim), dtype=np.float32)
+    vectors = rng.standard_normal((n, dim), dtype=np.float32)
+    vectors *= 0.35
+    vectors += centers[rng.integers(0, clusters, n)]
+    return vectors
+
+
+def _measure(index, queries, truth, k):
+    latencies = []
+    hits = 0
+    for query, expected in zip(queries, truth):
+        started = time.perf_counter()
+        _, found = index.search(query[None, :], k)
+        latencies.append(time.perf_counter() - started)
+        hits += len(set(found[0]) & set(expected))
+    latencies = np.array(latencies) * 1000
+    return hits / truth.size, float(latencies.mean()), float(np.percentile(latencies, 95))
+
+
+def main():
+    """Recall@k and single-query latency of each index type against exact (flat) search."""
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument("--index", help="use the vectors of this saved index (default: synthetic data)")
+    parser.add_argument("--synthetic", type=int, default=100000, help="synthetic corpus size")
+    parser.add_argument("--dim", type=int, default=1536)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("-k", type=int, default=10)
+    parser.add_argument("--types", default="ivf,hnsw,ivfpq")
+    args = parser.parse_args()
+
+    if args.index:
+        from index_manager import load_vector_store
+        vector_store = load_vector_store(None, args.index, mmap=True)
+        vectors = vector_store.index.reconstruct_batch(sorted(vector_store.index_to_docstore_id))
+    else:
+        vectors = synthetic_vectors(args.synthetic, args.dim)
+    n, dim = vectors.shape
+    rng = np.random.default_rng(1)
+    # Queries are perturbed corpus vectors: near real content, but not exact copies of it.
+    queries = vectors[rng.choice(n, args.queries, replace=False)]
+    queries = queries + 0.1 * queries.std() * rng.standard_normal(queries.shape, dtype=np.float32)
+
+    flat = faiss.IndexFlatL2(dim)
+    flat.add(vectors)
+    _, truth = flat.search(queries, args.k)
+    print(f"{n} vectors x {dim} dims, {args.queries} queries, recall@{args.k}\n")
+    print(f"{'index':<26}{'build s':>9}{'size MB':>9}{'recall':>8}{'mean ms':>9}{'p95 ms':>8}")
+    _, mean_ms, p95_ms = _measure(flat, queries, truth, args.k)
+    print(f"{'flat (exact)':<26}{0:>9.1f}{vectors.nbytes / 1e6:>9.1f}{1:>8.3f}{mean_ms:>9.2f}{p95_ms:>8.2f}", flush=True)
+
+    for kind in args.types.split(","):
+        started = time.perf_counter()
+        index = build_ann_index(vectors, kind)
+        build_s = time.perf_counter() - started
+        size_mb = faiss.serialize_index(index).nbytes / 1e6
+        settings = [("nprobe", v) for v in (4, 16, 64)] if kind != "hnsw" else [("efSearch", v) for v in (16, 64, 256)]
+        variants = [(kind, index)]
+        if kind == "ivfpq" and FAISS_REFINE_FACTOR:
+            variants.append((f"ivfpq+refine x{FAISS_REFINE_FACTOR}", refine_with(index, flat)))
+        for label, searched in variants:
+            for name, value in settings:
+                set_search_params(index, nprobe=value, ef_search=value)
+                recall, mean_ms, p95_ms = _measure(searched, queries, truth, args.k)
+                row = f"{label} {name}={value}"
+                print(f"{row:<26}{build_s:>9.1f}{size_mb:>9.1f}{recall:>8.3f}{mean_ms:>9.2f}{p95_ms:>8.2f}", flush=True)
+
+
+if __name__ == "__main__":
+    main()
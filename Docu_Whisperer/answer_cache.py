@@ -0,0 +1,147 @@
+# Persistent semantic cache of Chat answers, keyed on the question embedding.
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import numpy as np
+from langchain_core.documents import Document
+
+import metrics
+
+ANSWER_CACHE_PATH = "answer_cache.sqlite"
+ANSWER_CACHE_THRESHOLD = float(os.environ.get("ANSWER_CACHE_THRESHOLD", "0.95"))
+ANSWER_CACHE_TTL = float(os.environ.get("ANSWER_CACHE_TTL", str(7 * 24 * 3600)))
+ANSWER_CACHE_MAX_ENTRIES = int(os.environ.get("ANSWER_CACHE_MAX_ENTRIES", "5000"))
+
+
+def _normalize(vector):
+    vector = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+class AnswerCache:
+    """
+    Stores answers with the embedding of the question that produced them. A
+    new question whose embedding has cosine similarity >= threshold with a
+    stored one, asked in the same retrieval mode, reuses that answer, as
+    long as the entry is younger than ttl
+    and every source it was answered from still has the same fingerprint in
+    the index manifest. Least recently used entries beyond max_entries are
+    evicted.
+    """
+
+    def __init__(self, path=ANSWER_CACHE_PATH, threshold=ANSWER_CACHE_THRESHOLD,
+                 ttl=ANSWER_CACHE_TTL, max_entries=ANSWER_CACHE_MAX_ENTRIES):
+        self.path = path
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.invalidated = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS answers ("
+                "id INTEGER PRIMARY KEY, question TEXT NOT NULL, embedding BLOB NOT NULL, "
+                "answer TEXT NOT NULL, sources TEXT NOT NULL, source_versions TEXT NOT NULL, "
+                "created REAL NOT NULL, last_used REAL NOT NULL, mode TEXT)"
+            )
+            columns = [row[1] for row in self._conn.execute("PRAGMA table_info(answers)")]
+            if "mode" not in columns:
+                # Caches from before modes were recorded; their entries (mode NULL) are never reused.
+                self._conn.execute("ALTER TABLE answers ADD COLUMN mode TEXT")
+        rows = self._conn.execute("SELECT id, embedding, mode FROM answers").fetchall()
+        self._ids = [row[0] for row in rows]
+        self._modes = [row[2] for row in rows]
+        self._matrix = np.array([np.frombuffer(row[1], dtype=np.float32) for row in rows])
+        if not rows:
+            self._matrix = np.zeros((0, 0), dtype=np.float32)
+
+    def lookup(self, query_vector, source_versions, mode="vector"):
+        """Returns (answer, sources, similarity) for a usable entry answered in mode, else None."""
+        with self._lock:
+            self._expire()
+            match = None
+            if self._ids:
+                similarities = np.where(np.array(self._modes) == mode, self._matrix @ _normalize(query_vector), -np.inf)
+                best = int(np.argmax(similarities))
+                if similarities[best] >= self.threshold:
+                    match = (self._ids[best], float(similarities[best]))
+            if match is None:
+                self.misses += 1
+                metrics.count("answer_cache_lookups", result="miss")
+                return None
+
+            entry_id, similarity = match
+            answer, sources, versions = self._conn.execute(
+                "SELECT answer, sources, source_versions FROM answers WHERE id = ?", (entry_id,)
+            ).fetchone()
+            if any(source_versions.get(key) != version for key, version in json.loads(versions).items()):
+                # A source this answer was drawn from changed or was removed.
+                self._delete([entry_id])
+                self.invalidated += 1
+                self.misses += 1
+                metrics.count("answer_cache_lookups", result="invalidated")
+                return None
+
+            with self._conn:
+                self._conn.execute("UPDATE answers SET last_used = ? WHERE id = ?", (time.time(), entry_id))
+            self.hits += 1
+            metrics.count("answer_cache_lookups", result="hit")
+            docs = [Document(page_content=doc["page_content"], metadata=doc["metadata"]) for doc in json.loads(sources)]
+            return answer, docs, similarity
+
+    def store(self, question, query_vector, answer, sources, source_versions, mode="vector"):
+        """
+        source_versions maps each source the answer used to its current
+        manifest fingerprint; mode is the retrieval mode the sources came from.
+        """
+        vector = _normalize(query_vector)
+        now = time.time()
+        with self._lock, self._conn:
+            cursor = self._conn.execute(
+                "INSERT INTO answers (question, embedding, answer, sources, source_versions, created, last_used, mode) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    question, vector.tobytes(), answer,
+                    json.dumps([{"page_content": doc.page_content, "metadata": doc.metadata} for doc in sources]),
+                    json.dumps(source_versions), now, now, mode,
+                ),
+            )
+            self._ids.append(cursor.lastrowid)
+            self._modes.append(mode)
+            self._matrix = np.vstack([self._matrix.reshape(-1, len(vector)), vector])
+            overflow = len(self._ids) - self.max_entries
+            if overflow > 0:
+                rows = self._conn.execute("SELECT id FROM answers ORDER BY last_used LIMIT ?", (overflow,)).fetchall()
+                self._delete([row[0] for row in rows])
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "invalidated": self.invalidated,
+                "hit_rate": self.hits / total if total else 0.0,
+                "entries": len(self._ids),
+            }
+
+    def _expire(self):
+        rows = self._conn.execute("SELECT id FROM answers WHERE created < ?", (time.time() - self.ttl,)).fetchall()
+        if rows:
+            self._delete([row[0] for row in rows])
+
+    def _delete(self, ids):
+        with self._conn:
+            self._conn.executemany("DELETE FROM answers WHERE id = ?", [(entry_id,) for entry_id in ids])
+        removed = set(ids)
+        keep = [i for i, entry_id in enumerate(self._ids) if entry_id not in removed]
+        self._ids = [self._ids[i] for i in keep]
+        self._modes = [self._modes[i] for i in keep]
+        self._matrix = self._matrix[keep]
@@ -0,0 +1,438 @@
+# Reproducible ingestion and query benchmarks against fake backends; results are written as JSON.
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+
+import numpy as np
+
+from utils import DATA_FOLDER, list_doc_paths, peak_rss_mb
+
+BENCH_SIZES = "1000,10000,50000"
+SCENARIOS = ("parse", "chunk", "ingest", "search")
+# Used when data/ has no documents to draw words from.
+_FALLBACK_WORDS = (
+    "access control policy cloud storage encryption key review vulnerability scanning malware endpoint "
+    "asset owner risk audit log retention incident response backup network firewall patch standard"
+).split()
+_CHUNK_SIZE, _CHUNK_OVERLAP = 1000, 200
+
+
+# ---------- deterministic corpora ----------
+
+def seed_vocabulary(data_folder=DATA_FOLDER):
+    """Words of the documents in data_folder (in file order), so synthetic text looks like the real corpus."""
+    from docx_loader import load_docx_chunks
+    from pdf_loader import load_pdf_chunks
+
+    words = []
+    if os.path.isdir(data_folder):
+        docx_paths, pdf_paths = list_doc_paths(data_folder)
+        for path in sorted(docx_paths + pdf_paths):
+            chunks = load_docx_chunks(path) if path.endswith(".docx") else load_pdf_chunks(path)
+            for chunk in chunks:
+                words.extend(re.findall(r"[A-Za-z]{3,}", chunk.page_content))
+    return words or _FALLBACK_WORDS
+
+
+def make_paragraphs(rng, vocabulary, count):
+    paragraphs = []
+    for _ in range(count):
+        sentences = []
+        for _ in range(rng.randint(3, 6)):
+            sentence = " ".join(rng.choice(vocabulary) for _ in range(rng.randint(8, 20)))
+            sentences.append(sentence[0].upper() + sentence[1:] + ".")
+        paragraphs.append(" ".join(sentences))
+    return paragraphs
+
+
+def write_pdf(path, pages):
+    """Minimal text PDF, one list of lines per page (Helvetica, no compression)."""
+    objects = [b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>", None]
+    kids = []
+    for lines in pages:
+        body = " ".join("({}) Tj T*".format(re.sub(r"[()\\]", "", line)) for line in lines)
+        stream = ("BT /F1 10 Tf 12 TL 40 800 Td " + body + " ET").encode("latin-1", "replace")
+        objects.append(b"<< /Length %d >>\nstream\n" % len(stream) + stream + b"\nendstream")
+        objects.append(b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] "
+                       b"/Resources << /Font << /F1 1 0 R >> >> /Contents %d 0 R >>" % len(objects))
+        kids.append(len(objects))
+    objects[1] = b"<< /Type /Pages /Kids [" + b" ".join(b"%d 0 R" % kid for kid in kids) + b"] /Count %d >>" % len(kids)
+    objects.append(b"<< /Type /Catalog /Pages 2 0 R >>")
+    data, offsets = bytearray(b"%PDF-1.4\n"), []
+    for number, body in enumerate(objects, 1):
+        offsets.append(len(data))
+        data += b"%d 0 obj\n" % number + body + b"\nendobj\n"
+    xref = len(data)
+    data += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    data += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    data += b"trailer\n<< /Size %d /Root %d 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, len(objects), xref)
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+def write_synthetic_pdf(path, rng, vocabulary, page_count):
+    pages = []
+    for _ in range(page_count):
+        text = " ".join(make_paragraphs(rng, vocabulary, 4))
+        words = text.split()
+        pages.append([" ".join(words[i:i + 14]) for i in range(0, len(words), 14)][:60])
+    write_pdf(path, pages)
+
+
+def write_synthetic_docx(path, rng, vocabulary, paragraph_count):
+    """Bare-bones .docx (just word/document.xml) that Docx2txtLoader can read."""
+    body = "".join(f"<w:p><w:r><w:t>{text}</w:t></w:r></w:p>"
+                   for text in make_paragraphs(rng, vocabulary, paragraph_count))
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as docx:
+        docx.writestr("[Content_Types].xml",
+                      '<?xml version="1.0"?><Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+                      '<Default Extension="xml" ContentType="application/xml"/>'
+                      '<Override PartName="/word/document.xml" ContentType="application/vnd.openxmlformats-'
+                      'officedocument.wordprocessingml.document.main+xml"/></Types>')
+        docx.writestr("word/document.xml",
+                      '<?xml version="1.0"?><w:document xmlns:w="http://schemas.openxmlformats.org/'
+                      f'wordprocessingml/2006/main"><w:body>{body}</w:body></w:document>')
+
+
+def synthetic_html(rng, vocabulary, paragraph_count):
+    """A page with the navigation, script and footer boilerplate real sites have around their text."""
+    nav = "".join(f'<li><a href="/{word}">{word}</a></li>' for word in rng.sample(vocabulary, 20))
+    body = "".join(f"<h2>{rng.choice(vocabulary).title()}</h2><p>{text}</p>"
+                   for text in make_paragraphs(rng, vocabulary, paragraph_count))
+    return (f"<html><head><title>Synthetic</title><script>var x = {rng.random()};</script></head>"
+            f"<body><nav><ul>{nav}</ul></nav><main>{body}</main><footer>Copyright</footer></body></html>")
+
+
+def synthetic_chunks(rng, vocabulary, count, chunks_per_file=200):
+    """(key, chunks, info) sources in the shape add_sources takes, count chunks in total."""
+    from langchain_core.documents import Document
+
+    sources = []
+    for start in range(0, count, chunks_per_file):
+        doc_name = f"synthetic-{start // chunks_per_file:05d}.pdf"
+        chunks = []
+        for i, text in enumerate(make_paragraphs(rng, vocabulary, min(chunks_per_file, count - start))):
+            page = i // 6 + 1
+            chunks.append(Document(page_content=f"[{doc_name} - page {page}]\n{text[:_CHUNK_SIZE]}",
+                                   metadata={"page": page, "doc_name": doc_name}))
+        sources.append((os.path.join(DATA_FOLDER, doc_name), chunks, {"type": "file", "sha256": doc_name}))
+    return sources
+
+
+def build_index(embeddings, dim, index_path, sources):
+    """A fresh index at index_path holding sources (from synthetic_chunks), added ten at a time and saved."""
+    from index_log import wait_for_compaction
+    from index_manager import add_sources, new_vector_store, save_vector_store
+
+    vector_store = new_vector_store(embeddings, dim, index_path)
+    manifest = {"sources": {}}
+    for i in range(0, len(sources), 10):
+        vector_store = add_sources(vector_store, embeddings, manifest, sources[i:i + 10], index_path)
+    save_vector_store(vector_store, manifest)
+    vector_store.docstore.close()
+    # Searches are measured on the compacted index, not while it is being compacted.
+    wait_for_compaction(index_path)
+
+
+def build_corpus(args, workdir):
+    """Seed documents copied seed_copies times plus one synthetic PDF, DOCX and HTML page."""
+    rng = random.Random(args.seed)
+    vocabulary = seed_vocabulary(args.data)
+    corpus = os.path.join(workdir, "corpus")
+    os.makedirs(corpus, exist_ok=True)
+    files = []
+    if os.path.isdir(args.data):
+        docx_paths, pdf_paths = list_doc_paths(args.data)
+        for path in sorted(docx_paths + pdf_paths):
+            for copy in range(args.seed_copies):
+                name, ext = os.path.splitext(os.path.basename(path))
+                target = os.path.join(corpus, f"{name}-{copy}{ext}")
+                shutil.copyfile(path, target)
+                files.append(target)
+    pdf_path = os.path.join(corpus, "synthetic.pdf")
+    write_synthetic_pdf(pdf_path, rng, vocabulary, args.pdf_pages)
+    docx_path = os.path.join(corpus, "synthetic.docx")
+    write_synthetic_docx(docx_path, rng, vocabulary, args.pdf_pages * 4)
+    html_path = os.path.join(corpus, "synthetic.html")
+    with open(html_path, "w") as f:
+        f.write(synthetic_html(rng, vocabulary, 200))
+    return {"files": files + [pdf_path, docx_path], "html": html_path, "vocabulary": vocabulary}
+
+
+# ---------- scenarios (each runs in its own process) ----------
+
+def percentiles(samples):
+    ms = np.array(samples) * 1000
+    return {"p50_ms": float(np.percentile(ms, 50)), "p95_ms": float(np.percentile(ms, 95)),
+            "p99_ms": float(np.percentile(ms, 99)), "mean_ms": float(ms.mean())}
+
+
+def extract_text(path):
+    """Raw text per file type, the parse step without chunking."""
+    if path.endswith(".pdf"):
+        from pdf_loader import PyPDFLoader
+        return [doc.page_content for doc in PyPDFLoader(path).lazy_load()]
+    if path.endswith(".docx"):
+        from langchain_community.document_loaders import Docx2txtLoader
+        return [doc.page_content for doc in Docx2txtLoader(path).load()]
+    from html_extractor import extract_sections
+    with open(path) as f:
+        return ["\n\n".join(text for _, text in extract_sections(f.read())[1])]
+
+
+def scenario_parse(args, corpus):
+    """Text extraction per file type: MB and pages (or documents) per second."""
+    results = {}
+    for kind in ("pdf", "docx", "html"):
+        paths = [path for path in corpus["files"] + [corpus["html"]] if path.endswith("." + kind)]
+        started = time.perf_counter()
+        units = sum(len(extract_text(path)) for path in paths)
+        seconds = time.perf_counter() - started
+        size_mb = sum(os.path.getsize(path) for path in paths) / 1e6
+        results[kind] = {"files": len(paths), "units": units, "mb": size_mb, "time_s": seconds,
+                         "mb_per_s": size_mb / seconds, "units_per_s": units / seconds}
+    return results
+
+
+def scenario_chunk(args, corpus):
+    """The loaders end to end (load_pdf_chunks, load_docx_chunks, extract_html_content) and the splitter alone."""
+    from langchain_text_splitters import RecursiveCharacterTextSplitter
+    from docx_loader import load_docx_chunks
+    from pdf_loader import load_pdf_chunks
+    from web_loader import extract_html_content
+
+    results = {}
+    loaders = {"pdf": load_pdf_chunks, "docx": load_docx_chunks}
+    for kind, loader in loaders.items():
+        paths = [path for path in corpus["files"] if path.endswith("." + kind)]
+        started = time.perf_counter()
+        chunks = sum(len(loader(path)) for path in paths)
+        seconds = time.perf_counter() - started
+        results[f"load_{kind}"] = {"chunks": chunks, "time_s": seconds, "chunks_per_s": chunks / seconds}
+    with open(corpus["html"]) as f:
+        html = f.read()
+    started = time.perf_counter()
+    chunks = len(extract_html_content(html, "https://example.com/synthetic"))
+    seconds = time.perf_counter() - started
+    results["load_html"] = {"chunks": chunks, "time_s": seconds, "chunks_per_s": chunks / seconds}
+
+    texts = [text for path in corpus["files"] for text in extract_text(path)]
+    splitter = RecursiveCharacterTextSplitter(chunk_size=_CHUNK_SIZE, chunk_overlap=_CHUNK_OVERLAP)
+    started = time.perf_counter()
+    chunks = sum(len(splitter.split_text(text)) for text in texts)
+    seconds = time.perf_counter() - started
+    chars = sum(len(text) for text in texts)
+    results["split"] = {"chunks": chunks, "mb": chars / 1e6, "time_s": seconds,
+                        "chunks_per_s": chunks / seconds, "mb_per_s": chars / 1e6 / seconds}
+    return results
+
+
+def scenario_ingest(args, corpus):
+    """sync_index over the whole corpus: parse, embed (fake), index and save."""
+    from fake_openai import FakeEmbeddings
+    from index_manager import load_vector_store, sync_index
+
+    index_path = os.path.join(args.workdir, "ingest_index")
+    embeddings = FakeEmbeddings(args.dim)
+    started = time.perf_counter()
+    _, report = sync_index(embeddings, corpus["files"], [], index_path, args.workers)
+    seconds = time.perf_counter() - started
+    # Read back from disk: with FAISS_SHARD_BY set, sync_index hands back the shard writer, not a store.
+    vectors = len(load_vector_store(embeddings, index_path, mmap=True).index_to_docstore_id)
+    return {"files": len(corpus["files"]), "chunks": report["chunks"], "duplicates": report["duplicates"],
+            "vectors": vectors, "failed": len(report["failed"]),
+            "time_s": seconds, "chunks_per_s": report["chunks"] / seconds}
+
+
+def scenario_search(args, corpus, size):
+    """
+    Index build, load and per-query latency at size chunks: vector, lexical
+    and hybrid retrieval, context packing, and packed context + fake answer.
+    """
+    from context_packer import count_tokens, retrieve_context
+    from fake_openai import FakeChatModel, FakeEmbeddings
+    from index_log import index_kind
+    from index_manager import load_lexical_index, load_search_store
+    from qa import RETRIEVAL_K, retrieve, stream_answer
+
+    rng = random.Random(args.seed)
+    embeddings = FakeEmbeddings(args.dim)
+    index_path = os.path.join(args.workdir, f"search_index_{size}")
+    sources = synthetic_chunks(rng, corpus["vocabulary"], size)
+
+    started = time.perf_counter()
+    build_index(embeddings, args.dim, index_path, sources)
+    build_s = time.perf_counter() - started
+    del sources
+
+    started = time.perf_counter()
+    vector_store = load_search_store(embeddings, index_path)
+    lexical_index = load_lexical_index(vector_store, index_path)
+    load_s = time.perf_counter() - started
+
+    questions = [" ".join(rng.choice(corpus["vocabulary"]) for _ in range(rng.randint(3, 8)))
+                 for _ in range(args.queries)]
+    vectors = [embeddings.embed_query(question) for question in questions]
+    results = {"chunks": size, "index": index_kind(vector_store.index),
+               "build_s": build_s, "load_s": load_s, "build_chunks_per_s": size / build_s}
+    for mode in ("vector", "lexical", "hybrid"):
+        samples = []
+        for question, vector in zip(questions, vectors):
+            started = time.perf_counter()
+            retrieve(vector_store, lexical_index, question, vector, mode, RETRIEVAL_K)
+            samples.append(time.perf_counter() - started)
+        results[mode] = percentiles(samples)
+
+    samples, tokens = [], []
+    for question, vector in zip(questions, vectors):
+        started = time.perf_counter()
+        passages = retrieve_context(vector_store, lexical_index, question, vector, "hybrid")
+        samples.append(time.perf_counter() - started)
+        tokens.append(sum(count_tokens(passage.page_content) for passage in passages))
+    results["context"] = {**percentiles(samples), "mean_tokens": float(np.mean(tokens))}
+
+    llm = FakeChatModel()
+    first_token, total = [], []
+    for question, vector in zip(questions, vectors):
+        started, timings = time.perf_counter(), {}
+        docs = retrieve_context(vector_store, lexical_index, question, vector, "hybrid")
+        for _ in stream_answer(llm, question, docs, timings, started):
+            pass
+        first_token.append(timings.get("first_token_s", timings["answer_s"]))
+        total.append(timings["answer_s"])
+    results["answer"] = {"first_token": percentiles(first_token), "total": percentiles(total)}
+    return results
+
+
+def run_scenario(name, args, corpus, *extra):
+    baseline = peak_rss_mb()
+    result = globals()[f"scenario_{name}"](args, corpus, *extra)
+    result["peak_rss_mb"] = peak_rss_mb()
+    result["baseline_rss_mb"] = baseline
+    return result
+
+
+def isolated(name, args, corpus, *extra):
+    """Runs one scenario in a fresh process, so its peak memory is its own."""
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+        return pool.submit(run_scenario, name, args, corpus, *extra).result()
+
+
+# ---------- comparison ----------
+
+def flatten(results, prefix=""):
+    flat = {}
+    for key, value in results.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            flat.update(flatten(value, name + "."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[name] = value
+    return flat
+
+
+def regressions(current, baseline, tolerance):
+    """Metrics more than tolerance worse than baseline: throughputs (*_per_s) lower, times and memory higher."""
+    worse = []
+    current, baseline = flatten(current["scenarios"]), flatten(baseline["scenarios"])
+    for name, value in current.items():
+        old = baseline.get(name)
+        if not old:
+            continue
+        if name.endswith("_per_s"):
+            change = (old - value) / old
+        elif name.endswith(("_s", "_ms", "_mb")):
+            change = (value - old) / old
+        else:
+            continue
+        if change > tolerance:
+            worse.append((name, old, value, change))
+    return worse
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), timeout=10).stdout.strip() or None
+    except Exception:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark parsing, chunking, ingestion and search with fake "
+                                                 "embeddings and LLM; prints JSON results.")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="comma-separated (default: %(default)s)")
+    parser.add_argument("--sizes", default=BENCH_SIZES, help="search corpus sizes in chunks (default: %(default)s)")
+    parser.add_argument("--data", default=DATA_FOLDER, help="seed documents (default: %(default)s)")
+    parser.add_argument("--seed-copies", type=int, default=3, help="copies of each seed document in the corpus")
+    parser.add_argument("--pdf-pages", type=int, default=300, help="pages of the synthetic PDF")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--dim", type=int, default=1536, help="fake embedding dimensions")
+    parser.add_argument("--workers", type=int, default=1, help="parser processes for the ingest scenario")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workdir", help="keep the corpus and indexes here (default: a temporary directory)")
+    parser.add_argument("--output", help="write the JSON here instead of stdout")
+    parser.add_argument("--compare", help="earlier results JSON; exit 1 if any metric regressed past --tolerance")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative regression (default: 0.2)")
+    args = parser.parse_args()
+
+    keep = bool(args.workdir)
+    args.workdir = args.workdir or tempfile.mkdtemp(prefix="docuwhisperer-bench-")
+    os.makedirs(args.workdir, exist_ok=True)
+    try:
+        corpus = build_corpus(args, args.workdir)
+        scenarios = {}
+        for name in args.scenarios.split(","):
+            print(f"running {name}...", file=sys.stderr, flush=True)
+            if name == "search":
+                scenarios["search"] = {str(size): isolated("search", args, corpus, int(size))
+                                       for size in args.sizes.split(",")}
+            else:
+                scenarios[name] = isolated(name, args, corpus)
+    finally:
+        if not keep:
+            shutil.rmtree(args.workdir, ignore_errors=True)
+
+    results = {
+        "meta": {
+            "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "faiss_index_type": os.environ.get("FAISS_INDEX_TYPE", "flat"),
+            "args": {key: value for key, value in vars(args).items() if key not in ("output", "compare", "workdir")},
+        },
+        "scenarios": scenarios,
+    }
+    text = json.dumps(results, indent=1)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+    if args.compare:
+        with open(args.compare) as f:
+            worse = regressions(results, json.load(f), args.tolerance)
+        for name, old, new, change in worse:
+            print(f"REGRESSION {name}: {old:.4g} -> {new:.4g} ({change:+.0%})", file=sys.stderr)
+        return 1 if worse else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,322 @@
+# SQLite-backed docstore for the FAISS index: chunks are read on demand instead of unpickled at startup.
+import json
+import sqlite3
+import threading
+import time
+
+from langchain_community.docstore.base import AddableMixin, Docstore
+from langchain_core.documents import Document
+
+from dedup import lsh_keys
+
+CHUNK_STORE_FILE = "chunks.sqlite"
+
+# SQLite caps the number of bound parameters per statement.
+_SQL_BATCH = 500
+
+
+class ChunkStore(Docstore, AddableMixin):
+    """
+    Chunk text and metadata keyed by docstore id, plus the FAISS position ->
+    id mapping. Only the chunks a query hits are read. Adds and deletes go
+    into an open transaction that publish() makes visible together with
+    the new positions, the manifest's changed sources and a new version
+    row naming the vector files (see index_log.py), so readers never see
+    chunks for vectors that aren't saved yet, nor vectors without chunks.
+
+    It also keeps the fingerprints dedup.py matches new chunks against, and
+    aliases: duplicate chunks that were not embedded, each linked to the
+    indexed chunk it repeats.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=60)
+        # WAL lets the app keep reading while an update is being written.
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS chunks ("
+                "id TEXT PRIMARY KEY, page_content TEXT NOT NULL, metadata TEXT NOT NULL)"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS positions (position INTEGER PRIMARY KEY, id TEXT NOT NULL)"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS fingerprints (id TEXT PRIMARY KEY, exact TEXT NOT NULL, minhash BLOB)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS fingerprints_exact ON fingerprints (exact)")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS lsh_bands (band INTEGER, value INTEGER, id TEXT NOT NULL, "
+                "PRIMARY KEY (band, value, id)) WITHOUT ROWID"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS aliases (id TEXT PRIMARY KEY, canonical TEXT NOT NULL, "
+                "page_content TEXT NOT NULL, metadata TEXT NOT NULL, exact TEXT NOT NULL, minhash BLOB)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS aliases_canonical ON aliases (canonical)")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS sources (key TEXT PRIMARY KEY, entry TEXT NOT NULL)")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS versions (version INTEGER PRIMARY KEY, created REAL NOT NULL, "
+                "data TEXT NOT NULL)"
+            )
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM chunks").fetchone()[0]
+
+    def search(self, search):
+        doc = self.mget([search])[0]
+        # Same contract as InMemoryDocstore: a message string for unknown ids.
+        return doc if doc is not None else f"ID {search} not found."
+
+    def mget(self, ids):
+        """Documents for ids, in order; None for ids that are not stored."""
+        found = {}
+        unique = list(dict.fromkeys(ids))
+        with self._lock:
+            for start in range(0, len(unique), _SQL_BATCH):
+                batch = unique[start:start + _SQL_BATCH]
+                marks = ",".join("?" * len(batch))
+                rows = self._conn.execute(
+                    f"SELECT id, page_content, metadata FROM chunks WHERE id IN ({marks})", batch
+                ).fetchall()
+                for doc_id, page_content, metadata in rows:
+                    found[doc_id] = Document(id=doc_id, page_content=page_content, metadata=json.loads(metadata))
+        return [found.get(doc_id) for doc_id in ids]
+
+    def add(self, texts):
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO chunks (id, page_content, metadata) VALUES (?, ?, ?)",
+                [(doc_id, doc.page_content, json.dumps(doc.metadata)) for doc_id, doc in texts.items()],
+            )
+
+    def delete(self, ids):
+        rows = [(doc_id,) for doc_id in ids]
+        with self._lock:
+            self._conn.executemany("DELETE FROM chunks WHERE id = ?", rows)
+            self._conn.executemany("DELETE FROM fingerprints WHERE id = ?", rows)
+            self._conn.executemany("DELETE FROM lsh_bands WHERE id = ?", rows)
+
+    def clear(self):
+        # Version numbers carry on, so the files of earlier versions are never reused.
+        with self._lock:
+            for table in ("chunks", "positions", "fingerprints", "lsh_bands", "aliases", "sources"):
+                self._conn.execute(f"DELETE FROM {table}")
+
+    def add_fingerprints(self, fingerprints):
+        """{id: (exact, minhash)} for indexed chunks; minhash is None for chunks too short to compare."""
+        with self._lock:
+            self._insert_fingerprints(fingerprints.items())
+
+    def _insert_fingerprints(self, items):
+        items = list(items)
+        self._conn.executemany(
+            "INSERT OR REPLACE INTO fingerprints (id, exact, minhash) VALUES (?, ?, ?)",
+            [(doc_id, exact, signature) for doc_id, (exact, signature) in items],
+        )
+        signed = [(doc_id, signature) for doc_id, (_, signature) in items if signature is not None]
+        if signed:
+            keys = lsh_keys([signature for _, signature in signed])
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO lsh_bands (band, value, id) VALUES (?, ?, ?)",
+                [(band, value, doc_id) for (doc_id, _), row in zip(signed, keys.tolist())
+                 for band, value in enumerate(row)],
+            )
+
+    def find_exact(self, hashes):
+        """{exact fingerprint: id of an indexed chunk that has it} for those of hashes that are indexed."""
+        found = {}
+        unique = list(set(hashes))
+        with self._lock:
+            for start in range(0, len(unique), _SQL_BATCH):
+                batch = unique[start:start + _SQL_BATCH]
+                marks = ",".join("?" * len(batch))
+                found.update(self._conn.execute(
+                    f"SELECT exact, MIN(id) FROM fingerprints WHERE exact IN ({marks}) GROUP BY exact", batch
+                ).fetchall())
+        return found
+
+    def find_near(self, bands):
+        """{(band, value): [(id, minhash), ...]} of indexed chunks under those LSH keys: the candidates to compare."""
+        values_by_band = {}
+        for band, value in set(bands):
+            values_by_band.setdefault(band, []).append(value)
+        found = {}
+        with self._lock:
+            for band, values in values_by_band.items():
+                for start in range(0, len(values), _SQL_BATCH):
+                    batch = values[start:start + _SQL_BATCH]
+                    marks = ",".join("?" * len(batch))
+                    rows = self._conn.execute(
+                        f"SELECT b.value, f.id, f.minhash FROM lsh_bands b JOIN fingerprints f ON f.id = b.id "
+                        f"WHERE b.band = ? AND b.value IN ({marks})", [band] + batch,
+                    ).fetchall()
+                    for value, doc_id, signature in rows:
+                        found.setdefault((band, value), []).append((doc_id, signature))
+        return found
+
+    def missing_fingerprints(self):
+        """(id, page_content) of chunks that have no fingerprint yet."""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT id, page_content FROM chunks WHERE id NOT IN (SELECT id FROM fingerprints)"
+            ).fetchall()
+
+    def add_aliases(self, aliases):
+        """{alias id: (canonical id, Document, (exact, minhash))} for duplicates that were not embedded."""
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO aliases (id, canonical, page_content, metadata, exact, minhash) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                [(alias_id, canonical, doc.page_content, json.dumps(doc.metadata), exact, signature)
+                 for alias_id, (canonical, doc, (exact, signature)) in aliases.items()],
+            )
+
+    def delete_aliases(self, ids):
+        with self._lock:
+            self._conn.executemany("DELETE FROM aliases WHERE id = ?", [(doc_id,) for doc_id in ids])
+
+    def alias_count(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM aliases").fetchone()[0]
+
+    def heirs(self, ids):
+        """{canonical id: id of its oldest alias} for the ids that have aliases."""
+        found = {}
+        unique = list(dict.fromkeys(ids))
+        with self._lock:
+            for start in range(0, len(unique), _SQL_BATCH):
+                batch = unique[start:start + _SQL_BATCH]
+                marks = ",".join("?" * len(batch))
+                rows = self._conn.execute(
+                    f"SELECT canonical, id FROM aliases WHERE rowid IN (SELECT MIN(rowid) FROM aliases "
+                    f"WHERE canonical IN ({marks}) GROUP BY canonical)", batch
+                ).fetchall()
+                found.update(rows)
+        return found
+
+    def promote(self, canonical, heir):
+        """
+        Replaces chunk canonical with its alias heir, which keeps canonical's
+        vector; the other aliases of canonical now point at heir.
+        """
+        with self._lock:
+            page_content, metadata, exact, signature = self._conn.execute(
+                "SELECT page_content, metadata, exact, minhash FROM aliases WHERE id = ?", (heir,)
+            ).fetchone()
+            for table in ("chunks", "fingerprints", "lsh_bands"):
+                self._conn.execute(f"DELETE FROM {table} WHERE id = ?", (canonical,))
+            self._conn.execute("DELETE FROM aliases WHERE id = ?", (heir,))
+            self._conn.execute(
+                "INSERT OR REPLACE INTO chunks (id, page_content, metadata) VALUES (?, ?, ?)",
+                (heir, page_content, metadata),
+            )
+            self._insert_fingerprints([(heir, (exact, signature))])
+            self._conn.execute("UPDATE aliases SET canonical = ? WHERE canonical = ?", (heir, canonical))
+
+    def positions(self):
+        """The saved FAISS position -> docstore id mapping."""
+        with self._lock:
+            return dict(self._conn.execute("SELECT position, id FROM positions").fetchall())
+
+    def commit(self, index_to_docstore_id=None):
+        """Makes all pending changes visible, replacing the saved positions with index_to_docstore_id if given."""
+        with self._lock:
+            if index_to_docstore_id is not None:
+                self._conn.execute("DELETE FROM positions")
+                self._conn.executemany(
+                    "INSERT INTO positions (position, id) VALUES (?, ?)", index_to_docstore_id.items()
+                )
+            self._conn.commit()
+
+    def latest_version(self):
+        """The number of the latest published version; 0 if there is none."""
+        with self._lock:
+            return self._conn.execute("SELECT MAX(version) FROM versions").fetchone()[0] or 0
+
+    def snapshot(self):
+        """(number, data, positions) of the latest published version, read in one transaction; None if there is none."""
+        with self._lock:
+            begun = not self._conn.in_transaction
+            if begun:
+                self._conn.execute("BEGIN")
+            try:
+                row = self._conn.execute(
+                    "SELECT version, data FROM versions ORDER BY version DESC LIMIT 1"
+                ).fetchone()
+                positions = dict(self._conn.execute("SELECT position, id FROM positions").fetchall()) if row else {}
+            finally:
+                if begun:
+                    self._conn.commit()
+        return (row[0], json.loads(row[1]), positions) if row else None
+
+    def versions(self):
+        """[(number, created, data)] of the versions still recorded, oldest first."""
+        with self._lock:
+            rows = self._conn.execute("SELECT version, created, data FROM versions ORDER BY version").fetchall()
+        return [(number, created, json.loads(data)) for number, created, data in rows]
+
+    def prune_versions(self, oldest):
+        """Forgets the versions before oldest."""
+        with self._lock:
+            self._conn.execute("DELETE FROM versions WHERE version < ?", (oldest,))
+            self._conn.commit()
+
+    def sources(self):
+        """The manifest's sources as of the latest published version: {key: entry}."""
+        with self._lock:
+            rows = self._conn.execute("SELECT key, entry FROM sources").fetchall()
+        return {key: json.loads(entry) for key, entry in rows}
+
+    def update_sources(self, entries):
+        """
+        Rewrites the manifest entries given ({key: entry}) without publishing
+        a version, for bookkeeping no search depends on (when web pages were
+        last checked). Keys the manifest doesn't have are ignored.
+        """
+        with self._lock:
+            self._conn.executemany(
+                "UPDATE sources SET entry = ? WHERE key = ?", [(json.dumps(entry), key) for key, entry in entries.items()]
+            )
+            self._conn.commit()
+
+    def publish(self, number, data, added=None, deleted=(), renamed=None, sources=None, removed_sources=(),
+                positions=None):
+        """
+        Commits the pending chunk changes as version number: data names its
+        vector files; added, deleted and renamed are the position changes
+        that go with them ({position: id}, positions, {position: new id}),
+        or positions the complete new mapping. sources are the manifest
+        entries that changed ({key: entry}), removed_sources the keys that
+        are gone.
+        """
+        with self._lock:
+            if positions is not None:
+                self._conn.execute("DELETE FROM positions")
+                added = positions
+            self._conn.executemany("INSERT INTO positions (position, id) VALUES (?, ?)", (added or {}).items())
+            self._conn.executemany("DELETE FROM positions WHERE position = ?", [(p,) for p in deleted])
+            self._conn.executemany(
+                "UPDATE positions SET id = ? WHERE position = ?", [(i, p) for p, i in (renamed or {}).items()]
+            )
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO sources (key, entry) VALUES (?, ?)",
+                [(key, json.dumps(entry)) for key, entry in (sources or {}).items()],
+            )
+            self._conn.executemany("DELETE FROM sources WHERE key = ?", [(key,) for key in removed_sources])
+            self._conn.execute(
+                "INSERT INTO versions (version, created, data) VALUES (?, ?, ?)",
+                (number, time.time(), json.dumps(data)),
+            )
+            self._conn.commit()
+
+    def rollback(self):
+        with self._lock:
+            self._conn.rollback()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,190 @@
+# Command-line entry point: build/update the index and ask questions without running the Streamlit app.
+import argparse
+import atexit
+import os
+import sys
+import time
+
+import metrics
+from env_setup import setup_environment, make_embeddings, make_llm
+from index_log import compact, index_kind, remove_index, wait_for_compaction, writer_lock
+from index_manager import (FAISS_INDEX_PATH, is_sharded, load_lexical_index, load_manifest, load_search_store,
+                           load_vector_store, sync_index)
+from sharded_index import shard_names, shard_path
+from parallel_loader import INGEST_WORKERS
+from context_packer import CONTEXT_FETCH_K, CONTEXT_TOKEN_BUDGET, retrieve_context
+from qa import RETRIEVAL_MODES, stream_answer
+from vector_codec import bytes_per_vector
+from utils import DATA_FOLDER, list_doc_paths, load_web_urls
+
+
+def log(message):
+    print(message, file=sys.stderr, flush=True)
+
+
+def index_update(args, embeddings):
+    """Sync the index with data/ and web_urls.json, fetching web pages that are not indexed yet."""
+    docx_paths, pdf_paths = list_doc_paths(args.data)
+    web_urls = load_web_urls()
+    started = time.perf_counter()
+    log(f"Syncing {len(docx_paths) + len(pdf_paths)} documents and {len(web_urls)} web pages into {args.index}")
+
+    def file_progress(done, total, path):
+        log(f"  [{done}/{total}] parsed {os.path.basename(path)}")
+
+    _, report = sync_index(embeddings, docx_paths + pdf_paths, web_urls, args.index, args.workers, file_progress,
+                           data_folder=args.data)
+    log(
+        f"Files: {report['added']} added, {report['updated']} updated, {report['removed']} removed, "
+        f"{report['unchanged']} unchanged ({report['chunks'] - report['duplicates']} chunks embedded, "
+        f"{report['duplicates']} duplicates linked)"
+    )
+    for path, error in report["failed"]:
+        log(f"  could not parse {path}: {error}")
+    if report["peak_rss_mb"] is not None:
+        log(f"Peak memory: {report['peak_rss_mb']:.0f} MB (parser workers {report['worker_peak_rss_mb']:.0f} MB)")
+    failed = bool(report["failed"])
+
+    missing = [url for url in web_urls if url not in load_manifest(args.index)["sources"]]
+    if missing:
+        # Imported here so document-only runs don't pay for the web stack.
+        from web_crawler import crawl
+        from web_loader import BrowserPool
+
+        pool = BrowserPool() if args.browser else None
+
+        def page_progress(progress):
+            log(f"  web: {progress['fetched']} fetched, {progress['failed']} failed, "
+                f"{progress['indexed_pages']} indexed, {progress['queued']} queued")
+
+        try:
+            result = crawl(urls=missing, embeddings=embeddings, index_path=args.index, pool=pool,
+                           on_progress=page_progress)
+        finally:
+            if pool:
+                pool.close()
+        log(f"Web pages: {result['indexed_pages']} added ({result['indexed_chunks']} chunks)")
+        for url, error in result["errors"]:
+            log(f"  could not load {url}: {error}")
+        failed = failed or bool(result["errors"])
+    log(f"Done in {time.perf_counter() - started:.1f}s")
+    # Non-zero when anything could not be indexed, so deploy scripts and CI notice.
+    return 1 if failed else 0
+
+
+def index_build(args, embeddings):
+    """Rebuild the index from scratch (the embedding cache still saves re-embedding unchanged chunks)."""
+    with writer_lock(args.index):
+        remove_index(args.index)
+    return index_update(args, embeddings)
+
+
+def index_compact(args, embeddings):
+    """Merge the segments added since the last compaction into the base now, instead of waiting for it to be due."""
+    manifest = load_manifest(args.index)
+    paths = [shard_path(args.index, name) for name in shard_names(manifest)] if is_sharded(manifest) else [args.index]
+    for path in paths:
+        # One that an update just started in the background is finished first.
+        wait_for_compaction(path)
+        number = compact(path, embeddings)
+        log(f"{path}: {f'compacted into version {number}' if number else 'nothing to compact'}")
+    return 0
+
+
+def index_stats(args, embeddings):
+    vector_store = load_vector_store(embeddings, args.index, mmap=True)
+    if vector_store is None:
+        print(f"No index at {args.index}")
+        return 1
+    manifest = load_manifest(args.index)
+    sources = manifest["sources"]
+    kinds = {}
+    for entry in sources.values():
+        kinds[entry.get("type", "unknown")] = kinds.get(entry.get("type", "unknown"), 0) + 1
+    size = sum(os.path.getsize(os.path.join(folder, name))
+               for folder, _, names in os.walk(args.index) for name in names)
+    print(f"index:      {args.index} ({size / 1e6:.1f} MB on disk)")
+    print(f"vectors:    {len(vector_store.index_to_docstore_id)} x {vector_store.index.d}")
+    version = getattr(vector_store, "version", None)
+    if version:
+        print(f"version:    {version['number']} ({len(version['segments'])} segments since the last compaction, "
+              f"{version['ntotal'] - version['live']} deleted vectors not yet compacted away)")
+        spec = version.get("codec")
+        print(f"storage:    {spec or 'float32'} ({bytes_per_vector(spec, vector_store.index.d)} bytes per vector)")
+    print(f"sources:    {len(sources)} ({', '.join(f'{n} {kind}' for kind, n in sorted(kinds.items())) or 'none'})")
+    if is_sharded(manifest):
+        print(f"shards:     {len(vector_store.shards)} (by {manifest['shard_by']})")
+    aliases = vector_store.docstore.alias_count() if hasattr(vector_store.docstore, "alias_count") else 0
+    print(f"duplicates: {aliases} chunks linked instead of embedded")
+    print(f"lexical:    {len(load_lexical_index(vector_store, args.index))} chunks")
+    search_store = load_search_store(embeddings, args.index)
+    search_index = index_kind(search_store.index)
+    print(f"search:     {search_index}{' (exact)' if search_index.startswith('IndexFlat') else ''}")
+    print(f"emb. cache: {embeddings.stats()['entries']} vectors")
+    return 0
+
+
+def query(args, embeddings):
+    vector_store = load_search_store(embeddings, args.index)
+    if vector_store is None:
+        log(f"No index at {args.index}; run `python cli.py index build` first.")
+        return 1
+    lexical_index = load_lexical_index(vector_store, args.index)
+
+    started = time.perf_counter()
+    query_vector = None
+    if args.mode != "lexical":
+        with metrics.span("query_embedding"):
+            query_vector = embeddings.embed_query(args.question)
+    docs = retrieve_context(vector_store, lexical_index, args.question, query_vector, args.mode, args.k, args.budget)
+    timings = {"retrieval_s": time.perf_counter() - started}
+    for i, doc in enumerate(docs, 1):
+        source = doc.metadata.get("doc_name") or doc.metadata.get("source", "unknown")
+        log(f"[{i}] {source}")
+    if args.no_answer or not docs:
+        if not docs:
+            log("No matching content found.")
+        return 0 if docs else 1
+
+    for piece in stream_answer(make_llm(), args.question, docs, timings, started):
+        print(piece, end="", flush=True)
+    print()
+    log(", ".join(f"{name} {seconds:.2f}s" for name, seconds in timings.items()))
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="DocuWhisperer indexing and query tool.")
+    parser.add_argument("--index", default=FAISS_INDEX_PATH, help="index directory (default: %(default)s)")
+    parser.add_argument("--metrics", metavar="FILE",
+                        help="write stage timings and counters here on exit (.json, else Prometheus text)")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    index_parser = commands.add_parser("index", help="build, update or inspect the index")
+    index_parser.add_argument("action", choices=["build", "update", "stats", "compact"])
+    index_parser.add_argument("--data", default=DATA_FOLDER, help="documents folder (default: %(default)s)")
+    index_parser.add_argument("--workers", type=int, default=INGEST_WORKERS, help="parser processes")
+    index_parser.add_argument("--browser", action="store_true",
+                              help="render JavaScript-only web pages in headless Chrome")
+
+    query_parser = commands.add_parser("query", help="ask a question against the index")
+    query_parser.add_argument("question")
+    query_parser.add_argument("--mode", choices=RETRIEVAL_MODES, default="vector")
+    query_parser.add_argument("-k", type=int, default=CONTEXT_FETCH_K, help="candidate chunks to consider")
+    query_parser.add_argument("--budget", type=int, default=CONTEXT_TOKEN_BUDGET, help="context tokens")
+    query_parser.add_argument("--no-answer", action="store_true", help="only print the retrieved sources")
+
+    args = parser.parse_args()
+    setup_environment()
+    metrics.start_exporters()
+    if args.metrics:
+        atexit.register(metrics.write_metrics, args.metrics)
+    embeddings = make_embeddings()
+    if args.command == "query":
+        return query(args, embeddings)
+    actions = {"build": index_build, "update": index_update, "stats": index_stats, "compact": index_compact}
+    return actions[args.action](args, embeddings)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,188 @@
+# Builds the Chat prompt's context: more candidates, diversified with MMR, overlaps merged, packed to a token budget.
+import functools
+import os
+import re
+
+import numpy as np
+from langchain_core.documents import Document
+
+import metrics
+from qa import fetch_chunks, retrieve_ids
+from utils import split_header
+
+CONTEXT_FETCH_K = int(os.environ.get("CONTEXT_FETCH_K", "20"))
+CONTEXT_TOKEN_BUDGET = int(os.environ.get("CONTEXT_TOKEN_BUDGET", "3000"))
+# 1 ranks purely by relevance, 0 purely by novelty against what is already picked.
+CONTEXT_MMR_LAMBDA = float(os.environ.get("CONTEXT_MMR_LAMBDA", "0.7"))
+# gpt-4o's tokenizer; falls back to cl100k_base, then to ~4 characters per token.
+CONTEXT_ENCODING = os.environ.get("CONTEXT_ENCODING", "o200k_base")
+
+# Ids from index_manager.source_ids: 16 hex digits of the source, then the chunk's position in it.
+_SOURCE_ID_RE = re.compile(r"^(?P<source>[0-9a-f]{16})-(?P<n>\d+)$")
+# Shorter shared runs are coincidence, not splitter overlap.
+_MIN_OVERLAP = 20
+_MAX_OVERLAP = 400
+
+
+@functools.lru_cache(maxsize=1)
+def _get_encoder():
+    try:
+        import tiktoken
+    except ImportError:
+        return None
+    for name in (CONTEXT_ENCODING, "cl100k_base"):
+        try:
+            return tiktoken.get_encoding(name)
+        except Exception:
+            continue
+    return None
+
+
+def count_tokens(text):
+    encoder = _get_encoder()
+    if encoder is None:
+        return max(1, len(text) // 4)
+    return len(encoder.encode(text, disallowed_special=()))
+
+
+def truncate_to_tokens(text, budget):
+    encoder = _get_encoder()
+    if encoder is None:
+        return text[:budget * 4]
+    return encoder.decode(encoder.encode(text, disallowed_special=())[:budget])
+
+
+def stored_vectors(vector_store, ids):
+    """Normalized vectors of ids read back from the flat index (no re-embedding), or None if it can't."""
+    index = getattr(vector_store, "flat_index", vector_store.index)
+    positions = getattr(vector_store, "_positions_by_id", None)
+    if positions is None or len(positions) != len(vector_store.index_to_docstore_id):
+        positions = {doc_id: position for position, doc_id in vector_store.index_to_docstore_id.items()}
+        vector_store._positions_by_id = positions
+    try:
+        vectors = index.reconstruct_batch(np.array([positions[doc_id] for doc_id in ids], dtype=np.int64))
+    except Exception:
+        return None
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+
+def mmr_order(relevance, vectors, lambda_mult=CONTEXT_MMR_LAMBDA):
+    """Candidate positions in maximal-marginal-relevance order."""
+    similarity = vectors @ vectors.T
+    order = [int(np.argmax(relevance))]
+    remaining = set(range(len(relevance))) - set(order)
+    while remaining:
+        candidates = list(remaining)
+        redundancy = similarity[np.ix_(candidates, order)].max(axis=1)
+        scores = lambda_mult * relevance[candidates] - (1 - lambda_mult) * redundancy
+        best = candidates[int(np.argmax(scores))]
+        order.append(best)
+        remaining.remove(best)
+    return order
+
+
+def join_overlapping(first, second):
+    """second appended to first, without the text the splitter repeated at the boundary."""
+    for size in range(min(len(first), len(second), _MAX_OVERLAP), _MIN_OVERLAP - 1, -1):
+        if first.endswith(second[:size]):
+            return first + second[size:]
+    return first + "\n" + second
+
+
+def merge_adjacent(docs):
+    """
+    Groups chunks that sit next to each other in the same source into one
+    passage (in the order the first member of each group was picked) and
+    strips the repeated overlap and per-chunk headers.
+    """
+    keyed, groups = [], []
+    for rank, doc in enumerate(docs):
+        match = _SOURCE_ID_RE.match(doc.id or "")
+        if match:
+            keyed.append((match["source"], int(match["n"]), rank, doc))
+        else:
+            groups.append((rank, [doc]))
+    keyed.sort(key=lambda item: (item[0], item[1]))
+    for i, (source, n, rank, doc) in enumerate(keyed):
+        previous = keyed[i - 1] if i else None
+        if previous and previous[0] == source and previous[1] == n - 1:
+            first_rank, members = groups[-1]
+            groups[-1] = (min(first_rank, rank), members + [doc])
+        else:
+            groups.append((rank, [doc]))
+    groups.sort(key=lambda group: group[0])
+
+    passages = []
+    for _, group in groups:
+        doc_name, first_page, body = split_header(group[0].page_content)
+        last_page = first_page
+        for doc in group[1:]:
+            _, page, text = split_header(doc.page_content)
+            last_page = page or last_page
+            body = join_overlapping(body, text)
+        if doc_name is not None:
+            pages = f"page {first_page}" if first_page == last_page else f"pages {first_page}-{last_page}"
+            body = f"[{doc_name} - {pages}]\n{body}"
+        metadata = dict(group[0].metadata)
+        if len(group) > 1:
+            metadata["chunk_ids"] = [doc.id for doc in group]
+        passages.append(Document(page_content=body, metadata=metadata))
+    return passages
+
+
+def drop_redundant(passages):
+    """Drops passages whose text (ignoring header and whitespace) is already contained in a kept one."""
+    kept, kept_bodies = [], []
+    for passage in passages:
+        body = " ".join(split_header(passage.page_content)[2].split())
+        if any(body in other for other in kept_bodies):
+            continue
+        kept.append(passage)
+        kept_bodies.append(body)
+    return kept
+
+
+def pack(passages, budget=CONTEXT_TOKEN_BUDGET):
+    """Greedy, in order: every passage that still fits; the first one is truncated if it alone is too big."""
+    packed, used = [], 0
+    for passage in passages:
+        tokens = count_tokens(passage.page_content)
+        if used + tokens > budget:
+            if packed:
+                continue
+            passage = Document(page_content=truncate_to_tokens(passage.page_content, budget),
+                               metadata=passage.metadata)
+            tokens = budget
+        packed.append(passage)
+        used += tokens
+    return packed, used
+
+
+def retrieve_context(vector_store, lexical_index, query, query_vector=None, mode="vector",
+                     fetch_k=CONTEXT_FETCH_K, budget=CONTEXT_TOKEN_BUDGET, search=None):
+    """
+    The passages to answer query from: fetch_k candidates from retrieve_ids,
+    reordered with MMR on their stored vectors (relevance is similarity to
+    query_vector in vector mode, rank otherwise), adjacent chunks merged,
+    repeats dropped, and as many packed as fit in budget tokens. search is
+    passed on to retrieve_ids.
+    """
+    ids = retrieve_ids(vector_store, lexical_index, query, query_vector, mode, fetch_k, search)
+    docs = fetch_chunks(vector_store, ids)
+    if len(docs) > 1:
+        with metrics.span("mmr"):
+            vectors = stored_vectors(vector_store, [doc.id for doc in docs])
+            if vectors is not None:
+                if mode == "vector" and query_vector is not None:
+                    direction = np.asarray(query_vector, dtype=np.float32)
+                    relevance = vectors @ (direction / (np.linalg.norm(direction) or 1))
+                else:
+                    relevance = 1 - np.arange(len(docs)) / len(docs)
+                docs = [docs[i] for i in mmr_order(relevance, vectors)]
+    with metrics.span("context_pack"):
+        passages, tokens = pack(drop_redundant(merge_adjacent(docs)), budget)
+    metrics.count("context_candidates", len(docs))
+    metrics.count("context_passages", len(passages))
+    metrics.count("context_tokens", tokens)
+    return passages
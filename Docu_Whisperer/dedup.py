@@ -0,0 +1,124 @@
+# Fingerprints chunks so exact and near-duplicate text is embedded and indexed only once.
+import hashlib
+import os
+import re
+import zlib
+
+import numpy as np
+
+import metrics
+from utils import split_header
+
+# "near" (exact + MinHash), "exact" (identical text only) or "off".
+DEDUP_MODE = os.environ.get("DEDUP_MODE", "near")
+# Estimated Jaccard similarity of two chunks' word 3-shingles above which they count as duplicates.
+DEDUP_MIN_SIMILARITY = float(os.environ.get("DEDUP_MIN_SIMILARITY", "0.8"))
+# Below this many words a chunk only matches exactly: a few shingles make a meaningless MinHash.
+DEDUP_MIN_WORDS = int(os.environ.get("DEDUP_MIN_WORDS", "30"))
+SHINGLE_WORDS = 3
+MINHASH_PERMUTATIONS = 64
+# 16 bands of 4 values: chunks at 0.8 similarity share a band with >99.9% probability, at 0.3 about 12%.
+LSH_BANDS = 16
+
+_WORD_RE = re.compile(r"\w+")
+# Fixed seed: signatures are stored in the chunk store and compared across runs.
+_rng = np.random.RandomState(20240601)
+
+
+def _odd_multipliers(count):
+    return _rng.randint(1, 1 << 62, count, dtype=np.int64).astype(np.uint64) * np.uint64(4) + np.uint64(1)
+
+
+# Multiply-shift hash functions, one per MinHash value.
+_A = _odd_multipliers(MINHASH_PERMUTATIONS)
+_B = _odd_multipliers(MINHASH_PERMUTATIONS)
+# Mix word hashes into shingle hashes, and signature rows into band keys.
+_SHINGLE_MIX = _odd_multipliers(SHINGLE_WORDS)
+_BAND_MIX = _odd_multipliers(MINHASH_PERMUTATIONS // LSH_BANDS)
+
+
+def normalized_words(text):
+    """The chunk's words, lowercased, without the loader header (which names the file and page)."""
+    return _WORD_RE.findall(split_header(text)[2].lower())
+
+
+def minhash(words):
+    """MINHASH_PERMUTATIONS uint32 minimums over the word shingles, as bytes."""
+    words = np.fromiter((zlib.crc32(word.encode("utf-8")) for word in words), np.uint64, len(words))
+    if len(words) < SHINGLE_WORDS:
+        words = np.pad(words, (0, SHINGLE_WORDS - len(words)))
+    count = len(words) - SHINGLE_WORDS + 1
+    shingles = np.zeros(count, np.uint64)
+    for offset, mix in enumerate(_SHINGLE_MIX):
+        shingles += words[offset:offset + count] * mix
+    # 32-bit keys for multiply-shift hashing, which keeps the top 32 bits of a 64-bit product.
+    shingles = shingles >> np.uint64(32)
+    return ((shingles[:, None] * _A + _B) >> np.uint64(32)).min(axis=0).astype(np.uint32).tobytes()
+
+
+def similarity(signature, other):
+    """Estimated Jaccard similarity of the shingle sets two signatures came from."""
+    return float(np.mean(np.frombuffer(signature, np.uint32) == np.frombuffer(other, np.uint32)))
+
+
+def lsh_keys(signatures):
+    """(len(signatures), LSH_BANDS) band keys: near-duplicates almost always share at least one."""
+    rows = np.frombuffer(b"".join(signatures), np.uint32).astype(np.uint64).reshape(len(signatures), LSH_BANDS, -1)
+    # 32 bits are plenty to find candidates (each is compared anyway) and take half the space in SQLite.
+    return ((rows * _BAND_MIX).sum(axis=2) >> np.uint64(32)).astype(np.int64)
+
+
+def fingerprint(text):
+    """(exact, signature): a hash of the normalized text, and its MinHash (None for short chunks)."""
+    words = normalized_words(text)
+    exact = hashlib.sha256(" ".join(words).encode("utf-8")).hexdigest()[:32]
+    return exact, minhash(words) if len(words) >= DEDUP_MIN_WORDS else None
+
+
+def find_duplicates(store, chunks, ids, mode=DEDUP_MODE):
+    """
+    Fingerprints chunks about to be added under ids and matches them against
+    the chunks already in store (a ChunkStore, or None) and the ones before
+    them in the list. Returns (fingerprints, links): one (exact, signature)
+    per chunk, and {position: canonical id} for the chunks that repeat another.
+    """
+    if mode == "off":
+        return [None] * len(chunks), {}
+    prints = [fingerprint(chunk.page_content) for chunk in chunks]
+    signed = [position for position, (_, signature) in enumerate(prints) if signature is not None]
+    bands = {position: list(enumerate(row)) for position, row in
+             zip(signed, lsh_keys([prints[position][1] for position in signed]).tolist() if signed else [])}
+    indexed_exact, indexed_near = {}, {}
+    if store is not None:
+        indexed_exact = store.find_exact([exact for exact, _ in prints])
+        if mode == "near":
+            indexed_near = store.find_near([band for position in signed for band in bands[position]])
+    links = {}
+    exact_seen, near_seen = {}, {}  # earlier chunks of this call, by exact hash / by LSH band
+    for position, (exact, signature) in enumerate(prints):
+        canonical, kind = exact_seen.get(exact) or indexed_exact.get(exact), "exact"
+        if canonical is None and mode == "near" and signature is not None:
+            kind = "near"
+            candidates = [seen for band in bands[position]
+                          for seen in near_seen.get(band, []) + indexed_near.get(band, [])]
+            best = max(candidates, key=lambda candidate: similarity(signature, candidate[1]), default=None)
+            if best is not None and similarity(signature, best[1]) >= DEDUP_MIN_SIMILARITY:
+                canonical = best[0]
+        if canonical is not None:
+            links[position] = canonical
+            metrics.count("chunks_deduplicated", kind=kind)
+            continue
+        exact_seen[exact] = ids[position]
+        for band in bands.get(position, ()):
+            near_seen.setdefault(band, []).append((ids[position], signature))
+    return prints, links
+
+
+def backfill_fingerprints(store, batch=1000):
+    """Fingerprints the chunks indexed before deduplication existed, so new chunks are matched against them too."""
+    if DEDUP_MODE == "off":
+        return 0
+    missing = store.missing_fingerprints()
+    for start in range(0, len(missing), batch):
+        store.add_fingerprints({doc_id: fingerprint(text) for doc_id, text in missing[start:start + batch]})
+    return len(missing)
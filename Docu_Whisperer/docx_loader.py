@@ -3,11 +3,16 @@ import os
 from langchain_community.document_loaders import Docx2txtLoader
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 
+import metrics
+
 def load_docx_chunks(path):
     loader = Docx2txtLoader(path)
-    documents = loader.load()
+    with metrics.span("parse", kind="docx"):
+        documents = loader.load()
     splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
-    chunks = splitter.split_documents(documents)
+    with metrics.span("split", kind="docx"):
+        chunks = splitter.split_documents(documents)
+    metrics.count("chunks_created", len(chunks), kind="docx")
     for chunk in chunks:
         doc_name = os.path.basename(path)
         page = chunk.metadata.get("page", "N/A")
@@ -0,0 +1,132 @@
+# Persistent on-disk embedding cache, so re-indexing only embeds chunks it has not seen before.
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from array import array
+
+from langchain_core.embeddings import Embeddings
+
+import metrics
+
+EMBEDDING_CACHE_PATH = "embedding_cache.sqlite"
+EMBEDDING_CACHE_MAX_ENTRIES = int(os.environ.get("EMBEDDING_CACHE_MAX_ENTRIES", "200000"))
+
+# SQLite caps the number of bound parameters per statement.
+_SQL_BATCH = 500
+
+
+def cache_key(model, text):
+    return hashlib.sha256(f"{model}\x00{text}".encode("utf-8")).hexdigest()
+
+
+def _to_blob(vector):
+    return array("f", vector).tobytes()
+
+
+def _from_blob(blob):
+    vector = array("f")
+    vector.frombytes(blob)
+    return vector.tolist()
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Wraps an Embeddings object and stores every document vector in SQLite,
+    keyed by a hash of (model name, chunk text). Only cache misses are sent
+    to the wrapped embeddings. Least recently used entries are evicted once
+    the cache grows past max_entries. Questions go straight to the
+    wrapped embeddings, so hits and misses count index builds only.
+    """
+
+    def __init__(self, embeddings, model, path=EMBEDDING_CACHE_PATH, max_entries=EMBEDDING_CACHE_MAX_ENTRIES):
+        self.embeddings = embeddings
+        self.model = model
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings ("
+                "key TEXT PRIMARY KEY, vector BLOB NOT NULL, last_used REAL NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings(last_used)")
+
+    def embed_documents(self, texts):
+        keys = [cache_key(self.model, text) for text in texts]
+        found = self._get_many(keys)
+
+        # Embed each distinct missing text once, even if it appears several times.
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in found and key not in missing:
+                missing[key] = text
+        misses = sum(1 for key in keys if key not in found)
+        with self._lock:
+            self.hits += len(keys) - misses
+            self.misses += misses
+        metrics.count("embedding_cache_lookups", len(keys) - misses, result="hit")
+        metrics.count("embedding_cache_lookups", misses, result="miss")
+
+        if missing:
+            vectors = self.embeddings.embed_documents(list(missing.values()))
+            new = dict(zip(missing.keys(), vectors))
+            self._put_many(new)
+            found.update(new)
+        return [found[key] for key in keys]
+
+    def embed_query(self, text):
+        return self.embeddings.embed_query(text)
+
+    def embed_queries(self, texts):
+        """Embeds a batch of questions, uncached like embed_query."""
+        embed = getattr(self.embeddings, "embed_queries", self.embeddings.embed_documents)
+        return embed(texts)
+
+    def stats(self):
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "entries": entries,
+            }
+
+    def _get_many(self, keys):
+        found = {}
+        unique = list(dict.fromkeys(keys))
+        now = time.time()
+        with self._lock, self._conn:
+            for start in range(0, len(unique), _SQL_BATCH):
+                batch = unique[start:start + _SQL_BATCH]
+                marks = ",".join("?" * len(batch))
+                rows = self._conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({marks})", batch
+                ).fetchall()
+                for key, blob in rows:
+                    found[key] = _from_blob(blob)
+                self._conn.execute(
+                    f"UPDATE embeddings SET last_used = ? WHERE key IN ({marks})", [now, *batch]
+                )
+        return found
+
+    def _put_many(self, vectors):
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector, last_used) VALUES (?, ?, ?)",
+                [(key, _to_blob(vector), now) for key, vector in vectors.items()],
+            )
+            count = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+            if count > self.max_entries:
+                self._conn.execute(
+                    "DELETE FROM embeddings WHERE key IN "
+                    "(SELECT key FROM embeddings ORDER BY last_used LIMIT ?)",
+                    (count - self.max_entries,),
+                )
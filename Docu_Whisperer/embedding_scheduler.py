@@ -0,0 +1,229 @@
+# Embeds chunks in token-budgeted batches, several batches at a time, backing off when the gateway rate-limits us.
+import argparse
+import functools
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from langchain_core.embeddings import Embeddings
+
+import metrics
+
+EMBED_BATCH_TOKENS = int(os.environ.get("EMBED_BATCH_TOKENS", "60000"))
+EMBED_BATCH_SIZE = int(os.environ.get("EMBED_BATCH_SIZE", "256"))
+EMBED_MAX_IN_FLIGHT = int(os.environ.get("EMBED_MAX_IN_FLIGHT", "4"))
+EMBED_MAX_RETRIES = int(os.environ.get("EMBED_MAX_RETRIES", "6"))
+
+
+@functools.lru_cache(maxsize=1)
+def _get_encoder():
+    try:
+        import tiktoken
+        return tiktoken.get_encoding("cl100k_base")
+    except Exception:
+        return None
+
+
+def count_tokens(texts, encoder=None):
+    if encoder is None:
+        # Rough but cheap: ~4 characters per token for English text.
+        return [max(1, len(text) // 4) for text in texts]
+    return [len(tokens) for tokens in encoder.encode_batch(texts, disallowed_special=())]
+
+
+def make_batches(token_counts, max_tokens=EMBED_BATCH_TOKENS, max_size=EMBED_BATCH_SIZE):
+    """Group text positions into batches under both the token and the item limit."""
+    batches, batch, batch_tokens = [], [], 0
+    for i, tokens in enumerate(token_counts):
+        if batch and (batch_tokens + tokens > max_tokens or len(batch) >= max_size):
+            batches.append(batch)
+            batch, batch_tokens = [], 0
+        batch.append(i)
+        batch_tokens += tokens
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def rate_limit_delay(error):
+    """Seconds the server asked us to wait if error is a 429, else None."""
+    response = getattr(error, "response", None)
+    status = getattr(error, "status_code", None) or getattr(response, "status_code", None)
+    if status != 429:
+        return None
+    headers = getattr(response, "headers", None) or {}
+    try:
+        return float(headers.get("retry-after", 0))
+    except (TypeError, ValueError):
+        return 0.0
+
+
+class AdaptiveLimiter:
+    """
+    Caps the number of requests in flight. The cap halves on every rate
+    limit and grows back by one after a run of successful requests (AIMD).
+    """
+
+    def __init__(self, max_in_flight, recover_after=8):
+        self.max_in_flight = max_in_flight
+        self.limit = max_in_flight
+        self.recover_after = recover_after
+        self._in_flight = 0
+        self._successes = 0
+        self._cond = threading.Condition()
+
+    def __enter__(self):
+        with self._cond:
+            while self._in_flight >= self.limit:
+                self._cond.wait()
+            self._in_flight += 1
+        return self
+
+    def __exit__(self, *exc):
+        with self._cond:
+            self._in_flight -= 1
+            self._cond.notify_all()
+
+    def on_success(self):
+        with self._cond:
+            self._successes += 1
+            if self._successes >= self.recover_after and self.limit < self.max_in_flight:
+                self.limit += 1
+                self._successes = 0
+                self._cond.notify_all()
+
+    def on_rate_limit(self):
+        with self._cond:
+            self.limit = max(1, self.limit // 2)
+            self._successes = 0
+
+
+class ScheduledEmbeddings(Embeddings):
+    """
+    Wraps an Embeddings object (ideally created with max_retries=0, so 429s
+    reach us) and owns batching, concurrency and retries for it.
+    """
+
+    def __init__(self, embeddings, max_batch_tokens=EMBED_BATCH_TOKENS, max_batch_size=EMBED_BATCH_SIZE,
+                 max_in_flight=EMBED_MAX_IN_FLIGHT, max_retries=EMBED_MAX_RETRIES, base_delay=1.0):
+        self.embeddings = embeddings
+        self.max_batch_tokens = max_batch_tokens
+        self.max_batch_size = max_batch_size
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.limiter = AdaptiveLimiter(max_in_flight)
+        self.encoder = _get_encoder()
+        self.last_run = {}
+        self._stats_lock = threading.Lock()
+
+    def embed_documents(self, texts):
+        vectors, run = self._embed_batches(texts, "embed_documents")
+        if run:
+            self.last_run = run
+        return vectors
+
+    def embed_queries(self, texts):
+        """Batched like embed_documents, but left out of last_run, which describes the last ingest."""
+        return self._embed_batches(texts, "embed_queries")[0]
+
+    def _embed_batches(self, texts, stage):
+        texts = list(texts)
+        if not texts:
+            return [], None
+        started = time.perf_counter()
+        # Per call: the instance is shared by every session and the job worker.
+        retries = {"retries": 0, "rate_limited": 0}
+        token_counts = count_tokens(texts, self.encoder)
+        batches = make_batches(token_counts, self.max_batch_tokens, self.max_batch_size)
+
+        vectors = [None] * len(texts)
+
+        def run(batch):
+            with metrics.span("embed_batch"):
+                result = self._call(self.embeddings.embed_documents, [texts[i] for i in batch], retries)
+            for i, vector in zip(batch, result):
+                vectors[i] = vector
+
+        workers = min(self.limiter.max_in_flight, len(batches))
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            # list() re-raises the first batch that ran out of retries.
+            list(pool.map(run, batches))
+
+        seconds = time.perf_counter() - started
+        tokens = sum(token_counts)
+        metrics.observe("stage_seconds", seconds, stage=stage)
+        metrics.count("embedded_texts", len(texts))
+        metrics.count("embedded_tokens", tokens)
+        return vectors, {
+            "chunks": len(texts),
+            "tokens": tokens,
+            "batches": len(batches),
+            "seconds": seconds,
+            "chunks_per_s": len(texts) / seconds if seconds else 0.0,
+            "tokens_per_s": tokens / seconds if seconds else 0.0,
+            **retries,
+            "in_flight_limit": self.limiter.limit,
+        }
+
+    def embed_query(self, text):
+        with metrics.span("embed_query"):
+            return self._call(self.embeddings.embed_query, text)
+
+    def _call(self, fn, payload, retries=None):
+        for attempt in range(self.max_retries + 1):
+            try:
+                with self.limiter:
+                    result = fn(payload)
+                self.limiter.on_success()
+                return result
+            except Exception as e:
+                if attempt == self.max_retries:
+                    raise
+                delay = rate_limit_delay(e)
+                if retries is not None:
+                    with self._stats_lock:
+                        retries["retries"] += 1
+                        if delay is not None:
+                            retries["rate_limited"] += 1
+                metrics.count("embed_retries", reason="rate_limited" if delay is not None else "error")
+                if delay is not None:
+                    self.limiter.on_rate_limit()
+                # Exponential backoff, unless the server asked for longer.
+                time.sleep(max(delay or 0.0, self.base_delay * (2 ** attempt)))
+
+
+def main():
+    """Measure embedding throughput against a local fake endpoint (or --base-url)."""
+    from langchain_openai import OpenAIEmbeddings
+    from fake_openai import start_server
+
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument("--base-url", help="OpenAI-compatible base URL; starts fake_openai locally if omitted")
+    parser.add_argument("--chunks", type=int, default=2000)
+    parser.add_argument("--batch-size", type=int, default=EMBED_BATCH_SIZE)
+    parser.add_argument("--in-flight", type=int, default=EMBED_MAX_IN_FLIGHT)
+    parser.add_argument("--latency", type=float, default=0.05, help="fake server latency per request (s)")
+    parser.add_argument("--max-rps", type=float, default=0, help="fake server requests/s before it answers 429")
+    args = parser.parse_args()
+
+    server = None
+    base_url = args.base_url
+    if not base_url:
+        server = start_server(latency=args.latency, max_rps=args.max_rps)
+        base_url = f"http://127.0.0.1:{server.server_port}/v1"
+
+    texts = [f"Synthetic policy chunk {i}. " + "Controls must be reviewed annually. " * 20 for i in range(args.chunks)]
+    client = OpenAIEmbeddings(model="text-embedding-ada-002_v2", openai_api_base=base_url,
+                              api_key=os.environ.get("OPENAI_API_KEY", "fake"), max_retries=0,
+                              check_embedding_ctx_length=False)
+    scheduled = ScheduledEmbeddings(client, max_batch_size=args.batch_size, max_in_flight=args.in_flight, base_delay=0.1)
+    scheduled.embed_documents(texts)
+    for key, value in scheduled.last_run.items():
+        print(f"{key:>16}: {value:.2f}" if isinstance(value, float) else f"{key:>16}: {value}")
+    if server:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
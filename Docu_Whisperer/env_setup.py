@@ -3,16 +3,27 @@ import os
 import sys
 import subprocess
 
+API_BASE_URL = os.environ.get("OPENAI_API_BASE", "https://api.studio.genai")
+EMBEDDING_MODEL = "text-embedding-ada-002_v2"
+CHAT_MODEL = "gpt-4o_v2024-11-20_USEAST"
+LINUX_CA_BUNDLE = "/etc/ssl/certs/ca-certificates.crt"
+
 def setup_environment():
+    """
+    Exports the system CA certificates and points the OpenAI/requests
+    clients at them. Shells out on macOS and Windows, so call it once per
+    process (DocQuery caches it with st.cache_resource).
+    """
     ca_bundle_path = os.path.expanduser("~/ca_bundle.pem")
 
     if sys.platform == "darwin":
-        subprocess.run([
-            "security", "find-certificate", "-a", "-p",
-            "/Library/Keychains/System.keychain",
-            "/System/Library/Keychains/SystemRootCertificates.keychain",
-            os.path.expanduser("~/Library/Keychains/login.keychain-db")
-        ], stdout=open(ca_bundle_path, "w"))
+        with open(ca_bundle_path, "w") as f:
+            subprocess.run([
+                "security", "find-certificate", "-a", "-p",
+                "/Library/Keychains/System.keychain",
+                "/System/Library/Keychains/SystemRootCertificates.keychain",
+                os.path.expanduser("~/Library/Keychains/login.keychain-db")
+            ], stdout=f)
     elif sys.platform == "win32":
         subprocess.run([
             "powershell", "-Command",
@@ -21,9 +32,15 @@ def setup_environment():
             "ForEach-Object { $_.Export([System.Security.Cryptography.X509Certificates.X509ContentType]::Cert) } | "
             f"Set-Content -Encoding ascii -Path {ca_bundle_path}"
         ])
+    elif os.path.exists(LINUX_CA_BUNDLE):
+        # The system bundle can be used in place, no need to copy it.
+        ca_bundle_path = LINUX_CA_BUNDLE
 
-    os.environ["OPENAI_BASE_URL"] = "https://api.studio.genai"
-    os.environ["NO_PROXY"] = os.environ.get("NO_PROXY", "") + ("," if os.environ.get("NO_PROXY"))
+    os.environ["OPENAI_BASE_URL"] = API_BASE_URL
+    os.environ["TIKTOKEN_CACHE_DIR"] = os.environ.get("TIKTOKEN_CACHE_DIR", "/tmp/tiktoken_cache")
+    no_proxy = [host for host in os.environ.get("NO_PROXY", "").split(",") if host]
+    if "api.studio.genai" not in no_proxy:
+        os.environ["NO_PROXY"] = ",".join(no_proxy + ["api.studio.genai"])
 
     if os.path.exists(ca_bundle_path):
         os.environ["REQUESTS_CA_BUNDLE"] = ca_bundle_path
@@ -34,3 +51,25 @@ def get_api_key():
     if not api_key:
         raise ValueError("Please set the OPENAI_API_KEY environment variable when running the Docker container.")
     return api_key
+
+def make_embeddings(api_key=None, base_url=API_BASE_URL):
+    """The embeddings used for indexing and queries: cached on disk, batched and rate-limit aware."""
+    from langchain_openai import OpenAIEmbeddings
+    from embedding_cache import CachedEmbeddings
+    from embedding_scheduler import ScheduledEmbeddings
+
+    # Retries are left to ScheduledEmbeddings, which adapts its concurrency to 429s.
+    embeddings = OpenAIEmbeddings(model=EMBEDDING_MODEL, openai_api_base=base_url,
+                                  api_key=api_key or get_api_key(), max_retries=0)
+    return CachedEmbeddings(ScheduledEmbeddings(embeddings), EMBEDDING_MODEL)
+
+def make_llm(api_key=None, base_url=API_BASE_URL):
+    from langchain_openai import ChatOpenAI
+
+    return ChatOpenAI(
+        model_name=CHAT_MODEL,
+        openai_api_base=base_url,
+        api_key=api_key or get_api_key(),
+        temperature=0.7,
+        streaming=True
+    )
@@ -0,0 +1,181 @@
+# Local stand-in for the GenAI Studio OpenAI-compatible API, for measuring throughput without the real service.
+import argparse
+import base64
+import hashlib
+import json
+import threading
+import time
+from array import array
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+FAKE_DIMENSIONS = 1536
+
+
+def fake_vector(text, dimensions=FAKE_DIMENSIONS):
+    """Deterministic unit vector for a text (or token list)."""
+    if not isinstance(text, str):
+        text = json.dumps(text)
+    seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "big")
+    vector = np.random.default_rng(seed).random(dimensions) - 0.5
+    return (vector / np.linalg.norm(vector)).tolist()
+
+
+class FakeEmbeddings(Embeddings):
+    """In-process deterministic embeddings, no HTTP involved."""
+
+    def __init__(self, dimensions=FAKE_DIMENSIONS):
+        self.dimensions = dimensions
+
+    def embed_documents(self, texts):
+        return [fake_vector(text, self.dimensions) for text in texts]
+
+    def embed_query(self, text):
+        return fake_vector(text, self.dimensions)
+
+
+class FakeChatModel(BaseChatModel):
+    """
+    In-process deterministic chat model: streams back the first words of the
+    last message, optionally token_latency seconds apart, no HTTP involved.
+    """
+
+    words: int = 80
+    token_latency: float = 0.0
+
+    @property
+    def _llm_type(self):
+        return "fake-chat"
+
+    def _pieces(self, messages):
+        words = str(messages[-1].content).split()[:self.words] if messages else []
+        return [word + " " for word in words] or ["(empty)"]
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        message = AIMessage(content="".join(self._pieces(messages)))
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        for piece in self._pieces(messages):
+            if self.token_latency:
+                time.sleep(self.token_latency)
+            yield ChatGenerationChunk(message=AIMessageChunk(content=piece))
+
+
+class _RateLimiter:
+    # Token bucket: max_rps requests per second, bursts up to max_rps.
+    def __init__(self, max_rps):
+        self.max_rps = max_rps
+        self.tokens = max_rps
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def allow(self):
+        if not self.max_rps:
+            return True
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.max_rps, self.tokens + (now - self.updated) * self.max_rps)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            return False
+
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    server_version = "FakeOpenAI/1.0"
+
+    def log_message(self, *args):
+        pass
+
+    def _send_json(self, status, payload, headers=None):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        request = json.loads(self.rfile.read(length) or b"{}")
+        with self.server.stats_lock:
+            self.server.stats["requests"] += 1
+            rejected = self.server.stats["requests"] <= self.server.reject_first
+        if rejected or not self.server.limiter.allow():
+            with self.server.stats_lock:
+                self.server.stats["rate_limited"] += 1
+            self._send_json(429, {"error": {"message": "Rate limit exceeded", "type": "rate_limit"}},
+                            {"retry-after": "0.1"})
+            return
+        time.sleep(self.server.latency)
+        if self.path.rstrip("/").endswith("/embeddings"):
+            self._embeddings(request)
+        else:
+            self._send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+
+    def _embeddings(self, request):
+        inputs = request.get("input", [])
+        if isinstance(inputs, str) or (inputs and isinstance(inputs[0], int)):
+            inputs = [inputs]
+        dimensions = request.get("dimensions") or self.server.dimensions
+        tokens = sum(len(item) if isinstance(item, list) else max(1, len(item) // 4) for item in inputs)
+        with self.server.stats_lock:
+            self.server.stats["inputs"] += len(inputs)
+        vectors = [fake_vector(item, dimensions) for item in inputs]
+        if request.get("encoding_format") == "base64":
+            # What the openai client asks for by default; much cheaper than JSON floats.
+            vectors = [base64.b64encode(array("f", vector).tobytes()).decode("ascii") for vector in vectors]
+        self._send_json(200, {
+            "object": "list",
+            "data": [
+                {"object": "embedding", "index": i, "embedding": vector}
+                for i, vector in enumerate(vectors)
+            ],
+            "model": request.get("model", "fake"),
+            "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+        })
+
+
+def start_server(port=0, latency=0.0, max_rps=0, dimensions=FAKE_DIMENSIONS, reject_first=0):
+    """
+    Start the fake API on a daemon thread; port 0 picks a free port (see
+    server.server_port). The first reject_first requests are answered 429.
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", port), FakeOpenAIHandler)
+    server.daemon_threads = True
+    server.latency = latency
+    server.limiter = _RateLimiter(max_rps)
+    server.dimensions = dimensions
+    server.reject_first = reject_first
+    server.stats = {"requests": 0, "rate_limited": 0, "inputs": 0}
+    server.stats_lock = threading.Lock()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve a fake OpenAI-compatible API on localhost.")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds added to every request")
+    parser.add_argument("--max-rps", type=float, default=0, help="requests/s before answering 429 (0 = unlimited)")
+    args = parser.parse_args()
+    server = start_server(args.port, args.latency, args.max_rps)
+    print(f"Fake OpenAI API on http://127.0.0.1:{server.server_port}/v1")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,246 @@
+# Main-content extraction for web pages with lxml: drops scripts, menus, banners and footers, keeps the heading structure.
+import re
+
+import lxml.html
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+from lxml import etree
+
+CHUNK_SIZE = 1000
+CHUNK_OVERLAP = 200
+
+# Never content, wherever they are.
+_DROP_TAGS = ["script", "style", "noscript", "template", "svg", "canvas", "iframe", "object", "embed",
+              "button", "input", "select", "textarea", "dialog", "nav", "menu"]
+# Site chrome at page level; inside an article they hold its title, byline or a callout.
+_CHROME_TAGS = {"header", "footer", "aside"}
+_CHROME_ROLES = {"navigation", "banner", "contentinfo", "complementary", "search", "dialog", "alertdialog",
+                 "menu", "menubar", "toolbar"}
+_BOILERPLATE_RE = re.compile(
+    r"(?:^|[\s_-])(?:nav|navbar|navigation|menu|breadcrumbs?|sidebar|footer|header|masthead|cookies?|consent|gdpr"
+    r"|banner|social|share|sharing|related|recommended|comments?|advert\w*|ads?|sponsor\w*|promo\w*|newsletter"
+    r"|subscribe|signup|popup|modal|skip-link|toolbar|pagination|pager)(?:$|[\s_-])", re.I
+)
+# The class/id patterns only judge containers: a heading's <a class="header"> is still its text.
+_CONTAINER_TAGS = {"div", "section", "aside", "header", "footer", "ul", "ol", "table", "form"}
+_CONTENT_RE = re.compile(r"(?:^|[\s_-])(?:article|content|main|post|entry|story|prose)(?:$|[\s_-])", re.I)
+_HIDDEN_STYLE_RE = re.compile(r"display\s*:\s*none|visibility\s*:\s*hidden", re.I)
+_HEADINGS = {"h1": 1, "h2": 2, "h3": 3, "h4": 4, "h5": 5, "h6": 6}
+_BLOCK_TAGS = {"address", "article", "blockquote", "br", "caption", "dd", "details", "div", "dl", "dt", "fieldset",
+               "figcaption", "figure", "footer", "form", "header", "hr", "li", "main", "ol", "p", "section",
+               "summary", "table", "tbody", "tfoot", "thead", "tr", "ul", "aside"}
+_CELL_TAGS = {"td", "th"}
+# Text blocks that count towards a region's score when no <main> or <article> marks the content.
+_SCORED_TAGS = ("p", "pre", "blockquote", "li", "td", "dd")
+# A landmark holding less than this share of the page's text is a teaser, not the content.
+_MIN_MAIN_SHARE = 0.25
+
+
+def parse_html(html):
+    """The page as an lxml tree, or None if there is nothing to parse."""
+    if not html or not html.strip():
+        return None
+    try:
+        return lxml.html.document_fromstring(html)
+    except ValueError:
+        # lxml refuses str input that still carries an XML encoding declaration.
+        return lxml.html.document_fromstring(html.encode("utf-8"))
+    except etree.ParserError:
+        return None
+
+
+def _text_length(element):
+    return len(" ".join(element.text_content().split()))
+
+
+def _contains_landmark(element):
+    return bool(element.xpath(".//main|.//article|.//*[@role='main']"))
+
+
+def _drop(element):
+    # drop_tree keeps the tail text, which belongs to the parent.
+    if element.getparent() is not None:
+        element.drop_tree()
+
+
+def _is_boilerplate(element, in_content):
+    hidden = (element.get("hidden") is not None or element.get("aria-hidden") == "true"
+              or _HIDDEN_STYLE_RE.search(element.get("style") or ""))
+    chrome = element.tag in _CHROME_TAGS and not in_content or element.get("role") in _CHROME_ROLES
+    labels = f"{element.get('class') or ''} {element.get('id') or ''}"
+    boilerplate = (element.tag in _CONTAINER_TAGS and _BOILERPLATE_RE.search(labels)
+                   and not _CONTENT_RE.search(labels))
+    return (hidden or chrome or boilerplate) and not _contains_landmark(element)
+
+
+def strip_boilerplate(root):
+    """Removes scripts, hidden elements, navigation, banners, sidebars and footers from root in place."""
+    for element in list(root.iter(etree.Comment, etree.ProcessingInstruction, *_DROP_TAGS)):
+        _drop(element)
+    # Top down, so nothing inside a dropped element is looked at.
+    pending = [(root, False)]
+    while pending:
+        element, in_content = pending.pop()
+        for child in list(element):
+            if _is_boilerplate(child, in_content):
+                _drop(child)
+            else:
+                pending.append((child, in_content or child.tag in ("article", "main")))
+
+
+def _link_density(element, length):
+    links = sum(_text_length(link) for link in element.iter("a"))
+    return links / length if length else 1.0
+
+
+def main_region(body):
+    """
+    The element holding the page's content: its <main> (or role=main), the
+    largest <article>, or else the block that collects the most paragraph
+    text with the fewest links, much like Readability does.
+    """
+    total = _text_length(body)
+    for xpath in ("//main", "//*[@role='main']", "//article"):
+        candidates = body.xpath(xpath)
+        if candidates:
+            best = max(candidates, key=_text_length)
+            if _text_length(best) >= _MIN_MAIN_SHARE * total:
+                return best
+
+    scores = {}
+    for block in body.iter(*_SCORED_TAGS):
+        length = _text_length(block)
+        if length < 25:
+            continue
+        score = 1 + block.text_content().count(",") + min(length / 100, 3)
+        parent = block.getparent()
+        for ancestor, share in ((parent, 1.0), (parent.getparent() if parent is not None else None, 0.5)):
+            if ancestor is not None:
+                scores[ancestor] = scores.get(ancestor, 0.0) + score * share
+    if not scores:
+        return body
+    # Link density only for the front runners: it walks the whole subtree.
+    leaders = sorted(scores, key=scores.get, reverse=True)[:5]
+    best = max(leaders, key=lambda element: scores[element] * (1 - _link_density(element, _text_length(element))))
+    return best if _text_length(best) >= _MIN_MAIN_SHARE * total else body
+
+
+class _SectionWriter:
+    """Collects text lines under the heading path they appear beneath."""
+
+    def __init__(self):
+        self.sections = []
+        self.path = []  # [(level, heading text)]
+        self.lines = []
+        self.line = []
+
+    def text(self, text):
+        self.line.append(text)
+
+    def end_line(self):
+        line = " ".join("".join(self.line).split()).strip(" |")
+        if line:
+            self.lines.append(line)
+        self.line = []
+
+    def end_section(self):
+        self.end_line()
+        if self.lines:
+            self.sections.append(([heading for _, heading in self.path], "\n".join(self.lines)))
+        self.lines = []
+
+    def heading(self, level, text):
+        self.end_section()
+        text = " ".join(text.split())
+        if text:
+            self.path = [(lvl, heading) for lvl, heading in self.path if lvl < level] + [(level, text)]
+
+    def walk(self, element):
+        tag = element.tag if isinstance(element.tag, str) else None
+        if tag in _HEADINGS:
+            self.heading(_HEADINGS[tag], element.text_content())
+            return
+        if tag == "pre":
+            self.end_line()
+            self.lines.append(element.text_content().strip("\n"))
+            return
+        block = tag in _BLOCK_TAGS
+        if block:
+            self.end_line()
+        if tag == "li":
+            self.text("- ")
+        if element.text:
+            self.text(element.text)
+        for child in element:
+            self.walk(child)
+            if child.tail:
+                self.text(child.tail)
+        if tag in _CELL_TAGS:
+            self.text(" | ")
+        if block:
+            self.end_line()
+
+
+def page_title(root):
+    for xpath in ("//meta[@property='og:title']/@content", "//title//text()", "(//h1)[1]//text()"):
+        title = " ".join(" ".join(root.xpath(xpath)).split())
+        if title:
+            return title
+    return ""
+
+
+def extract_sections(html):
+    """(title, [(heading path, text)]) of the page's main content, in reading order."""
+    root = parse_html(html)
+    if root is None:
+        return "", []
+    title = page_title(root)
+    body = root.find("body")
+    if body is None:
+        body = root
+    strip_boilerplate(body)
+    writer = _SectionWriter()
+    region = main_region(body)
+    # A page <h1> just above the main region still names its sections.
+    for heading in region.xpath("preceding::h1[1]"):
+        writer.heading(1, heading.text_content())
+    writer.walk(region)
+    writer.end_section()
+    return title, writer.sections
+
+
+def section_chunks(title, sections, chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP):
+    """
+    (text, heading path) chunks that start at headings: consecutive short
+    sections are packed together under the first one's path, and long ones
+    split with overlap. Every chunk begins with its heading path (or the
+    page title when the page has no headings).
+    """
+    splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+    chunks = []
+    packed, packed_path = "", None
+    for path, text in sections:
+        label = " > ".join(path) or title
+        if packed and len(packed) + len(text) + len(path[-1] if path else "") + 3 <= chunk_size:
+            packed += "\n\n" + (f"{path[-1]}\n" if path and path != packed_path else "") + text
+            continue
+        if packed:
+            chunks.append((packed, " > ".join(packed_path or [])))
+        if len(label) + len(text) + 1 <= chunk_size:
+            packed, packed_path = (f"{label}\n{text}" if label else text), path
+            continue
+        packed, packed_path = "", None
+        for piece in splitter.split_text(text):
+            chunks.append((f"{label}\n{piece}" if label else piece, " > ".join(path)))
+    if packed:
+        chunks.append((packed, " > ".join(packed_path or [])))
+    return chunks
+
+
+def visible_text(html):
+    """The page's text without scripts, styles and templates: what a reader sees before any JavaScript runs."""
+    root = parse_html(html)
+    if root is None:
+        return ""
+    for element in root.iter("script", "style", "noscript", "template"):
+        _drop(element)
+    return " ".join(root.text_content().split())
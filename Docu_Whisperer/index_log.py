@@ -0,0 +1,694 @@
+# Append-only index storage: vectors appended as segment files, versions published atomically, compaction in the background.
+import argparse
+import contextlib
+import functools
+import json
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+import faiss
+import numpy as np
+from langchain_community.vectorstores import FAISS
+from langchain_core.documents import Document
+
+import metrics
+from ann_index import ANN_INDEX_FILE, ANN_META_FILE, MMAP_FLAGS, read_ann_index, sync_ann_index, synthetic_vectors
+from chunk_store import CHUNK_STORE_FILE, ChunkStore
+from lexical_index import LEXICAL_INDEX_FILE, sync_lexical_index
+from vector_codec import CODEC_FILE, new_storage, read_codec, train_codec, wanted_codec
+
+# Compaction merges the segments into a new base once there are more than INDEX_MAX_SEGMENTS of them,
+# or once they, or the deleted vectors still in the files, make up more than INDEX_COMPACT_SHARE of the index.
+INDEX_MAX_SEGMENTS = int(os.environ.get("INDEX_MAX_SEGMENTS", "8"))
+INDEX_COMPACT_SHARE = float(os.environ.get("INDEX_COMPACT_SHARE", "0.25"))
+# Files only versions replaced longer ago than this use are deleted; readers load a version well within it.
+INDEX_FILE_GRACE = float(os.environ.get("INDEX_FILE_GRACE", "300"))
+# How long an update waits for the one before it (a crawl can hold the index for a while).
+INDEX_LOCK_TIMEOUT = float(os.environ.get("INDEX_LOCK_TIMEOUT", "3600"))
+# Threads a query fans out over, each searching a group of indexes; FAISS releases the GIL while it searches.
+FAISS_SEARCH_THREADS = int(os.environ.get("FAISS_SEARCH_THREADS", "0")) or os.cpu_count() or 1
+
+LOCK_FILE = "writer.lock"
+SEGMENTS_DIR = "segments"
+BASE_PREFIX = "base-"
+SHARDS_DIR = "shards"
+# What an index saved before versions existed keeps in its directory.
+LEGACY_FILES = ["index.faiss", ANN_INDEX_FILE, ANN_META_FILE, LEXICAL_INDEX_FILE]
+LEGACY_MANIFEST_FILE = "manifest.json"
+
+_locks = {}
+_locks_guard = threading.Lock()
+_compactions = {}
+_compactions_guard = threading.Lock()
+
+
+if sys.platform == "win32":
+    import msvcrt
+
+    def _try_lock_file(fd):
+        # Locks the first byte, which may lie past the end of the (empty) file.
+        os.lseek(fd, 0, os.SEEK_SET)
+        try:
+            msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+            return True
+        except OSError:
+            return False
+
+    def _unlock_file(fd):
+        os.lseek(fd, 0, os.SEEK_SET)
+        msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+else:
+    import fcntl
+
+    def _try_lock_file(fd):
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except BlockingIOError:
+            return False
+
+    def _unlock_file(fd):
+        fcntl.flock(fd, fcntl.LOCK_UN)
+
+
+def _lock_dir(index_path):
+    # The shards of a sharded index (see sharded_index.py) are all guarded by its lock.
+    parent = os.path.dirname(os.path.abspath(index_path))
+    return os.path.dirname(parent) if os.path.basename(parent) == SHARDS_DIR else index_path
+
+
+@contextlib.contextmanager
+def writer_lock(index_path, timeout=INDEX_LOCK_TIMEOUT):
+    """
+    Held from opening an index for an update until it is saved, and while
+    compacting, so updates take turns instead of overwriting each other:
+    threads wait on a lock, other processes on a lock of writer.lock
+    (flock, or msvcrt.locking on Windows).
+    Re-entrant within a thread. Raises TimeoutError after timeout seconds.
+    """
+    path = os.path.realpath(_lock_dir(index_path))
+    os.makedirs(path, exist_ok=True)
+    with _locks_guard:
+        state = _locks.setdefault(path, {"lock": threading.Lock(), "owner": None, "depth": 0, "fd": None})
+    if state["owner"] != threading.get_ident():
+        deadline = time.monotonic() + timeout
+        with metrics.span("writer_lock_wait"):
+            if not state["lock"].acquire(timeout=timeout):
+                raise TimeoutError(f"{index_path} is still being updated by another thread")
+            fd = os.open(os.path.join(path, LOCK_FILE), os.O_RDWR | os.O_CREAT, 0o644)
+            while not _try_lock_file(fd):
+                if time.monotonic() > deadline:
+                    os.close(fd)
+                    state["lock"].release()
+                    raise TimeoutError(f"{index_path} is still being updated by another process")
+                time.sleep(0.2)
+        state.update(owner=threading.get_ident(), fd=fd)
+    state["depth"] += 1
+    try:
+        yield
+    finally:
+        state["depth"] -= 1
+        if state["depth"] == 0:
+            _unlock_file(state["fd"])
+            os.close(state["fd"])
+            state.update(owner=None, fd=None)
+            state["lock"].release()
+
+
+def _fsync(path):
+    if sys.platform == "win32":
+        if os.path.isdir(path):
+            # Windows can't open a directory to sync it; NTFS journals the rename itself.
+            return
+        # Windows only flushes files opened for writing.
+        fd = os.open(path, os.O_RDWR)
+    else:
+        fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _write_index(index, path):
+    """Writes index to path, on disk for good before anything can publish it."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + ".tmp"
+    faiss.write_index(index, tmp_path)
+    _fsync(tmp_path)
+    os.replace(tmp_path, path)
+    _fsync(os.path.dirname(path))
+
+
+def published_version(index_path):
+    """The number of the latest version published in index_path, or None (nothing yet, or the legacy layout)."""
+    path = os.path.join(index_path, CHUNK_STORE_FILE)
+    if not os.path.exists(path):
+        return None
+    try:
+        conn = sqlite3.connect(path, timeout=60)
+        try:
+            return conn.execute("SELECT MAX(version) FROM versions").fetchone()[0]
+        finally:
+            conn.close()
+    except sqlite3.Error:
+        return None
+
+
+def published_sources(index_path):
+    """The manifest sources of the latest version published in index_path, or None if none is."""
+    if published_version(index_path) is None:
+        return None
+    store = ChunkStore(os.path.join(index_path, CHUNK_STORE_FILE))
+    try:
+        return store.sources()
+    finally:
+        store.close()
+
+
+@functools.lru_cache(maxsize=1)
+def _search_pool():
+    return ThreadPoolExecutor(FAISS_SEARCH_THREADS, thread_name_prefix="index-search")
+
+
+def _balanced_groups(sizes, count):
+    """Index numbers split into count groups of about the same number of vectors."""
+    groups = [[] for _ in range(count)]
+    totals = [0] * count
+    for part in sorted(range(len(sizes)), key=lambda part: -sizes[part]):
+        lightest = totals.index(min(totals))
+        groups[lightest].append(part)
+        totals[lightest] += sizes[part]
+    return [group for group in groups if group]
+
+
+class MultiIndex:
+    """
+    Several FAISS indexes behind the part of the FAISS index interface the
+    query path uses (the shards of a sharded index, or the base and
+    segments of one version). Positions run on from one index to the
+    next. A search fans out over threads, each searching a group of
+    indexes, and merges their top k by distance. Positions that live
+    marks False (deleted, awaiting compaction) are never returned; each
+    index is asked for as many extra results as it has of them.
+    """
+
+    def __init__(self, indexes, flat_indexes, threads=FAISS_SEARCH_THREADS, live=None):
+        self.indexes = indexes
+        # Context packing reads stored vectors back from these; ANN indexes can't all do that.
+        self.flat_indexes = flat_indexes
+        self.offsets = np.cumsum([0] + [index.ntotal for index in indexes])
+        self.ntotal = int(self.offsets[-1])
+        self.d = indexes[0].d
+        self.live = live
+        self.dead = [0 if live is None else int(end - start - live[start:end].sum())
+                     for start, end in zip(self.offsets, self.offsets[1:])]
+        self.groups = _balanced_groups([index.ntotal for index in indexes], max(1, min(threads, len(indexes))))
+
+    def _search_group(self, parts, queries, k):
+        distances, labels = [], []
+        for part in parts:
+            found_distances, found = self.indexes[part].search(queries, k + self.dead[part])
+            found = np.where(found >= 0, found + self.offsets[part], -1)
+            if self.dead[part]:
+                found = np.where(self.live[np.maximum(found, 0)], found, -1)
+            distances.append(np.where(found >= 0, found_distances, np.inf))
+            labels.append(found)
+        return np.hstack(distances), np.hstack(labels)
+
+    def search(self, queries, k):
+        queries = np.ascontiguousarray(queries, dtype=np.float32)
+        if len(self.groups) == 1:
+            parts = [self._search_group(self.groups[0], queries, k)]
+        else:
+            parts = list(_search_pool().map(lambda group: self._search_group(group, queries, k), self.groups))
+        distances = np.hstack([part[0] for part in parts])
+        labels = np.hstack([part[1] for part in parts])
+        order = np.argsort(distances, axis=1, kind="stable")[:, :k]
+        return np.take_along_axis(distances, order, axis=1), np.take_along_axis(labels, order, axis=1)
+
+    def reconstruct_batch(self, keys):
+        keys = np.asarray(keys, dtype=np.int64)
+        parts = np.searchsorted(self.offsets, keys, side="right") - 1
+        vectors = np.empty((len(keys), self.d), dtype=np.float32)
+        for part in np.unique(parts):
+            mask = parts == part
+            vectors[mask] = self.flat_indexes[part].reconstruct_batch(keys[mask] - self.offsets[part])
+        return vectors
+
+
+def _kinds(index):
+    parts = getattr(index, "indexes", None)
+    return {type(index).__name__} if parts is None else set().union(*(_kinds(part) for part in parts))
+
+
+def index_kind(index):
+    """The FAISS index type behind index; for a MultiIndex, those of its parts (e.g. "IndexFlatL2, IndexHNSWFlat")."""
+    return ", ".join(sorted(_kinds(index)))
+
+
+def load_published(embeddings, index_path, mmap=False, search=False):
+    """
+    The latest version published in index_path as a read-only FAISS store,
+    or None if there is none or it holds no vectors. search=True searches
+    the base's IVF/HNSW/PQ index when compaction built one. The store keeps
+    working after later versions are published.
+    """
+    if published_version(index_path) is None:
+        return None
+    store = ChunkStore(os.path.join(index_path, CHUNK_STORE_FILE))
+    snapshot = store.snapshot()
+    if snapshot is None or not snapshot[2]:
+        store.close()
+        return None
+    number, data, positions = snapshot
+    flags = MMAP_FLAGS if mmap else 0
+    indexes, flat_indexes, base_path = [], [], None
+    if data["base"] and data["base"]["count"]:
+        base_path = os.path.join(index_path, data["base"]["dir"])
+        flat = faiss.read_index(os.path.join(base_path, "index.faiss"), flags)
+        ann = read_ann_index(base_path, flat, mmap) if search else None
+        indexes.append(ann or flat)
+        flat_indexes.append(flat)
+    elif data["base"]:
+        base_path = os.path.join(index_path, data["base"]["dir"])
+    for segment in data["segments"]:
+        index = faiss.read_index(os.path.join(index_path, SEGMENTS_DIR, segment["file"]), flags)
+        indexes.append(index)
+        flat_indexes.append(index)
+    live = None
+    if len(positions) < data["ntotal"]:
+        live = np.zeros(data["ntotal"], dtype=bool)
+        live[np.fromiter(positions, dtype=np.int64, count=len(positions))] = True
+    # Segments are small next to the base; one thread searches them all, and shards fan out on their own.
+    index = MultiIndex(indexes, flat_indexes, threads=1, live=live)
+    vector_store = FAISS(embeddings, index, store, positions)
+    vector_store.flat_index = index
+    vector_store.version = {"number": number, **data, "live": len(positions)}
+    # Where the lexical index of the base is; what was added since is tokenized on load.
+    vector_store.base_path = base_path
+    return vector_store
+
+
+def compaction_due(data, live):
+    if not data["ntotal"]:
+        return False
+    in_segments = sum(segment["count"] for segment in data["segments"])
+    dead = data["ntotal"] - live
+    return (len(data["segments"]) > INDEX_MAX_SEGMENTS
+            or in_segments > INDEX_COMPACT_SHARE * data["ntotal"]
+            or dead > INDEX_COMPACT_SHARE * data["ntotal"])
+
+
+class IndexWriter:
+    """
+    Adds to and deletes from the latest published version of an index
+    directory without reading its vectors: new vectors wait in memory
+    until publish() writes them as one segment file, and deletes and
+    renames only change positions. Offers the parts of the langchain FAISS
+    store that index_manager's update functions use. Open it, and publish,
+    with writer_lock held.
+    """
+
+    def __init__(self, embeddings, index_path):
+        self.embeddings = embeddings
+        self.index_path = index_path
+        os.makedirs(index_path, exist_ok=True)
+        self.docstore = ChunkStore(os.path.join(index_path, CHUNK_STORE_FILE))
+        if self.docstore.latest_version() == 0 and os.path.exists(os.path.join(index_path, LEGACY_FILES[0])):
+            migrate_legacy(index_path, self.docstore)
+        snapshot = self.docstore.snapshot()
+        number, data, positions = snapshot if snapshot else (0, None, {})
+        self._reset(number, data or {"base": None, "segments": [], "ntotal": 0, "dim": None}, positions)
+        self._published_sources = {key: json.dumps(entry, sort_keys=True)
+                                   for key, entry in self.docstore.sources().items()}
+
+    def _reset(self, number, data, positions):
+        self.number = number
+        self.data = data
+        self.index_to_docstore_id = positions
+        self.ntotal = data["ntotal"]
+        self.d = data["dim"]
+        self._pending = []
+        self._added, self._deleted, self._renamed = {}, set(), {}
+        self._replace_positions = False
+        self._position_of = None
+        self._codec = None
+
+    def clear(self, dimension):
+        """Starts over empty: the next publish replaces everything published before."""
+        self.docstore.clear()
+        self._reset(self.number, {"base": None, "segments": [], "ntotal": 0, "dim": dimension}, {})
+        self._replace_positions = True
+        self._published_sources = {}
+
+    def _positions(self):
+        if self._position_of is None:
+            self._position_of = {doc_id: position for position, doc_id in self.index_to_docstore_id.items()}
+        return self._position_of
+
+    def add_embeddings(self, text_embeddings, metadatas=None, ids=None, **kwargs):
+        texts, vectors = zip(*text_embeddings)
+        vectors = np.asarray(vectors, dtype=np.float32)
+        metadatas = metadatas or [{} for _ in texts]
+        self.docstore.add({doc_id: Document(id=doc_id, page_content=text, metadata=metadata)
+                           for doc_id, text, metadata in zip(ids, texts, metadatas)})
+        for offset, doc_id in enumerate(ids):
+            position = self.ntotal + offset
+            self.index_to_docstore_id[position] = doc_id
+            self._added[position] = doc_id
+            if self._position_of is not None:
+                self._position_of[doc_id] = position
+        self.d = self.d or vectors.shape[1]
+        self._pending.append(vectors)
+        self.ntotal += len(ids)
+        return list(ids)
+
+    def delete(self, ids):
+        position_of = self._positions()
+        for doc_id in ids:
+            position = position_of.pop(doc_id, None)
+            if position is None:
+                continue
+            del self.index_to_docstore_id[position]
+            if self._added.pop(position, None) is None:
+                self._deleted.add(position)
+                self._renamed.pop(position, None)
+        self.docstore.delete(ids)
+        return True
+
+    def rename(self, position, doc_id):
+        """Gives the vector at position to chunk doc_id (see ChunkStore.promote)."""
+        position_of = self._positions()
+        position_of.pop(self.index_to_docstore_id[position], None)
+        position_of[doc_id] = position
+        self.index_to_docstore_id[position] = doc_id
+        if position in self._added:
+            self._added[position] = doc_id
+        else:
+            self._renamed[position] = doc_id
+
+    def _storage(self):
+        # New vectors are stored like the base's, with the codec trained for it.
+        if self._codec is None and self.data.get("codec"):
+            self._codec = read_codec(os.path.join(self.index_path, self.data["base"]["dir"]))
+        return new_storage(self._codec, self.d)
+
+    def record_sources(self, manifest):
+        """
+        Saves the entries of manifest's sources that changed, without
+        publishing a version, so readers keep the index they loaded. Only
+        for changes no search depends on, with nothing added, deleted or
+        renamed here.
+        """
+        with writer_lock(self.index_path):
+            current = {key: json.dumps(entry, sort_keys=True) for key, entry in manifest["sources"].items()}
+            changed = {key: manifest["sources"][key] for key, dumped in current.items()
+                       if key in self._published_sources and self._published_sources[key] != dumped}
+            self.docstore.update_sources(changed)
+            self._published_sources.update((key, current[key]) for key in changed)
+
+    def publish(self, manifest=None):
+        """
+        Makes what was added, deleted and renamed here, and manifest's
+        sources when given, the latest version in one SQLite commit. Only
+        the new vectors are written, as one segment file. Starts a
+        compaction in the background when one is due.
+        """
+        with writer_lock(self.index_path):
+            if self.docstore.latest_version() != self.number:
+                raise RuntimeError(f"{self.index_path} was changed by another writer since it was opened here")
+            sources, removed = {}, []
+            if manifest is not None:
+                current = {key: json.dumps(entry, sort_keys=True) for key, entry in manifest["sources"].items()}
+                sources = {key: manifest["sources"][key] for key, dumped in current.items()
+                           if self._published_sources.get(key) != dumped}
+                removed = [key for key in self._published_sources if key not in current]
+            if not (self._pending or self._added or self._deleted or self._renamed or sources or removed
+                    or self._replace_positions):
+                # Nothing for readers to reload; fingerprints or aliases may still be pending.
+                self.docstore.commit()
+                return self.number
+            number = self.number + 1
+            data = {**self.data, "segments": list(self.data["segments"]), "ntotal": self.ntotal, "dim": self.d}
+            if self._pending:
+                segment = self._storage()
+                segment.add(np.vstack(self._pending))
+                name = f"{number:06d}.faiss"
+                with metrics.span("index_write"):
+                    _write_index(segment, os.path.join(self.index_path, SEGMENTS_DIR, name))
+                data["segments"].append({"file": name, "count": segment.ntotal})
+            with metrics.span("chunk_store_commit"):
+                self.docstore.publish(number, data, self._added, self._deleted, self._renamed, sources, removed,
+                                      self.index_to_docstore_id if self._replace_positions else None)
+            metrics.count("index_versions")
+            if manifest is not None:
+                self._published_sources = current
+            self._reset(number, data, self.index_to_docstore_id)
+            collect_garbage(self.index_path, self.docstore)
+        if compaction_due(data, len(self.index_to_docstore_id)):
+            compact_in_background(self.index_path, self.embeddings)
+        return number
+
+
+def migrate_legacy(index_path, store):
+    """
+    Publishes an index saved before versions existed (index.faiss, its
+    positions and manifest.json) as the first version, with its files as
+    the base, then removes them from the top of the directory.
+    """
+    flat = faiss.read_index(os.path.join(index_path, LEGACY_FILES[0]), MMAP_FLAGS)
+    positions = store.positions()
+    if len(positions) != flat.ntotal:
+        raise ValueError(
+            f"{index_path}/index.faiss has {flat.ntotal} vectors but the chunk store maps {len(positions)}; "
+            "rebuild it with `python cli.py index build`."
+        )
+    try:
+        with open(os.path.join(index_path, LEGACY_MANIFEST_FILE), "r") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        manifest = {"sources": {}}
+    number = store.latest_version() + 1
+    base_dir = f"{BASE_PREFIX}{number:06d}"
+    base_path = os.path.join(index_path, base_dir)
+    tmp_path = base_path + ".tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    for name in LEGACY_FILES:
+        if os.path.exists(os.path.join(index_path, name)):
+            # A hard link costs nothing; the copy is for filesystems without them.
+            try:
+                os.link(os.path.join(index_path, name), os.path.join(tmp_path, name))
+            except OSError:
+                shutil.copy2(os.path.join(index_path, name), os.path.join(tmp_path, name))
+            _fsync(os.path.join(tmp_path, name))
+    os.replace(tmp_path, base_path)
+    _fsync(index_path)
+    data = {"base": {"dir": base_dir, "count": flat.ntotal}, "segments": [], "ntotal": flat.ntotal, "dim": flat.d}
+    store.publish(number, data, sources=manifest["sources"])
+    for name in LEGACY_FILES + [LEGACY_MANIFEST_FILE]:
+        if os.path.exists(os.path.join(index_path, name)):
+            os.remove(os.path.join(index_path, name))
+
+
+def collect_garbage(index_path, store, grace=INDEX_FILE_GRACE):
+    """
+    Deletes the bases and segment files that neither the latest version
+    nor one replaced less than grace seconds ago uses (including those of
+    an update or compaction that crashed before publishing), and forgets
+    the versions they belonged to. Runs with writer_lock held.
+    """
+    versions = store.versions()
+    if not versions:
+        return
+    cutoff = time.time() - grace
+    kept = [version for version, successor in zip(versions, versions[1:] + [None])
+            if successor is None or successor[1] > cutoff]
+    if kept[0][0] != versions[0][0]:
+        store.prune_versions(kept[0][0])
+    used = set()
+    for _, _, data in kept:
+        if data["base"]:
+            used.add(data["base"]["dir"])
+        used.update(segment["file"] for segment in data["segments"])
+    for name in os.listdir(index_path):
+        if name.startswith(BASE_PREFIX) and name not in used:
+            shutil.rmtree(os.path.join(index_path, name), ignore_errors=True)
+    segments_dir = os.path.join(index_path, SEGMENTS_DIR)
+    for name in os.listdir(segments_dir) if os.path.isdir(segments_dir) else []:
+        if name not in used:
+            os.remove(os.path.join(segments_dir, name))
+
+
+def compact(index_path, embeddings=None):
+    """
+    Merges the base and segments of the latest version into a new base
+    without the deleted vectors, stored as FAISS_STORAGE / FAISS_PCA_DIM
+    say (see vector_codec.py), builds its lexical and (if configured) ANN
+    index, and publishes it as the next version. Readers that loaded
+    an earlier version keep using its files. Returns the new version
+    number, or None if there was nothing to compact.
+    """
+    with writer_lock(index_path), metrics.span("index_compact"):
+        vector_store = load_published(embeddings, index_path, mmap=True)
+        if vector_store is None:
+            return None
+        store = vector_store.docstore
+        try:
+            data = vector_store.version
+            spec = wanted_codec(data, data["live"])
+            if not data["segments"] and data["live"] == data["ntotal"] and spec == data.get("codec"):
+                return None
+            order = sorted(vector_store.index_to_docstore_id)
+            positions = {i: vector_store.index_to_docstore_id[position] for i, position in enumerate(order)}
+            vectors = vector_store.flat_index.reconstruct_batch(order)
+            if spec is None:
+                codec = None
+            elif spec == data.get("codec"):
+                # Re-encoding with the same codec loses nothing more; retraining on its output would.
+                codec = read_codec(vector_store.base_path)
+            else:
+                # vectors are what the old codec kept: precision it dropped stays lost (only a rebuild re-embeds).
+                codec = train_codec(vectors, spec)
+            flat = new_storage(codec, data["dim"])
+            flat.add(vectors)
+            del vectors
+
+            number = data["number"] + 1
+            base_dir = f"{BASE_PREFIX}{number:06d}"
+            base_path = os.path.join(index_path, base_dir)
+            tmp_path = base_path + ".tmp"
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            os.makedirs(tmp_path)
+            _write_index(flat, os.path.join(tmp_path, "index.faiss"))
+            if codec is not None:
+                _write_index(codec, os.path.join(tmp_path, CODEC_FILE))
+            if vector_store.base_path and os.path.exists(os.path.join(vector_store.base_path, LEXICAL_INDEX_FILE)):
+                # Start from the old base's lexical index, so only the segments' chunks are tokenized.
+                shutil.copy2(os.path.join(vector_store.base_path, LEXICAL_INDEX_FILE), tmp_path)
+            base_store = SimpleNamespace(index=flat, docstore=store, index_to_docstore_id=positions)
+            with metrics.span("lexical_sync"):
+                sync_lexical_index(base_store, tmp_path)
+            with metrics.span("ann_sync"):
+                sync_ann_index(base_store, tmp_path)
+            for name in os.listdir(tmp_path):
+                _fsync(os.path.join(tmp_path, name))
+            os.replace(tmp_path, base_path)
+            _fsync(index_path)
+
+            new_data = {"base": {"dir": base_dir, "count": flat.ntotal}, "segments": [], "ntotal": flat.ntotal,
+                        "dim": data["dim"], "codec": spec}
+            store.publish(number, new_data, positions=positions)
+            metrics.count("index_compactions")
+            collect_garbage(index_path, store)
+            return number
+        finally:
+            store.close()
+
+
+def _compact_logged(index_path, embeddings):
+    try:
+        compact(index_path, embeddings)
+    except Exception as e:
+        # The versions already published stay as they are; the next update tries again.
+        metrics.count("index_compaction_errors")
+        print(f"Compacting {index_path} failed: {type(e).__name__}: {e}", file=sys.stderr, flush=True)
+
+
+def compact_in_background(index_path, embeddings=None):
+    """
+    Compacts index_path on a thread of its own, unless that is already
+    happening. The thread is not a daemon, so a command-line update waits
+    for it before exiting.
+    """
+    key = os.path.realpath(index_path)
+    with _compactions_guard:
+        thread = _compactions.get(key)
+        if thread is None or not thread.is_alive():
+            thread = threading.Thread(target=_compact_logged, args=(index_path, embeddings), name="index-compaction")
+            thread.start()
+            _compactions[key] = thread
+    return thread
+
+
+def wait_for_compaction(index_path):
+    thread = _compactions.get(os.path.realpath(index_path))
+    if thread is not None:
+        thread.join()
+
+
+def remove_index(index_path):
+    """Deletes everything saved in index_path but the lock file. Call it with writer_lock held."""
+    for name in os.listdir(index_path) if os.path.isdir(index_path) else []:
+        path = os.path.join(index_path, name)
+        if name == LOCK_FILE:
+            continue
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+
+
+def main():
+    """Time to save a small update to a large index: rewriting the whole flat index file, against publishing a version."""
+    from fake_openai import FakeEmbeddings
+
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument("--synthetic", type=int, default=100000, help="corpus size")
+    parser.add_argument("--dim", type=int, default=1536)
+    parser.add_argument("--update", type=int, default=500, help="vectors added, then deleted")
+    args = parser.parse_args()
+
+    vectors = synthetic_vectors(args.synthetic + args.update, args.dim)
+    corpus, new = vectors[:args.synthetic], vectors[args.synthetic:]
+    ids = [f"chunk-{i}" for i in range(len(vectors))]
+    print(f"{args.synthetic} vectors x {args.dim} dims, update of {args.update} vectors\n")
+    print(f"{'save after':<16}{'rewrite ms':>12}{'publish ms':>12}")
+    with tempfile.TemporaryDirectory() as tmp:
+        flat = faiss.IndexFlatL2(args.dim)
+        flat.add(corpus)
+        index_path = os.path.join(tmp, "index")
+        embeddings = FakeEmbeddings(args.dim)
+        writer = IndexWriter(embeddings, index_path)
+        writer.clear(args.dim)
+        writer.add_embeddings(zip(ids, corpus), ids=ids[:args.synthetic])
+        writer.publish()
+        wait_for_compaction(index_path)
+        writer.docstore.close()
+
+        for label, change in (("add", "add"), ("delete", "delete")):
+            started = time.perf_counter()
+            if change == "add":
+                flat.add(new)
+            else:
+                flat.remove_ids(np.arange(args.synthetic, args.synthetic + args.update, dtype=np.int64))
+            _write_index(flat, os.path.join(tmp, "index.faiss"))
+            rewrite_s = time.perf_counter() - started
+
+            started = time.perf_counter()
+            with writer_lock(index_path):
+                writer = IndexWriter(embeddings, index_path)
+                if change == "add":
+                    writer.add_embeddings(zip(ids[args.synthetic:], new), ids=ids[args.synthetic:])
+                else:
+                    writer.delete(ids[args.synthetic:])
+                writer.publish()
+                writer.docstore.close()
+            publish_s = time.perf_counter() - started
+            print(f"{label:<16}{rewrite_s * 1000:>12.0f}{publish_s * 1000:>12.0f}", flush=True)
+
+        started = time.perf_counter()
+        compact(index_path, embeddings)
+        print(f"\ncompaction (in the background) {time.perf_counter() - started:.1f} s")
+
+
+if __name__ == "__main__":
+    main()
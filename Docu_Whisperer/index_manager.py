@@ -0,0 +1,515 @@
+# Handles the FAISS index and its per-source manifest, so index updates only touch the sources that changed.
+import hashlib
+import json
+import os
+import pickle
+
+import faiss
+from langchain_community.vectorstores import FAISS
+
+from ann_index import FAISS_MMAP, MMAP_FLAGS, load_ann_index
+import metrics
+from chunk_store import CHUNK_STORE_FILE, ChunkStore
+from dedup import DEDUP_MODE, backfill_fingerprints, find_duplicates
+from index_log import IndexWriter, _fsync, load_published, published_sources, published_version, writer_lock
+from lexical_index import LexicalIndex, sync_lexical_index
+from parallel_loader import INGEST_WORKERS, iter_file_parts, prefetch
+from utils import DATA_FOLDER, peak_rss_mb
+
+FAISS_INDEX_PATH = "faiss_index"
+MANIFEST_FILE = "manifest.json"
+PICKLED_DOCSTORE_FILE = "index.pkl"
+# Chunks from several small files are embedded together so the scheduler can run batches concurrently.
+SYNC_EMBED_GROUP = 1000
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def text_sha256(chunks):
+    digest = hashlib.sha256()
+    for chunk in chunks:
+        digest.update(chunk.page_content.encode("utf-8"))
+        digest.update(b"\x00")
+    return digest.hexdigest()
+
+
+def source_ids(key, count, start=0, version=""):
+    # Stable per source: a replaced source deletes its old ids before re-adding.
+    # version keeps a new file version's ids apart from the one it replaces.
+    prefix = hashlib.sha1((key + version).encode("utf-8")).hexdigest()[:16]
+    return [f"{prefix}-{i}" for i in range(start, start + count)]
+
+
+def load_manifest(index_path=FAISS_INDEX_PATH):
+    # Published with the index (see index_log.py); manifest.json is the top of a sharded or legacy index.
+    sources = published_sources(index_path)
+    if sources is not None:
+        return {"sources": sources}
+    path = os.path.join(index_path, MANIFEST_FILE)
+    if os.path.exists(path):
+        try:
+            with open(path, "r") as f:
+                return json.load(f)
+        except Exception:
+            pass
+    return {"sources": {}}
+
+
+def save_manifest(manifest, index_path=FAISS_INDEX_PATH):
+    """Replaces manifest.json, on disk for good before it is in place: it is all that records a sharded update."""
+    os.makedirs(index_path, exist_ok=True)
+    path = os.path.join(index_path, MANIFEST_FILE)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=1)
+    _fsync(tmp_path)
+    os.replace(tmp_path, path)
+    _fsync(index_path)
+
+
+def read_pickled_docstore(index_path=FAISS_INDEX_PATH):
+    """(docstore, index_to_docstore_id) of an index saved by FAISS.save_local, from its index.pkl."""
+    with open(os.path.join(index_path, PICKLED_DOCSTORE_FILE), "rb") as f:
+        return pickle.load(f)
+
+
+def migrate_pickled_docstore(index_path=FAISS_INDEX_PATH):
+    """
+    Moves the chunks of an index saved by FAISS.save_local (index.pkl) into
+    the chunk store, then deletes the pickle. Runs once per index, from a
+    writer holding writer_lock. The chunk store is built under another
+    name and renamed into place, so readers see either the pickle or the
+    complete store.
+    """
+    docstore, index_to_docstore_id = read_pickled_docstore(index_path)
+    path = os.path.join(index_path, CHUNK_STORE_FILE)
+    tmp_path = path + ".tmp"
+    for stale in (tmp_path, tmp_path + "-wal", tmp_path + "-shm"):
+        if os.path.exists(stale):
+            os.remove(stale)
+    store = ChunkStore(tmp_path)
+    ids = list(index_to_docstore_id.values())
+    store.add({doc_id: docstore.search(doc_id) for doc_id in ids})
+    store.commit(index_to_docstore_id)
+    store.close()
+    os.replace(tmp_path, path)
+    os.remove(os.path.join(index_path, PICKLED_DOCSTORE_FILE))
+
+
+def is_sharded(manifest):
+    """True for an index saved in the sharded layout (see sharded_index.py)."""
+    return "shard_by" in manifest
+
+
+def load_vector_store(embeddings, index_path=FAISS_INDEX_PATH, mmap=False):
+    """
+    The latest saved version of the index with its chunk store, as a
+    read-only store, or None. Chunks stay on disk and are read per query.
+    mmap=True maps the vector files read-only instead of reading them into
+    memory. A sharded index comes back as one store over all its shards.
+    Use open_index to add or delete.
+    """
+    manifest = load_manifest(index_path)
+    if is_sharded(manifest):
+        from sharded_index import load_sharded_store
+        return load_sharded_store(embeddings, index_path, manifest, mmap)
+    if published_version(index_path) is not None:
+        return load_published(embeddings, index_path, mmap)
+    # Saved before versions existed; converted by the next update, and only read here.
+    index_file = os.path.join(index_path, "index.faiss")
+    if not os.path.exists(index_file):
+        return None
+    index = faiss.read_index(index_file, MMAP_FLAGS if mmap else 0)
+    if not os.path.exists(os.path.join(index_path, CHUNK_STORE_FILE)):
+        try:
+            docstore, index_to_docstore_id = read_pickled_docstore(index_path)
+            return FAISS(embeddings, index, docstore, index_to_docstore_id)
+        except FileNotFoundError:
+            pass  # A writer converted it just now.
+    store = ChunkStore(os.path.join(index_path, CHUNK_STORE_FILE))
+    index_to_docstore_id = store.positions()
+    if len(index_to_docstore_id) != index.ntotal:
+        raise ValueError(
+            f"{index_file} has {index.ntotal} vectors but the chunk store maps {len(index_to_docstore_id)}; "
+            "rebuild it with `python cli.py index build`."
+        )
+    return FAISS(embeddings, index, store, index_to_docstore_id)
+
+
+def load_search_store(embeddings, index_path=FAISS_INDEX_PATH, mmap=FAISS_MMAP):
+    """
+    A read-only vector store for queries: memory-mapped, and searching the
+    IVF/HNSW/PQ index when one is configured and up to date.
+    """
+    manifest = load_manifest(index_path)
+    if is_sharded(manifest):
+        from sharded_index import load_sharded_store
+        return load_sharded_store(embeddings, index_path, manifest, mmap, search=True)
+    if published_version(index_path) is not None:
+        return load_published(embeddings, index_path, mmap, search=True)
+    vector_store = load_vector_store(embeddings, index_path, mmap)
+    if vector_store is not None:
+        ann = load_ann_index(vector_store, index_path, mmap)
+        # Context packing reads stored vectors back, which ANN indexes can't all do.
+        vector_store.flat_index = vector_store.index
+        if ann is not None:
+            vector_store.index = ann
+    return vector_store
+
+
+def new_vector_store(embeddings, dimension, index_path=FAISS_INDEX_PATH):
+    """An empty index to add to; saving it replaces whatever was saved at index_path before."""
+    vector_store = IndexWriter(embeddings, index_path)
+    vector_store.clear(dimension)
+    return vector_store
+
+
+def open_vector_store(embeddings, index_path=FAISS_INDEX_PATH):
+    """
+    The saved index opened for adding and deleting (see index_log.IndexWriter),
+    or None if there is none. An index saved in an older layout is converted.
+    """
+    with writer_lock(index_path):
+        if published_version(index_path) is None:
+            if not os.path.exists(os.path.join(index_path, "index.faiss")):
+                return None
+            if not os.path.exists(os.path.join(index_path, CHUNK_STORE_FILE)):
+                migrate_pickled_docstore(index_path)
+        return IndexWriter(embeddings, index_path)
+
+
+def load_lexical_index(vector_store, index_path=FAISS_INDEX_PATH):
+    """
+    The BM25 index over vector_store's chunks. One saved before the lexical
+    index existed, or out of step with FAISS, is caught up in memory; only
+    writers (compaction) save it. For a sharded store, the shards' lexical
+    indexes merged.
+    """
+    shards = getattr(vector_store, "shards", None)
+    if shards:
+        return LexicalIndex.merge([load_lexical_index(store, path) for path, store in shards.items()])
+    if hasattr(vector_store, "base_path"):
+        # The base's index, caught up in memory with the chunks added and deleted since it was compacted.
+        return sync_lexical_index(vector_store, vector_store.base_path, save=False)
+    lexical_index = LexicalIndex.load(index_path)
+    if vector_store is not None and len(lexical_index) != len(vector_store.index_to_docstore_id):
+        lexical_index = sync_lexical_index(vector_store, index_path, save=False)
+    return lexical_index
+
+
+def save_vector_store(vector_store, manifest):
+    """Publishes the updates made to vector_store, and manifest, as the next version of its index."""
+    if getattr(vector_store, "sharded", False):
+        vector_store.save(manifest)
+        return
+    vector_store.publish(manifest)
+
+
+def save_source_entries(vector_store, manifest):
+    """
+    Saves manifest entries that changed in ways no search depends on (web
+    pages' check times and validators) without publishing a new version.
+    A sharded index keeps its manifest in manifest.json, which is rewritten.
+    """
+    if getattr(vector_store, "sharded", False):
+        save_manifest(manifest, vector_store.index_path)
+        return
+    vector_store.record_sources(manifest)
+
+
+def source_key(doc, data_folder=DATA_FOLDER):
+    """The manifest key of the file (in data_folder) or web page a chunk came from, or None."""
+    # Docx chunks carry a "source" path too, so check for doc_name first.
+    if doc.metadata.get("doc_name"):
+        return os.path.join(data_folder, doc.metadata["doc_name"])
+    return doc.metadata.get("source")
+
+
+def source_versions(manifest):
+    """Content fingerprint per source; None for legacy entries that have none yet."""
+    return {key: entry.get("sha256") for key, entry in manifest["sources"].items()}
+
+
+def adopt_legacy_index(vector_store, manifest, data_folder=DATA_FOLDER):
+    """
+    Indexes built before the manifest existed own no sources. Attribute their
+    vectors by chunk metadata so they can still be removed; file sources get
+    no fingerprint, so the next sync (of data_folder) replaces them once.
+    """
+    if vector_store is None or manifest["sources"]:
+        return manifest
+    for vector_id in vector_store.index_to_docstore_id.values():
+        doc = vector_store.docstore.search(vector_id)
+        key = source_key(doc, data_folder) if hasattr(doc, "metadata") else None
+        if not key:
+            continue
+        kind = "file" if doc.metadata.get("doc_name") else "web"
+        manifest["sources"].setdefault(key, {"type": kind, "ids": []})["ids"].append(vector_id)
+    return manifest
+
+
+def plan_chunks(vector_store, batches):
+    """
+    (ids, chunks, fingerprints, links, unique) for [(key, ids, chunks)]
+    batches: links maps the position of each chunk that repeats one already
+    in vector_store, or an earlier one here, to that chunk's id; unique are
+    the positions of the chunks to embed.
+    """
+    ids = [doc_id for _, batch_ids, _ in batches for doc_id in batch_ids]
+    chunks = [chunk for _, _, batch_chunks in batches for chunk in batch_chunks]
+    if not chunks:
+        return ids, chunks, [], {}, []
+    store = vector_store.docstore if vector_store is not None else None
+    prints, links = find_duplicates(store if isinstance(store, ChunkStore) else None, chunks, ids)
+    return ids, chunks, prints, links, [i for i in range(len(chunks)) if i not in links]
+
+
+def add_planned(vector_store, embeddings, plan, vectors, index_path=FAISS_INDEX_PATH):
+    """
+    Adds the unique chunks of a plan_chunks plan with their vectors, creating
+    the index if vector_store is None, and records the rest as aliases.
+    """
+    ids, chunks, prints, links, unique = plan
+    if unique:
+        texts = [chunks[i].page_content for i in unique]
+        if vector_store is None:
+            vector_store = new_vector_store(embeddings, len(vectors[0]), index_path)
+        with metrics.span("index_add"):
+            vector_store.add_embeddings(zip(texts, vectors), metadatas=[chunks[i].metadata for i in unique],
+                                        ids=[ids[i] for i in unique])
+        metrics.count("chunks_indexed", len(unique))
+    if chunks and isinstance(vector_store.docstore, ChunkStore) and DEDUP_MODE != "off":
+        vector_store.docstore.add_fingerprints({ids[i]: prints[i] for i in unique})
+        vector_store.docstore.add_aliases({ids[i]: (canonical, chunks[i], prints[i]) for i, canonical in links.items()})
+    return vector_store
+
+
+def index_chunks(vector_store, embeddings, batches, index_path=FAISS_INDEX_PATH):
+    """
+    Embeds the chunks of [(key, ids, chunks)] batches in one call and adds
+    them, creating the index if vector_store is None. Chunks that repeat one
+    already indexed, or an earlier one here, are not embedded: they are kept
+    as aliases of it (see dedup.py). Returns the vector store and the number
+    of chunks linked that way.
+    """
+    if getattr(vector_store, "sharded", False):
+        return vector_store.index_chunks(embeddings, batches)
+    plan = plan_chunks(vector_store, batches)
+    chunks, links, unique = plan[1], plan[3], plan[4]
+    if not chunks:
+        return vector_store, 0
+    vectors = embeddings.embed_documents([chunks[i].page_content for i in unique]) if unique else []
+    return add_planned(vector_store, embeddings, plan, vectors, index_path), len(links)
+
+
+def delete_chunks(vector_store, ids, shard=None):
+    """
+    Deletes chunks and aliases by id. A chunk that duplicates were linked to
+    is handed to its oldest alias instead, vector and all, so the text stays
+    searchable for as long as some source still has it. shard names the
+    shard of a sharded index that holds ids, when it is known.
+    """
+    if getattr(vector_store, "sharded", False):
+        return vector_store.delete_chunks(ids, shard)
+    known = set(vector_store.index_to_docstore_id.values())
+    indexed = [doc_id for doc_id in ids if doc_id in known]
+    store = vector_store.docstore
+    if isinstance(store, ChunkStore):
+        store.delete_aliases([doc_id for doc_id in ids if doc_id not in known])
+        heirs = store.heirs(indexed)
+        if heirs:
+            for position, doc_id in list(vector_store.index_to_docstore_id.items()):
+                if doc_id in heirs:
+                    store.promote(doc_id, heirs[doc_id])
+                    vector_store.rename(position, heirs[doc_id])
+            metrics.count("chunks_promoted", len(heirs))
+            indexed = [doc_id for doc_id in indexed if doc_id not in heirs]
+    if indexed:
+        with metrics.span("index_delete"):
+            vector_store.delete(indexed)
+        metrics.count("chunks_deleted", len(indexed))
+    return vector_store
+
+
+def add_sources(vector_store, embeddings, manifest, pending, index_path=FAISS_INDEX_PATH):
+    """
+    Add several (key, chunks, info) sources, each replacing whatever that
+    source owned before, embedding all their new chunks in one call.
+    """
+    pending = list({key: (key, chunks, info) for key, chunks, info in pending}.values())
+    for key, _, _ in pending:
+        vector_store = remove_source(vector_store, manifest, key)
+    batches = [(key, source_ids(key, len(chunks)), chunks) for key, chunks, _ in pending]
+    vector_store, _ = index_chunks(vector_store, embeddings, batches, index_path)
+    for (key, _, info), (_, ids, _) in zip(pending, batches):
+        manifest["sources"][key] = {**info, "ids": ids}
+    return vector_store
+
+
+def remove_source(vector_store, manifest, key):
+    entry = manifest["sources"].pop(key, None)
+    if entry and vector_store is not None:
+        vector_store = delete_chunks(vector_store, entry["ids"], entry.get("shard"))
+    return vector_store
+
+
+def sync_sources(vector_store, embeddings, manifest, doc_paths, web_urls, max_workers=INGEST_WORKERS,
+                 on_progress=None, index_path=FAISS_INDEX_PATH, prune=True):
+    """
+    Bring the index in line with the files on disk and the web URL list:
+    new files are embedded, modified files replaced, and sources that no
+    longer exist are deleted (with prune=False, sources not listed are left
+    alone, to update just doc_paths). Web pages are only ever removed here,
+    adding one goes through add_web_page. Files that fail to parse keep
+    whatever they had indexed and are listed under "failed".
+    on_progress(done, total, path) is called as each changed file is parsed.
+
+    Files stream through page range by page range: parsing runs ahead of
+    embedding by at most INGEST_BUFFER_MB, and chunks are appended to the
+    index SYNC_EMBED_GROUP at a time, so a huge PDF or a full rebuild
+    doesn't need all its chunks in memory at once. A replaced file's old
+    vectors are only dropped once its new version is completely added.
+    """
+    report = {"added": 0, "updated": 0, "removed": 0, "unchanged": 0, "chunks": 0, "duplicates": 0, "failed": []}
+    sources = manifest["sources"]
+
+    changed = {}
+    for path in doc_paths:
+        stat = os.stat(path)
+        entry = sources.get(path)
+        if entry and entry.get("size") == stat.st_size and entry.get("mtime") == stat.st_mtime:
+            report["unchanged"] += 1
+            continue
+        sha256 = file_sha256(path)
+        if entry and entry.get("sha256") == sha256:
+            # Touched but not modified: just refresh the recorded stat.
+            entry.update(size=stat.st_size, mtime=stat.st_mtime)
+            report["unchanged"] += 1
+            continue
+        changed[path] = {"type": "file", "size": stat.st_size, "mtime": stat.st_mtime, "sha256": sha256}
+
+    updating = {path for path in changed if path in sources}
+    staged, errors = {}, {}  # ids added so far / parse errors, per file in progress
+    pending, finished = [], []
+    pending_chunks = 0
+
+    def flush():
+        nonlocal vector_store, pending_chunks
+        batches = []
+        for path, chunks in pending:
+            ids = source_ids(path, len(chunks), len(staged[path]), changed[path]["sha256"])
+            staged[path].extend(ids)
+            batches.append((path, ids, chunks))
+        vector_store, linked = index_chunks(vector_store, embeddings, batches, index_path)
+        report["duplicates"] += linked
+        for path in finished:
+            vector_store = remove_source(vector_store, manifest, path)
+            sources[path] = {**changed[path], "ids": staged.pop(path)}
+            report["chunks"] += len(sources[path]["ids"])
+        pending.clear()
+        finished.clear()
+        pending_chunks = 0
+
+    done = 0
+    for path, chunks, error, last in prefetch(iter_file_parts(changed, max_workers)):
+        if path not in staged:
+            staged[path] = []
+            if not sources.get(path, {}).get("sha256"):
+                # Legacy entries have no version to keep their ids apart from the new ones.
+                vector_store = remove_source(vector_store, manifest, path)
+        if error:
+            errors.setdefault(path, []).append(error)
+        elif chunks and path not in errors:
+            pending.append((path, chunks))
+            pending_chunks += len(chunks)
+        if last:
+            done += 1
+            if on_progress:
+                on_progress(done, len(changed), path)
+            if path in errors:
+                pending[:] = [part for part in pending if part[0] != path]
+                pending_chunks = sum(len(part) for _, part in pending)
+                if staged[path]:
+                    vector_store = delete_chunks(vector_store, staged[path])
+                del staged[path]
+                report["failed"].append((path, "; ".join(errors.pop(path))))
+            else:
+                report["updated" if path in updating else "added"] += 1
+                finished.append(path)
+        if pending_chunks >= SYNC_EMBED_GROUP:
+            flush()
+    flush()
+
+    wanted = set(doc_paths) | set(web_urls)
+    for key in [key for key in sources if prune and key not in wanted]:
+        vector_store = remove_source(vector_store, manifest, key)
+        report["removed"] += 1
+    return vector_store, report
+
+
+def open_index(embeddings, index_path=FAISS_INDEX_PATH, data_folder=DATA_FOLDER):
+    """
+    The saved vector store (or None) and its manifest, ready for add/remove
+    calls; files of an index older than the manifest are assumed to be in
+    data_folder. A sharded index (or a new one, with FAISS_SHARD_BY set) comes
+    back as a sharded_index.ShardedIndex, which opens shards as they are needed.
+    Hold writer_lock(index_path) from here until the update is saved.
+    """
+    manifest = load_manifest(index_path)
+    vector_store = None if is_sharded(manifest) else open_vector_store(embeddings, index_path)
+    if not is_sharded(manifest) and vector_store is None:
+        from sharded_index import FAISS_SHARD_BY
+        if FAISS_SHARD_BY != "none":
+            manifest["shard_by"] = FAISS_SHARD_BY
+    if is_sharded(manifest):
+        from sharded_index import ShardedIndex
+        return ShardedIndex(embeddings, index_path, manifest), manifest
+    if vector_store is not None:
+        backfill_fingerprints(vector_store.docstore)
+    return vector_store, adopt_legacy_index(vector_store, manifest, data_folder)
+
+
+def sync_index(embeddings, doc_paths, web_urls, index_path=FAISS_INDEX_PATH, max_workers=INGEST_WORKERS,
+               on_progress=None, prune=True, data_folder=DATA_FOLDER):
+    with metrics.span("index_sync"), writer_lock(index_path):
+        vector_store, manifest = open_index(embeddings, index_path, data_folder)
+        vector_store, report = sync_sources(
+            vector_store, embeddings, manifest, doc_paths, web_urls, max_workers, on_progress, index_path, prune
+        )
+        if vector_store is not None:
+            save_vector_store(vector_store, manifest)
+    # Process-lifetime peaks: for a long-running app they include everything before this sync.
+    report["peak_rss_mb"] = peak_rss_mb()
+    report["worker_peak_rss_mb"] = peak_rss_mb(children=True)
+    return vector_store, report
+
+
+def web_page_source(url, chunks):
+    """A (key, chunks, info) entry for add_sources."""
+    return url, chunks, {"type": "web", "sha256": text_sha256(chunks)}
+
+
+def add_web_page(embeddings, url, chunks, index_path=FAISS_INDEX_PATH):
+    with writer_lock(index_path):
+        vector_store, manifest = open_index(embeddings, index_path)
+        vector_store = add_sources(vector_store, embeddings, manifest, [web_page_source(url, chunks)], index_path)
+        save_vector_store(vector_store, manifest)
+    return vector_store
+
+
+def remove_sources(embeddings, keys, index_path=FAISS_INDEX_PATH):
+    """Deletes the files or web pages keys from the saved index. Returns how many were indexed."""
+    with writer_lock(index_path):
+        vector_store, manifest = open_index(embeddings, index_path)
+        removed = [key for key in keys if key in manifest["sources"]]
+        for key in removed:
+            vector_store = remove_source(vector_store, manifest, key)
+        if vector_store is not None and removed:
+            save_vector_store(vector_store, manifest)
+    return len(removed)
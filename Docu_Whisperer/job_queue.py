@@ -0,0 +1,399 @@
+# Persistent queue of index jobs (ingest, remove, re-index, crawl, refresh), run by a background worker.
+import argparse
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+import metrics
+from index_manager import FAISS_INDEX_PATH, add_web_page, remove_sources, sync_index
+from utils import DATA_FOLDER, list_doc_paths, load_web_urls, save_web_urls
+
+JOB_QUEUE_PATH = os.environ.get("JOB_QUEUE_PATH", "jobs.sqlite")
+# A running job whose worker has not checked in for this long is taken to be dead (process killed) and re-queued.
+JOB_STALE_SECONDS = float(os.environ.get("JOB_STALE_SECONDS", "60"))
+JOB_HEARTBEAT_SECONDS = JOB_STALE_SECONDS / 6
+# Runs of a job that keeps dying with its worker before it is marked failed.
+JOB_MAX_ATTEMPTS = 3
+# Finished jobs kept for the job list.
+JOB_HISTORY = 200
+JOB_KINDS = ("ingest", "remove", "reindex", "crawl", "refresh")
+
+
+def _is_url(source):
+    return bool(source) and source.startswith(("http://", "https://"))
+
+
+def _covered_by_reindex(kind, source):
+    # A re-index syncs with data/ and the saved web page list, so it also adds or removes any file and removes
+    # any page dropped from the list; adding a page still needs the page fetched.
+    return kind == "remove" or (kind == "ingest" and not _is_url(source))
+
+
+class JobQueue:
+    """
+    Index jobs in SQLite, so they outlive the browser tab that asked for
+    them and the process that was running them.
+
+    Submitting coalesces with jobs still waiting: an ingest or remove for a
+    source that already has one queued replaces it (the latest request
+    wins), a second re-index or refresh returns the queued one, and a
+    queued re-index absorbs the file and removal jobs it would redo anyway.
+    Only one job runs at a time across all workers, since every job writes
+    the same index.
+    """
+
+    def __init__(self, path=JOB_QUEUE_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=60, isolation_level=None)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, kind TEXT NOT NULL, source TEXT, payload TEXT NOT NULL, "
+            "state TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, created REAL NOT NULL, started REAL, "
+            "heartbeat REAL, finished REAL, progress TEXT, result TEXT, error TEXT)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, id)")
+
+    @contextmanager
+    def _transaction(self):
+        # BEGIN IMMEDIATE takes SQLite's write lock up front, so two processes can't both claim or coalesce.
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._conn
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+
+    def submit(self, kind, source=None, **payload):
+        """Queues a job (or folds it into an equivalent queued one). Returns the id of the job that will do it."""
+        if kind not in JOB_KINDS:
+            raise ValueError(f"Unknown job kind {kind!r}; expected one of {', '.join(JOB_KINDS)}")
+        now = time.time()
+        metrics.count("jobs_submitted", kind=kind)
+        with self._transaction() as conn:
+            queued = conn.execute("SELECT id, kind, source FROM jobs WHERE state = 'queued' ORDER BY id").fetchall()
+            reindex = next((job["id"] for job in queued if job["kind"] == "reindex"), None)
+            if kind in ("reindex", "refresh"):
+                same = next((job["id"] for job in queued if job["kind"] == kind), None)
+                if same is not None:
+                    metrics.count("jobs_coalesced", kind=kind)
+                    return same
+            elif kind in ("ingest", "remove"):
+                same = next((job["id"] for job in queued if job["source"] == source
+                             and job["kind"] in ("ingest", "remove")), None)
+                if same is not None:
+                    conn.execute("UPDATE jobs SET kind = ?, payload = ? WHERE id = ?",
+                                 (kind, json.dumps(payload), same))
+                    metrics.count("jobs_coalesced", kind=kind)
+                    return same
+                if reindex is not None and _covered_by_reindex(kind, source):
+                    metrics.count("jobs_coalesced", kind=kind)
+                    return reindex
+            job_id = conn.execute(
+                "INSERT INTO jobs (kind, source, payload, state, created) VALUES (?, ?, ?, 'queued', ?)",
+                (kind, source, json.dumps(payload), now),
+            ).lastrowid
+            if kind == "reindex":
+                merged = [job["id"] for job in queued if _covered_by_reindex(job["kind"], job["source"])]
+                conn.executemany(
+                    "UPDATE jobs SET state = 'merged', finished = ?, result = ? WHERE id = ?",
+                    [(now, json.dumps({"merged_into": job_id}), merged_id) for merged_id in merged],
+                )
+                metrics.count("jobs_coalesced", len(merged), kind="reindex")
+            return job_id
+
+    def claim(self):
+        """The oldest queued job, now marked running; None if there is none or another job is still running."""
+        now = time.time()
+        with self._transaction() as conn:
+            for job in conn.execute("SELECT id, attempts FROM jobs WHERE state = 'running' AND heartbeat < ?",
+                                    (now - JOB_STALE_SECONDS,)).fetchall():
+                # Its worker died mid-job: every job kind is safe to run again from the start.
+                if job["attempts"] >= JOB_MAX_ATTEMPTS:
+                    conn.execute("UPDATE jobs SET state = 'failed', finished = ?, error = ? WHERE id = ?",
+                                 (now, "Worker stopped while running the job", job["id"]))
+                else:
+                    conn.execute("UPDATE jobs SET state = 'queued' WHERE id = ?", (job["id"],))
+                metrics.count("jobs_recovered")
+            if conn.execute("SELECT 1 FROM jobs WHERE state = 'running'").fetchone():
+                return None
+            job = conn.execute("SELECT * FROM jobs WHERE state = 'queued' ORDER BY id LIMIT 1").fetchone()
+            if job is None:
+                return None
+            conn.execute(
+                "UPDATE jobs SET state = 'running', attempts = attempts + 1, started = ?, heartbeat = ?, "
+                "progress = NULL WHERE id = ?",
+                (now, now, job["id"]),
+            )
+        return self.get(job["id"])
+
+    def heartbeat(self, job_id, progress=None):
+        """Marks the job's worker as alive, optionally with new progress {done, total, unit, message}."""
+        with self._lock:
+            if progress is None:
+                self._conn.execute("UPDATE jobs SET heartbeat = ? WHERE id = ?", (time.time(), job_id))
+            else:
+                self._conn.execute("UPDATE jobs SET heartbeat = ?, progress = ? WHERE id = ?",
+                                   (time.time(), json.dumps(progress), job_id))
+
+    def finish(self, job_id, result=None, error=None):
+        state = "failed" if error else "done"
+        metrics.count("jobs_finished", state=state)
+        with self._transaction() as conn:
+            conn.execute("UPDATE jobs SET state = ?, finished = ?, result = ?, error = ? WHERE id = ?",
+                         (state, time.time(), json.dumps(result) if result is not None else None, error, job_id))
+            # Keep the table small: the list only shows recent history.
+            conn.execute(
+                "DELETE FROM jobs WHERE state NOT IN ('queued', 'running') AND id NOT IN "
+                "(SELECT id FROM jobs WHERE state NOT IN ('queued', 'running') ORDER BY id DESC LIMIT ?)",
+                (JOB_HISTORY,),
+            )
+
+    def cancel(self, job_id):
+        """Cancels a job that has not started yet. Returns True if it was still queued."""
+        with self._lock:
+            cursor = self._conn.execute(
+                "UPDATE jobs SET state = 'cancelled', finished = ? WHERE id = ? AND state = 'queued'",
+                (time.time(), job_id),
+            )
+        return cursor.rowcount == 1
+
+    def _describe(self, row):
+        job = dict(row)
+        for key in ("payload", "progress", "result"):
+            job[key] = json.loads(job[key]) if job[key] else ({} if key == "payload" else None)
+        end = job["finished"] or time.time()
+        job["seconds"] = end - job["started"] if job["started"] else 0.0
+        done = (job["progress"] or {}).get("done", 0)
+        job["rate"] = done / job["seconds"] if job["seconds"] else 0.0
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._describe(row) if row else None
+
+    def jobs(self, limit=20):
+        """Queued and running jobs first (oldest first), then the most recently finished ones."""
+        with self._lock:
+            active = self._conn.execute(
+                "SELECT * FROM jobs WHERE state IN ('queued', 'running') ORDER BY id").fetchall()
+            finished = self._conn.execute(
+                "SELECT * FROM jobs WHERE state NOT IN ('queued', 'running') ORDER BY finished DESC, id DESC LIMIT ?",
+                (max(limit - len(active), 0),)).fetchall()
+        return [self._describe(row) for row in active + finished]
+
+    def last_job(self, kind):
+        """The most recently submitted job of kind, in any state; None if there is none."""
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM jobs WHERE kind = ? ORDER BY id DESC LIMIT 1", (kind,)).fetchone()
+        return self._describe(row) if row else None
+
+    def last_finished(self):
+        """Id of the most recent job that completed, to notice that the index on disk changed."""
+        with self._lock:
+            return self._conn.execute("SELECT MAX(id) FROM jobs WHERE state = 'done'").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+# ---------- running jobs ----------
+
+def _add_web_urls(urls):
+    # Re-read first: the app may have changed the list since this job started.
+    saved = load_web_urls()
+    new = [url for url in urls if url not in saved]
+    if new:
+        save_web_urls(saved + new)
+
+
+def run_ingest(job, embeddings, index_path, pool, progress):
+    source = job["source"]
+    if _is_url(source):
+        from web_loader import load_web_chunks
+
+        progress(0, 1, "pages", "fetching")
+        chunks, method = load_web_chunks(source, pool)
+        if not chunks:
+            raise ValueError("No text extracted from the page.")
+        progress(0, 1, "pages", f"embedding {len(chunks)} chunks")
+        add_web_page(embeddings, source, chunks, index_path)
+        _add_web_urls([source])
+        progress(1, 1, "pages")
+        return {"chunks": len(chunks), "method": method}
+    if not os.path.exists(source):
+        raise FileNotFoundError(f"{source} no longer exists")
+    _, report = sync_index(embeddings, [source], [], index_path, on_progress=lambda done, total, path: progress(
+        done, total, "files", os.path.basename(path)), prune=False)
+    if report["failed"]:
+        raise ValueError(report["failed"][0][1])
+    return report
+
+
+def run_remove(job, embeddings, index_path, pool, progress):
+    return {"removed": remove_sources(embeddings, [job["source"]], index_path)}
+
+
+def run_reindex(job, embeddings, index_path, pool, progress):
+    data_folder = job["payload"].get("data", DATA_FOLDER)
+    docx_paths, pdf_paths = list_doc_paths(data_folder)
+    _, report = sync_index(embeddings, docx_paths + pdf_paths, load_web_urls(), index_path, data_folder=data_folder,
+                           on_progress=lambda done, total, path: progress(done, total, "files", os.path.basename(path)))
+    return report
+
+
+def run_crawl(job, embeddings, index_path, pool, progress):
+    from web_crawler import crawl
+
+    def on_progress(p):
+        done = p["fetched"] + p["failed"]
+        progress(done, done + p["queued"], "pages",
+                 f"{p['indexed_pages']} pages / {p['indexed_chunks']} chunks indexed, {p['failed']} failed")
+
+    # Pages already in the list (from an earlier, interrupted run of this job too) are not fetched again.
+    result = crawl(embeddings=embeddings, index_path=index_path, pool=pool, skip=load_web_urls(),
+                   on_progress=on_progress, on_indexed=_add_web_urls, **job["payload"])
+    return {key: value for key, value in result.items() if key != "started"}
+
+
+def run_refresh(job, embeddings, index_path, pool, progress):
+    from web_refresh import refresh_web_pages
+
+    progress(0, 0, "pages", "checking")
+    _, report = refresh_web_pages(embeddings, load_web_urls(), index_path, max_age=0, pool=pool)
+    progress(report["checked"], report["checked"], "pages")
+    return report
+
+
+RUNNERS = {"ingest": run_ingest, "remove": run_remove, "reindex": run_reindex, "crawl": run_crawl,
+           "refresh": run_refresh}
+
+
+class JobWorker:
+    """
+    Takes jobs off the queue one at a time on a daemon thread and runs them
+    against index_path, checking in every JOB_HEARTBEAT_SECONDS so other
+    workers can tell it is alive. The app runs one per process; the index
+    it serves from is only replaced once a job has saved a new one.
+    """
+
+    def __init__(self, queue, embeddings, index_path=FAISS_INDEX_PATH, pool=None, poll=1.0):
+        self.queue = queue
+        self.embeddings = embeddings
+        self.index_path = index_path
+        self.pool = pool
+        self.poll = poll
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._loop, name="job-worker", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+
+    def _loop(self):
+        while not self._stop.is_set():
+            try:
+                ran = self.run_next()
+            except Exception:
+                # The queue itself failed (e.g. the database is locked for too long); try again later.
+                metrics.count("job_worker_errors")
+                ran = False
+            if not ran:
+                self._stop.wait(self.poll)
+
+    def run_next(self):
+        """Runs the next queued job, if any. Returns whether one ran."""
+        job = self.queue.claim()
+        if job is None:
+            return False
+        alive = threading.Event()
+
+        def beat():
+            while not alive.wait(JOB_HEARTBEAT_SECONDS):
+                self.queue.heartbeat(job["id"])
+
+        def progress(done, total, unit, message=None):
+            self.queue.heartbeat(job["id"], {"done": done, "total": total, "unit": unit, "message": message})
+
+        beater = threading.Thread(target=beat, name=f"job-{job['id']}-heartbeat", daemon=True)
+        beater.start()
+        try:
+            with metrics.span("job", kind=job["kind"]):
+                result = RUNNERS[job["kind"]](job, self.embeddings, self.index_path, self.pool, progress)
+        except Exception as e:
+            self.queue.finish(job["id"], error=f"{type(e).__name__}: {e}")
+        else:
+            self.queue.finish(job["id"], result)
+        finally:
+            alive.set()
+            beater.join()
+        return True
+
+
+def describe_progress(job):
+    """One line of progress for the job list, e.g. '12/40 files, 1.5 files/s: report.pdf'."""
+    progress = job["progress"] or {}
+    text = ""
+    if progress.get("total"):
+        text = f"{progress['done']}/{progress['total']} {progress['unit']}"
+        if job["rate"]:
+            text += f", {job['rate']:.1f} {progress['unit']}/s"
+    if progress.get("message"):
+        text += (": " if text else "") + progress["message"]
+    return text
+
+
+def main():
+    """Run a job worker in the foreground, or list and submit jobs."""
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument("--queue", default=JOB_QUEUE_PATH)
+    parser.add_argument("--index", default=FAISS_INDEX_PATH)
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("work", help="run queued jobs until interrupted")
+    commands.add_parser("list", help="show queued, running and recent jobs")
+    submit = commands.add_parser("submit", help="queue a job")
+    submit.add_argument("kind", choices=JOB_KINDS)
+    submit.add_argument("source", nargs="?", help="file path or URL for ingest / remove")
+    args = parser.parse_args()
+
+    queue = JobQueue(args.queue)
+    if args.command == "list":
+        for job in queue.jobs(50):
+            print(f"{job['id']:>5}  {job['state']:<9} {job['kind']:<8} {job['source'] or '':<50} "
+                  f"{job['seconds']:7.1f}s  {job['error'] or describe_progress(job)}")
+        return
+    if args.command == "submit":
+        if args.kind in ("ingest", "remove") and not args.source:
+            parser.error(f"{args.kind} needs a file path or URL")
+        print(queue.submit(args.kind, args.source))
+        return
+
+    from env_setup import make_embeddings, setup_environment
+
+    setup_environment()
+    metrics.start_exporters()
+    worker = JobWorker(queue, make_embeddings(), args.index)
+    print(f"Running jobs from {args.queue} against {args.index}")
+    try:
+        worker._loop()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
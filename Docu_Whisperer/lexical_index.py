@@ -0,0 +1,139 @@
+# BM25 inverted index over the same chunks as the FAISS index, for exact identifiers and embedding-free search.
+import heapq
+import json
+import math
+import os
+import re
+from collections import Counter
+
+LEXICAL_INDEX_FILE = "lexical_index.json"
+
+# Keeps identifiers such as "CLD-02", "ISO/IEC-27001" or "v2.1" together as one token.
+_TOKEN_RE = re.compile(r"\w+(?:[-./]\w+)*")
+
+
+def tokenize(text):
+    tokens = []
+    for token in _TOKEN_RE.findall(text.lower()):
+        tokens.append(token)
+        parts = re.split(r"[-./]", token)
+        # Also index the parts, so "CLD-02" is found by "CLD 02" as well.
+        if len(parts) > 1:
+            tokens.extend(part for part in parts if part)
+    return tokens
+
+
+class LexicalIndex:
+    """
+    Okapi BM25 over chunks, keyed by the same docstore ids FAISS uses. The
+    postings live in memory and are persisted as JSON next to the flat index.
+    """
+
+    def __init__(self, k1=1.2, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self.postings = {}
+        self.doc_len = {}
+        self._total_len = 0
+
+    def __len__(self):
+        return len(self.doc_len)
+
+    def add(self, ids, texts):
+        for doc_id, text in zip(ids, texts):
+            if doc_id in self.doc_len:
+                self.remove([doc_id])
+            counts = Counter(tokenize(text))
+            for term, tf in counts.items():
+                self.postings.setdefault(term, {})[doc_id] = tf
+            length = sum(counts.values())
+            self.doc_len[doc_id] = length
+            self._total_len += length
+
+    def remove(self, ids):
+        ids = [doc_id for doc_id in ids if doc_id in self.doc_len]
+        if not ids:
+            return
+        removed = set(ids)
+        for doc_id in ids:
+            self._total_len -= self.doc_len.pop(doc_id)
+        for term in list(self.postings):
+            postings = self.postings[term]
+            for doc_id in removed.intersection(postings):
+                del postings[doc_id]
+            if not postings:
+                del self.postings[term]
+
+    def search(self, query, k=4):
+        """Returns up to k (doc_id, score) pairs, best first; no hits returns []."""
+        if not self.doc_len:
+            return []
+        n = len(self.doc_len)
+        avg_len = self._total_len / n
+        scores = {}
+        for term in set(tokenize(query)):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (n - len(postings) + 0.5) / (len(postings) + 0.5))
+            for doc_id, tf in postings.items():
+                norm = self.k1 * (1 - self.b + self.b * self.doc_len[doc_id] / avg_len)
+                scores[doc_id] = scores.get(doc_id, 0.0) + idf * tf * (self.k1 + 1) / (tf + norm)
+        return heapq.nlargest(k, scores.items(), key=lambda item: item[1])
+
+    def save(self, index_path):
+        path = os.path.join(index_path, LEXICAL_INDEX_FILE)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"k1": self.k1, "b": self.b, "doc_len": self.doc_len, "postings": self.postings}, f)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, index_path):
+        """The saved index, or an empty one if there is none (or it is unreadable)."""
+        path = os.path.join(index_path, LEXICAL_INDEX_FILE)
+        index = cls()
+        if os.path.exists(path):
+            try:
+                with open(path, "r") as f:
+                    data = json.load(f)
+                index = cls(data["k1"], data["b"])
+                index.postings = data["postings"]
+                index.doc_len = data["doc_len"]
+                index._total_len = sum(index.doc_len.values())
+            except Exception:
+                index = cls()
+        return index
+
+    @classmethod
+    def merge(cls, indexes):
+        """One index over the chunks of several (the shards of a sharded index); their ids must not overlap."""
+        merged = cls(indexes[0].k1, indexes[0].b) if indexes else cls()
+        for index in indexes:
+            for term, postings in index.postings.items():
+                merged.postings.setdefault(term, {}).update(postings)
+            merged.doc_len.update(index.doc_len)
+            merged._total_len += index._total_len
+        return merged
+
+
+def sync_lexical_index(vector_store, index_path, save=True):
+    """
+    Makes the saved lexical index hold exactly the chunks in vector_store:
+    chunks deleted from FAISS are dropped and only new ones are tokenized
+    (chunks missing from the docstore are left out). With save=False the
+    result is only returned, as readers must; index_path None starts from
+    an empty index.
+    """
+    index = LexicalIndex.load(index_path) if index_path else LexicalIndex()
+    current = set(vector_store.index_to_docstore_id.values())
+    index.remove([doc_id for doc_id in index.doc_len if doc_id not in current])
+    new_ids = [doc_id for doc_id in vector_store.index_to_docstore_id.values() if doc_id not in index.doc_len]
+    docstore = vector_store.docstore
+    # An index not yet converted from index.pkl has an InMemoryDocstore, which only has search().
+    docs = docstore.mget(new_ids) if hasattr(docstore, "mget") else [docstore.search(doc_id) for doc_id in new_ids]
+    found = [(doc_id, doc) for doc_id, doc in zip(new_ids, docs) if hasattr(doc, "page_content")]
+    index.add([doc_id for doc_id, _ in found], [doc.page_content for _, doc in found])
+    if save:
+        index.save(index_path)
+    return index
@@ -0,0 +1,238 @@
+# In-process timing spans, counters and latency histograms, exported as Prometheus text or JSON.
+import atexit
+import json
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+METRICS_PREFIX = "docuwhisperer"
+# Serve /metrics (Prometheus text) and /metrics.json on this port; 0 = off.
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "0"))
+# 0.0.0.0 lets a Prometheus outside the container scrape it.
+METRICS_HOST = os.environ.get("METRICS_HOST", "127.0.0.1")
+# Write all metrics here when the process exits (.json for JSON, anything else Prometheus text).
+METRICS_FILE = os.environ.get("METRICS_FILE", "")
+# Upper bounds in seconds; they span a BM25 lookup up to a whole-corpus re-index.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+# Recent observations kept per histogram for the percentiles in the JSON and debug views.
+RECENT_SAMPLES = 1024
+
+
+def _key(name, labels):
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+class _Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.recent = deque(maxlen=RECENT_SAMPLES)
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.count += 1
+        self.sum += value
+        self.recent.append(value)
+
+    def percentile(self, q):
+        if not self.recent:
+            return None
+        ordered = sorted(self.recent)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class MetricsRegistry:
+    """
+    Counters and histograms keyed by name and labels. Every stage of the
+    pipeline records into the module-level REGISTRY through span(), count()
+    and observe(); parser worker processes send theirs back with drain().
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+
+    def count(self, name, amount=1, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = _Histogram()
+            histogram.observe(value)
+
+    @contextmanager
+    def span(self, stage, **labels):
+        """Times the block into the stage_seconds histogram, labelled stage=<stage>."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe("stage_seconds", time.perf_counter() - started, stage=stage, **labels)
+
+    def snapshot(self):
+        """Plain-data copy of everything recorded, for JSON, merge() and the debug panel."""
+        with self._lock:
+            return {
+                "counters": [{"name": name, "labels": dict(labels), "value": value}
+                             for (name, labels), value in sorted(self.counters.items())],
+                "histograms": [
+                    {"name": name, "labels": dict(labels), "count": h.count, "sum": h.sum,
+                     "buckets": list(zip(h.buckets, h.counts)), "recent": list(h.recent),
+                     "p50": h.percentile(0.5), "p95": h.percentile(0.95), "p99": h.percentile(0.99)}
+                    for (name, labels), h in sorted(self.histograms.items())
+                ],
+            }
+
+    def drain(self):
+        """snapshot() and reset, so a worker process can hand each task's metrics to the parent."""
+        drained = MetricsRegistry()
+        with self._lock:
+            drained.counters, self.counters = self.counters, {}
+            drained.histograms, self.histograms = self.histograms, {}
+        return drained.snapshot()
+
+    def merge(self, snapshot):
+        """Adds a snapshot taken in another process."""
+        if not snapshot:
+            return
+        with self._lock:
+            for counter in snapshot["counters"]:
+                key = _key(counter["name"], counter["labels"])
+                self.counters[key] = self.counters.get(key, 0) + counter["value"]
+            for data in snapshot["histograms"]:
+                key = _key(data["name"], data["labels"])
+                histogram = self.histograms.get(key)
+                if histogram is None:
+                    histogram = self.histograms[key] = _Histogram()
+                for i, (_, count) in enumerate(data["buckets"]):
+                    histogram.counts[i] += count
+                histogram.count += data["count"]
+                histogram.sum += data["sum"]
+                histogram.recent.extend(data["recent"])
+
+    def reset(self):
+        with self._lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+    def to_prometheus(self):
+        """Prometheus text exposition format (counters and cumulative histogram buckets)."""
+        snapshot = self.snapshot()
+        lines = []
+
+        def label_text(labels, extra=None):
+            pairs = list(labels.items()) + list((extra or {}).items())
+            if not pairs:
+                return ""
+            escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+            return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+        typed = set()
+        for counter in snapshot["counters"]:
+            name = f"{METRICS_PREFIX}_{counter['name']}_total"
+            if name not in typed:
+                lines.append(f"# TYPE {name} counter")
+                typed.add(name)
+            lines.append(f"{name}{label_text(counter['labels'])} {counter['value']}")
+        for histogram in snapshot["histograms"]:
+            name = f"{METRICS_PREFIX}_{histogram['name']}"
+            if name not in typed:
+                lines.append(f"# TYPE {name} histogram")
+                typed.add(name)
+            cumulative = 0
+            for bound, count in histogram["buckets"]:
+                cumulative += count
+                lines.append(f"{name}_bucket{label_text(histogram['labels'], {'le': bound})} {cumulative}")
+            lines.append(f"{name}_bucket{label_text(histogram['labels'], {'le': '+Inf'})} {histogram['count']}")
+            lines.append(f"{name}_sum{label_text(histogram['labels'])} {histogram['sum']}")
+            lines.append(f"{name}_count{label_text(histogram['labels'])} {histogram['count']}")
+        return "\n".join(lines) + "\n"
+
+    def to_json(self):
+        snapshot = self.snapshot()
+        for histogram in snapshot["histograms"]:
+            del histogram["recent"]
+        return json.dumps(snapshot, indent=1)
+
+    def stage_table(self):
+        """One row per span stage: count, mean, p50/p95/p99 and total seconds, slowest total first."""
+        rows = []
+        for histogram in self.snapshot()["histograms"]:
+            if histogram["name"] != "stage_seconds" or not histogram["count"]:
+                continue
+            labels = dict(histogram["labels"])
+            stage = labels.pop("stage")
+            if labels:
+                stage += " (" + ", ".join(f"{k}={v}" for k, v in sorted(labels.items())) + ")"
+            rows.append({
+                "stage": stage, "count": histogram["count"], "total_s": histogram["sum"],
+                "mean_ms": histogram["sum"] / histogram["count"] * 1000,
+                "p50_ms": histogram["p50"] * 1000, "p95_ms": histogram["p95"] * 1000,
+                "p99_ms": histogram["p99"] * 1000,
+            })
+        return sorted(rows, key=lambda row: -row["total_s"])
+
+
+REGISTRY = MetricsRegistry()
+span = REGISTRY.span
+count = REGISTRY.count
+observe = REGISTRY.observe
+
+
+def write_metrics(path, registry=REGISTRY):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        f.write(registry.to_json() if path.endswith(".json") else registry.to_prometheus())
+    os.replace(tmp_path, path)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.rstrip("/") == "/metrics.json":
+            body, content_type = self.server.registry.to_json(), "application/json"
+        elif self.path.rstrip("/") in ("", "/metrics"):
+            body, content_type = self.server.registry.to_prometheus(), "text/plain; version=0.0.4"
+        else:
+            self.send_error(404)
+            return
+        data = body.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def start_metrics_server(port=METRICS_PORT, host=METRICS_HOST, registry=REGISTRY):
+    """Serve the registry on host:port from a daemon thread; port 0 picks a free port."""
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    server.daemon_threads = True
+    server.registry = registry
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    return server
+
+
+def start_exporters():
+    """Starts whatever METRICS_PORT / METRICS_FILE ask for. Returns the HTTP server, if any."""
+    if METRICS_FILE:
+        atexit.register(write_metrics, METRICS_FILE)
+    if METRICS_PORT:
+        return start_metrics_server(METRICS_PORT)
+    return None
@@ -0,0 +1,174 @@
+# Parses .docx/.pdf files across a process pool and streams their chunks back in input order.
+import multiprocessing
+import os
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from docx_loader import load_docx_chunks
+from pdf_loader import count_pdf_pages, iter_pdf_chunks, load_pdf_chunks
+import metrics
+
+# 1 parses everything serially in the calling process.
+INGEST_WORKERS = int(os.environ.get("INGEST_WORKERS", os.cpu_count() or 1))
+# PDFs longer than this are split into page ranges parsed by separate workers.
+PDF_PAGES_PER_TASK = int(os.environ.get("PDF_PAGES_PER_TASK", "50"))
+# Parsed chunk text allowed to wait for embedding; parsing pauses when it is full.
+INGEST_BUFFER_MB = float(os.environ.get("INGEST_BUFFER_MB", "64"))
+
+
+def load_file_chunks(path, pages=None):
+    if path.lower().endswith(".docx"):
+        return load_docx_chunks(path)
+    if path.lower().endswith(".pdf"):
+        return load_pdf_chunks(path, pages)
+    return []
+
+
+def _load_task(task):
+    # Runs in a worker: never raise, so one bad file cannot take down the batch.
+    # The worker's parse/split metrics travel back with the result.
+    path, pages = task
+    try:
+        return load_file_chunks(path, pages), None, metrics.REGISTRY.drain()
+    except Exception as e:
+        return [], f"{type(e).__name__}: {e}", metrics.REGISTRY.drain()
+
+
+def iter_serial_parts(path, pages_per_task=PDF_PAGES_PER_TASK):
+    """In-process counterpart of the page-range tasks: one pass over the file, one part per page range."""
+    try:
+        if not path.lower().endswith(".pdf"):
+            yield path, load_file_chunks(path), None, True
+            return
+        # One reader for the whole file; reopening a big PDF per range costs more than parsing it.
+        part, part_end = [], pages_per_task
+        for chunk in iter_pdf_chunks(path):
+            if chunk.metadata["page"] > part_end:
+                yield path, part, None, False
+                part = []
+                part_end = (chunk.metadata["page"] - 1) // pages_per_task * pages_per_task + pages_per_task
+            part.append(chunk)
+        yield path, part, None, True
+    except Exception as e:
+        yield path, [], f"{type(e).__name__}: {e}", True
+
+
+def plan_tasks(paths, pages_per_task=PDF_PAGES_PER_TASK):
+    tasks = []
+    for path in paths:
+        page_count = 0
+        if path.lower().endswith(".pdf"):
+            try:
+                page_count = count_pdf_pages(path)
+            except Exception:
+                # Let the worker hit (and report) the same error.
+                page_count = 0
+        if page_count > pages_per_task:
+            tasks.extend(
+                (path, (start, min(start + pages_per_task, page_count)))
+                for start in range(0, page_count, pages_per_task)
+            )
+        else:
+            tasks.append((path, None))
+    return tasks
+
+
+def iter_file_parts(paths, max_workers=INGEST_WORKERS, pages_per_task=PDF_PAGES_PER_TASK):
+    """
+    Yields (path, chunks, error, last) per task, in the order given: a file
+    arrives as one part, a long PDF as one part per page range. last marks
+    a file's final part. error is None on success; a task that fails does
+    not affect the others. At most two tasks per worker are in flight, so
+    a slow consumer holds the parsers back instead of piling up results.
+    """
+    paths = list(dict.fromkeys(paths))
+    if max_workers <= 1 or not paths:
+        for path in paths:
+            yield from iter_serial_parts(path, pages_per_task)
+        return
+
+    tasks = plan_tasks(paths, pages_per_task)
+    if len(tasks) == 1:
+        yield from iter_serial_parts(paths[0], pages_per_task)
+        return
+    lasts = [i + 1 == len(tasks) or tasks[i + 1][0] != path for i, (path, _) in enumerate(tasks)]
+
+    # Spawned, not forked: this runs on a thread of the app, and a fork would copy locks other threads hold.
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=min(max_workers, len(tasks)), mp_context=context) as pool:
+        pending = deque()
+        submitted = 0
+        while submitted < len(tasks) or pending:
+            while submitted < len(tasks) and len(pending) < 2 * max_workers:
+                pending.append((submitted, pool.submit(_load_task, tasks[submitted])))
+                submitted += 1
+            position, future = pending.popleft()
+            try:
+                chunks, error, task_metrics = future.result()
+                metrics.REGISTRY.merge(task_metrics)
+            except Exception as e:
+                # The worker process itself died (e.g. BrokenProcessPool).
+                chunks, error = [], f"{type(e).__name__}: {e}"
+            yield tasks[position][0], chunks, error, lasts[position]
+
+
+def part_size(part):
+    """Rough in-memory bytes of a parsed part (text plus per-chunk overhead)."""
+    return sum(len(chunk.page_content) + 500 for chunk in part[1])
+
+
+def prefetch(items, max_mb=INGEST_BUFFER_MB, size=part_size):
+    """
+    Runs the items generator in a background thread, so parsing continues
+    while the caller embeds. At most max_mb of items wait in between; the
+    producer blocks when the buffer is full (one oversized item still
+    passes). Exceptions in the producer are re-raised in the caller.
+    """
+    limit = max_mb * 1e6
+    buffer = deque()
+    state = {"bytes": 0, "finished": False, "error": None, "stopped": False}
+    cond = threading.Condition()
+
+    def produce():
+        try:
+            for item in items:
+                item_size = size(item)
+                with cond:
+                    while buffer and state["bytes"] + item_size > limit and not state["stopped"]:
+                        cond.wait()
+                    if state["stopped"]:
+                        break
+                    buffer.append((item, item_size))
+                    state["bytes"] += item_size
+                    cond.notify_all()
+        except BaseException as e:
+            state["error"] = e
+        finally:
+            close = getattr(items, "close", None)
+            if close:
+                close()
+            with cond:
+                state["finished"] = True
+                cond.notify_all()
+
+    thread = threading.Thread(target=produce, name="ingest-prefetch", daemon=True)
+    thread.start()
+    try:
+        while True:
+            with cond:
+                while not buffer and not state["finished"]:
+                    cond.wait()
+                if not buffer:
+                    break
+                item, item_size = buffer.popleft()
+                state["bytes"] -= item_size
+                cond.notify_all()
+            yield item
+        if state["error"] is not None:
+            raise state["error"]
+    finally:
+        with cond:
+            state["stopped"] = True
+            cond.notify_all()
+        thread.join()
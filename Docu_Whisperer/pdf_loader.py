@@ -6,34 +6,55 @@ from pypdf import PdfReader
 from langchain_core.documents import Document
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 
+import metrics
+
+def open_pdf(path):
+    old_stdout = sys.stdout
+    sys.stdout = io.StringIO()
+    try:
+        return PdfReader(path)
+    finally:
+        sys.stdout = old_stdout
+
+def count_pdf_pages(path):
+    return len(open_pdf(path).pages)
+
 class PyPDFLoader:
-    def __init__(self, path):
+    # pages is an optional (start, stop) range so large PDFs can be split across workers.
+    def __init__(self, path, pages=None):
         self.path = path
-    def load(self):
-        old_stdout = sys.stdout
-        sys.stdout = io.StringIO()
-        try:
-            reader = PdfReader(self.path)
-        finally:
-            sys.stdout = old_stdout
-        documents = []
-        for i, page in enumerate(reader.pages):
-            text = page.extract_text()
+        self.pages = pages
+    def lazy_load(self):
+        """Yields one Document per page with text, without holding the whole range."""
+        reader = open_pdf(self.path)
+        start, stop = self.pages or (0, len(reader.pages))
+        for i in range(start, stop):
+            with metrics.span("parse", kind="pdf"):
+                text = reader.pages[i].extract_text()
+            metrics.count("pages_parsed", kind="pdf")
             if text and text.strip():
-                documents.append(Document(
+                yield Document(
                     page_content=text,
                     metadata={"page": i + 1, "doc_name": os.path.basename(self.path)}
-                ))
-        return documents
+                )
+    def load(self):
+        return list(self.lazy_load())
 
-def load_pdf_chunks(path):
-    loader = PyPDFLoader(path)
-    documents = loader.load()
+def iter_pdf_chunks(path, pages=None):
+    """Chunks page by page, so only the current page's text and chunks are in memory."""
     splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
-    chunks = splitter.split_documents(documents)
-    for chunk in chunks:
-        doc_name = os.path.basename(path)
-        page = chunk.metadata.get("page", "N/A")
-        chunk.page_content = f"[{doc_name} - page {page}]\n{chunk.page_content}"
-        chunk.metadata["doc_name"] = doc_name
-    return [chunk for chunk in chunks if chunk.page_content.strip()]
\ No newline at end of file
+    doc_name = os.path.basename(path)
+    for document in PyPDFLoader(path, pages).lazy_load():
+        # Same chunks as splitting the whole list: the splitter never crosses documents.
+        with metrics.span("split", kind="pdf"):
+            chunks = splitter.split_documents([document])
+        metrics.count("chunks_created", len(chunks), kind="pdf")
+        for chunk in chunks:
+            page = chunk.metadata.get("page", "N/A")
+            chunk.page_content = f"[{doc_name} - page {page}]\n{chunk.page_content}"
+            chunk.metadata["doc_name"] = doc_name
+            if chunk.page_content.strip():
+                yield chunk
+
+def load_pdf_chunks(path, pages=None):
+    return list(iter_pdf_chunks(path, pages))
@@ -0,0 +1,126 @@
+# Retrieval and streamed answer generation for the Chat tab.
+import functools
+import time
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.prompts import ChatPromptTemplate
+
+import metrics
+
+RETRIEVAL_K = 2
+RETRIEVAL_MODES = ["vector", "hybrid", "lexical"]
+# Candidates taken from each ranking before fusing them in hybrid mode.
+HYBRID_FETCH_K = 20
+RRF_K = 60
+
+# The prompt RetrievalQA's "stuff" chain used for chat models, so answers read the same as before.
+QA_PROMPT = ChatPromptTemplate.from_messages([
+    ("system",
+     "Use the following pieces of context to answer the user's question.\n"
+     "If you don't know the answer, just say that you don't know, don't try to make up an answer.\n"
+     "----------------\n"
+     "{context}"),
+    ("human", "{question}"),
+])
+
+
+def vector_search_batch(vector_store, query_vectors, k):
+    """Docstore ids of the top k chunks for each of query_vectors, from one FAISS search."""
+    # Straight to the FAISS index, so every hit comes back with its docstore id.
+    with metrics.span("vector_search"):
+        _, indices = vector_store.index.search(np.asarray(query_vectors, dtype=np.float32), k)
+    return [[vector_store.index_to_docstore_id[i] for i in row if i != -1] for row in indices]
+
+
+def vector_search_ids(vector_store, query_vector, k):
+    return vector_search_batch(vector_store, [query_vector], k)[0]
+
+
+def reciprocal_rank_fusion(rankings, k=RRF_K):
+    scores = {}
+    for ranking in rankings:
+        for rank, doc_id in enumerate(ranking):
+            scores[doc_id] = scores.get(doc_id, 0.0) + 1.0 / (k + rank + 1)
+    return sorted(scores, key=scores.get, reverse=True)
+
+
+def retrieve_ids(vector_store, lexical_index, query, query_vector=None, mode="vector", k=RETRIEVAL_K, search=None):
+    """
+    Docstore ids of the top k chunks for query, best first. "vector" is
+    dense search on query_vector, "lexical" is BM25 only and needs no
+    embedding, and "hybrid" fuses both rankings with reciprocal-rank
+    fusion. Lexical search can return fewer than k ids, or none.
+    search(query_vector, k), if given, replaces the dense search (the
+    retrieval service batches it across requests).
+    """
+    metrics.count("retrievals", mode=mode)
+    search = search or functools.partial(vector_search_ids, vector_store)
+    if mode == "lexical":
+        with metrics.span("lexical_search"):
+            ids = [doc_id for doc_id, _ in lexical_index.search(query, k)]
+    elif mode == "hybrid":
+        fetch_k = max(k, HYBRID_FETCH_K)
+        dense = search(query_vector, fetch_k)
+        with metrics.span("lexical_search"):
+            sparse = [doc_id for doc_id, _ in lexical_index.search(query, fetch_k)]
+        ids = reciprocal_rank_fusion([dense, sparse])[:k]
+    else:
+        ids = search(query_vector, k)
+    return ids
+
+
+def fetch_chunks(vector_store, ids):
+    """Documents for ids, in order, skipping any that are gone."""
+    with metrics.span("chunk_fetch"):
+        if hasattr(vector_store.docstore, "mget"):
+            docs = vector_store.docstore.mget(ids)
+        else:
+            docs = [vector_store.docstore.search(doc_id) for doc_id in ids]
+    # A chunk deleted by an update saved after this index was loaded is missing (or a "not found" string).
+    return [doc for doc in docs if isinstance(doc, Document)]
+
+
+def retrieve(vector_store, lexical_index, query, query_vector=None, mode="vector", k=RETRIEVAL_K):
+    """The top k chunks for query; see retrieve_ids for the modes."""
+    return fetch_chunks(vector_store, retrieve_ids(vector_store, lexical_index, query, query_vector, mode, k))
+
+
+def build_messages(query, docs):
+    with metrics.span("prompt_build"):
+        context = "\n\n".join(doc.page_content for doc in docs)
+        messages = QA_PROMPT.format_messages(context=context, question=query)
+    # Imported here: context_packer imports this module.
+    from context_packer import count_tokens
+    # The messages' text in the model's tokenizer; the few tokens of chat framing are left out.
+    metrics.count("llm_prompt_tokens", sum(count_tokens(message.content) for message in messages))
+    return messages
+
+
+def stream_answer(llm, query, docs, timings, started=None):
+    """
+    Yields the answer text piece by piece as the model produces it. Records
+    first_token_s (time to first token) and answer_s (time to the full
+    answer) in timings, both measured from started.
+    """
+    started = started or time.perf_counter()
+    messages = build_messages(query, docs)
+    llm_started = time.perf_counter()
+    pieces, usage = [], None
+    for chunk in llm.stream(messages):
+        # Gateways that report usage while streaming send it on a chunk of its own, often without text.
+        usage = getattr(chunk, "usage_metadata", None) or usage
+        if not chunk.content:
+            continue
+        if "first_token_s" not in timings:
+            timings["first_token_s"] = time.perf_counter() - started
+            metrics.observe("stage_seconds", time.perf_counter() - llm_started, stage="llm_first_token")
+        pieces.append(chunk.content)
+        yield chunk.content
+    timings["answer_s"] = time.perf_counter() - started
+    metrics.observe("stage_seconds", time.perf_counter() - llm_started, stage="llm_answer")
+    if usage and usage.get("output_tokens"):
+        metrics.count("llm_completion_tokens", usage["output_tokens"])
+    else:
+        from context_packer import count_tokens
+        metrics.count("llm_completion_tokens", count_tokens("".join(pieces)))
@@ -0,0 +1,480 @@
+# Retrieval as a shared local service: one loaded index for every app process, questions embedded and searched in micro-batches.
+import argparse
+import base64
+import json
+import os
+import queue
+import random
+import tempfile
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import httpx
+import numpy as np
+from langchain_core.documents import Document
+
+import metrics
+from context_packer import CONTEXT_FETCH_K, CONTEXT_TOKEN_BUDGET, retrieve_context
+from index_log import index_kind, published_version
+from index_manager import FAISS_INDEX_PATH, load_lexical_index, load_search_store
+from lexical_index import LexicalIndex
+from qa import vector_search_batch
+
+# Set in the app's environment (e.g. http://127.0.0.1:8770) to use the service instead of a per-process index.
+RETRIEVAL_SERVICE_URL = os.environ.get("RETRIEVAL_SERVICE_URL", "")
+RETRIEVAL_SERVICE_HOST = os.environ.get("RETRIEVAL_SERVICE_HOST", "127.0.0.1")
+RETRIEVAL_SERVICE_PORT = int(os.environ.get("RETRIEVAL_SERVICE_PORT", "8770"))
+# A batch closes this long after its first question arrives, or when it holds RETRIEVAL_MAX_BATCH questions.
+RETRIEVAL_BATCH_WAIT_MS = float(os.environ.get("RETRIEVAL_BATCH_WAIT_MS", "5"))
+RETRIEVAL_MAX_BATCH = int(os.environ.get("RETRIEVAL_MAX_BATCH", "64"))
+# Embedding calls in flight at once, each carrying a whole batch.
+RETRIEVAL_EMBED_IN_FLIGHT = int(os.environ.get("RETRIEVAL_EMBED_IN_FLIGHT", "4"))
+# Seconds between checks for a newer index on disk (0 = only on POST /reload).
+RETRIEVAL_RELOAD_INTERVAL = float(os.environ.get("RETRIEVAL_RELOAD_INTERVAL", "5"))
+
+
+def encode_vector(vector):
+    # float32 bytes in base64, like the embeddings API: far cheaper than JSON floats.
+    return base64.b64encode(np.asarray(vector, dtype=np.float32).tobytes()).decode("ascii")
+
+
+def decode_vector(text):
+    return np.frombuffer(base64.b64decode(text), dtype=np.float32).tolist()
+
+
+class MicroBatcher:
+    """
+    Collects items submitted from many threads and hands them to fn(items),
+    which returns one result per item. A batch closes max_wait seconds after
+    its first item arrives or once it holds max_batch items; up to workers
+    batches run at once. active(), if given, is how many callers could
+    submit at all: a batch holding that many closes without waiting, so a
+    lone request is not delayed. submit() returns a Future for the item's
+    result.
+    """
+
+    def __init__(self, fn, name, max_wait=RETRIEVAL_BATCH_WAIT_MS / 1000, max_batch=RETRIEVAL_MAX_BATCH, workers=1,
+                 active=None):
+        self.fn = fn
+        self.name = name
+        self.max_wait = max_wait
+        self.max_batch = max_batch
+        self.active = active
+        self._queue = queue.Queue()
+        # One worker gathers at a time, so idle workers don't split a batch between them.
+        self._gather_lock = threading.Lock()
+        for i in range(workers):
+            threading.Thread(target=self._run, name=f"{name}-batcher-{i}", daemon=True).start()
+
+    def submit(self, item):
+        future = Future()
+        self._queue.put((item, future))
+        return future
+
+    def _next_batch(self):
+        with self._gather_lock:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch:
+                if self.active is not None and len(batch) >= self.active() and self._queue.empty():
+                    break
+                remaining = deadline - time.monotonic()
+                try:
+                    # Past the deadline, still take whatever is already waiting.
+                    batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            metrics.count("service_batches", kind=self.name)
+            metrics.count("service_batched_requests", len(batch), kind=self.name)
+            try:
+                results = self.fn([item for item, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            for (_, future), result in zip(batch, results):
+                future.set_result(result)
+
+
+class RetrievalService:
+    """
+    One loaded index (FAISS, chunk store and BM25) shared by all clients.
+    Questions that arrive together are embedded in one embeddings call and
+    searched in one FAISS search; the rest of retrieve_context (lexical
+    search, chunk fetch, MMR, packing) runs per request. A newer index on
+    disk is picked up without a restart, while requests already running
+    finish on the one they started with.
+    """
+
+    def __init__(self, embeddings, index_path=FAISS_INDEX_PATH, max_wait=RETRIEVAL_BATCH_WAIT_MS / 1000,
+                 max_batch=RETRIEVAL_MAX_BATCH, embed_in_flight=RETRIEVAL_EMBED_IN_FLIGHT,
+                 reload_interval=RETRIEVAL_RELOAD_INTERVAL):
+        self.embeddings = embeddings
+        self.index_path = index_path
+        self._reload_lock = threading.Lock()
+        self._current = (None, LexicalIndex(), None)  # (vector store, lexical index, files' mtimes)
+        self._active = 0
+        self._active_lock = threading.Lock()
+        self.reload()
+        active = lambda: self._active
+        self.embedder = MicroBatcher(self._embed_batch, "embed", max_wait, max_batch, embed_in_flight, active)
+        self.searcher = MicroBatcher(self._search_batch, "search", max_wait, max_batch, active=active)
+        if reload_interval:
+            threading.Thread(target=self._watch, args=(reload_interval,), name="index-watcher", daemon=True).start()
+
+    @contextmanager
+    def request(self):
+        """Counts a client request as in progress, so batches know how many questions could still join them."""
+        with self._active_lock:
+            self._active += 1
+        try:
+            yield
+        finally:
+            with self._active_lock:
+                self._active -= 1
+
+    def _stamp(self):
+        # Each save publishes a new version; a sharded index rewrites its manifest.json, a legacy one index.faiss.
+        stamp = [published_version(self.index_path)]
+        for name in ("index.faiss", "manifest.json"):
+            try:
+                stamp.append(os.stat(os.path.join(self.index_path, name)).st_mtime_ns)
+            except FileNotFoundError:
+                stamp.append(None)
+        return tuple(stamp)
+
+    def reload(self):
+        """Loads the index as it is on disk now. Returns its number of vectors."""
+        with self._reload_lock:
+            stamp = self._stamp()
+            vector_store = load_search_store(self.embeddings, self.index_path)
+            lexical_index = load_lexical_index(vector_store, self.index_path)
+            self._current = (vector_store, lexical_index, stamp)
+        metrics.count("service_reloads")
+        return len(vector_store.index_to_docstore_id) if vector_store is not None else 0
+
+    def _watch(self, interval):
+        while True:
+            time.sleep(interval)
+            try:
+                if self._stamp() != self._current[2]:
+                    self.reload()
+            except Exception:
+                # Most likely caught mid-save; the next check tries again.
+                metrics.count("service_reload_errors")
+
+    def _embed_batch(self, queries):
+        with metrics.span("service_embed_batch"):
+            # Questions, not chunks: kept out of the embedding cache and the ingest stats where the embeddings allow.
+            embed = getattr(self.embeddings, "embed_queries", self.embeddings.embed_documents)
+            return embed(queries)
+
+    def _search_batch(self, requests):
+        # (vector store, query vector, k) per request; a reload can leave two stores in one batch.
+        results = [None] * len(requests)
+        groups = {}
+        for position, (vector_store, _, _) in enumerate(requests):
+            groups.setdefault(id(vector_store), []).append(position)
+        for positions in groups.values():
+            vector_store = requests[positions[0]][0]
+            k = max(requests[position][2] for position in positions)
+            rows = vector_search_batch(vector_store, [requests[position][1] for position in positions], k)
+            for position, ids in zip(positions, rows):
+                results[position] = ids[:requests[position][2]]
+        return results
+
+    def stats(self):
+        vector_store, lexical_index, _ = self._current
+        return {
+            "vectors": len(vector_store.index_to_docstore_id) if vector_store is not None else 0,
+            "index": index_kind(vector_store.index) if vector_store is not None else None,
+            "lexical_documents": len(lexical_index),
+        }
+
+    def embed(self, query):
+        """The query's embedding, computed in a batch with any other questions arriving at the same time."""
+        return self.embedder.submit(query).result()
+
+    def retrieve_context(self, query, query_vector=None, mode="vector", fetch_k=CONTEXT_FETCH_K,
+                         budget=CONTEXT_TOKEN_BUDGET):
+        """(passages, query_vector): context_packer.retrieve_context on the shared index, dense search batched."""
+        vector_store, lexical_index, _ = self._current
+        if vector_store is None:
+            return [], query_vector
+        if query_vector is None and mode != "lexical":
+            query_vector = self.embed(query)
+
+        def search(vector, k):
+            return self.searcher.submit((vector_store, vector, k)).result()
+
+        with metrics.span("service_context"):
+            passages = retrieve_context(vector_store, lexical_index, query, query_vector, mode, fetch_k, budget, search)
+        return passages, query_vector
+
+
+class RetrievalHandler(BaseHTTPRequestHandler):
+    server_version = "DocuWhispererRetrieval/1.0"
+
+    def log_message(self, *args):
+        pass
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/health":
+            self._send_json(200, self.server.service.stats())
+        else:
+            self._send_json(404, {"error": f"Unknown path {self.path}"})
+
+    def do_POST(self):
+        service = self.server.service
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length) or b"{}")
+            if self.path == "/embed":
+                with service.request():
+                    vector = service.embed(request["query"])
+                self._send_json(200, {"vector": encode_vector(vector)})
+            elif self.path == "/context":
+                vector = request.get("vector")
+                with service.request():
+                    passages, vector = service.retrieve_context(
+                        request["query"], decode_vector(vector) if vector else None, request.get("mode", "vector"),
+                        request.get("fetch_k", CONTEXT_FETCH_K), request.get("budget", CONTEXT_TOKEN_BUDGET),
+                    )
+                self._send_json(200, {
+                    "passages": [{"id": doc.id, "page_content": doc.page_content, "metadata": doc.metadata}
+                                 for doc in passages],
+                    "vector": encode_vector(vector) if vector is not None else None,
+                })
+            elif self.path == "/reload":
+                self._send_json(200, {"vectors": service.reload()})
+            else:
+                self._send_json(404, {"error": f"Unknown path {self.path}"})
+        except (KeyError, ValueError) as e:
+            self._send_json(400, {"error": f"{type(e).__name__}: {e}"})
+        except Exception as e:
+            self._send_json(500, {"error": f"{type(e).__name__}: {e}"})
+
+
+class RetrievalServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # Many sessions connect at once; past the default listen backlog of 5, connections are reset.
+    request_queue_size = 128
+
+
+def start_service(service, port=RETRIEVAL_SERVICE_PORT, host=RETRIEVAL_SERVICE_HOST):
+    """Serves service over HTTP on a daemon thread; port 0 picks a free port (see server.server_port)."""
+    server = RetrievalServer((host, port), RetrievalHandler)
+    server.service = service
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class RetrievalClient:
+    """The app's side of the service: the same embed and retrieve_context calls, answered by the shared index."""
+
+    def __init__(self, url=RETRIEVAL_SERVICE_URL, timeout=60):
+        self.url = url.rstrip("/")
+        self._http = httpx.Client(timeout=timeout)
+
+    def _post(self, path, payload):
+        response = self._http.post(self.url + path, json=payload)
+        if response.status_code != 200:
+            raise RuntimeError(f"Retrieval service {path}: {response.json().get('error', response.status_code)}")
+        return response.json()
+
+    def health(self):
+        response = self._http.get(self.url + "/health")
+        response.raise_for_status()
+        return response.json()
+
+    def embed(self, query):
+        return decode_vector(self._post("/embed", {"query": query})["vector"])
+
+    def retrieve_context(self, query, query_vector=None, mode="vector", fetch_k=CONTEXT_FETCH_K,
+                         budget=CONTEXT_TOKEN_BUDGET):
+        payload = {"query": query, "mode": mode, "fetch_k": fetch_k, "budget": budget}
+        if query_vector is not None:
+            payload["vector"] = encode_vector(query_vector)
+        passages = self._post("/context", payload)["passages"]
+        return [Document(id=p["id"], page_content=p["page_content"], metadata=p["metadata"]) for p in passages]
+
+    def reload(self):
+        return self._post("/reload", {})["vectors"]
+
+
+# ---------- load test ----------
+
+def _percentiles(samples):
+    ms = np.array(samples) * 1000
+    return {"p50_ms": float(np.percentile(ms, 50)), "p95_ms": float(np.percentile(ms, 95)),
+            "p99_ms": float(np.percentile(ms, 99))}
+
+
+def _drive(ask, questions, clients):
+    """Sends questions from clients threads at once, each asking its next one as soon as the last is answered."""
+    pending = queue.Queue()
+    for question in questions:
+        pending.put(question)
+    latencies, errors, lock = [], [], threading.Lock()
+
+    def client():
+        while True:
+            try:
+                question = pending.get_nowait()
+            except queue.Empty:
+                return
+            started = time.perf_counter()
+            try:
+                ask(question)
+            except Exception as e:
+                with lock:
+                    errors.append(f"{type(e).__name__}: {e}")
+                continue
+            with lock:
+                latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds = time.perf_counter() - started
+    result = {"questions": len(latencies), "errors": len(errors), "seconds": seconds,
+              "qps": len(latencies) / seconds, **(_percentiles(latencies) if latencies else {})}
+    if errors:
+        result["first_error"] = errors[0]
+    return result
+
+
+def load_test(args):
+    """
+    QPS and latency of concurrent questions (embedding + retrieve_context)
+    answered in-process, as each Streamlit process does today, and through
+    the service, both against the fake embeddings API.
+    """
+    from langchain_openai import OpenAIEmbeddings
+
+    from benchmark import build_index, seed_vocabulary, synthetic_chunks
+    from embedding_scheduler import ScheduledEmbeddings
+    from fake_openai import FakeEmbeddings, start_server
+
+    api = start_server(latency=args.latency, max_rps=args.max_rps)
+    embeddings = ScheduledEmbeddings(
+        OpenAIEmbeddings(model="text-embedding-ada-002_v2", openai_api_base=f"http://127.0.0.1:{api.server_port}/v1",
+                         api_key="fake", max_retries=0, check_embedding_ctx_length=False),
+        base_delay=0.1,
+    )
+    rng = random.Random(args.seed)
+    vocabulary = seed_vocabulary()
+    index_path = args.index
+    workdir = None
+    if not index_path:
+        workdir = tempfile.TemporaryDirectory(prefix="docuwhisperer-loadtest-")
+        index_path = os.path.join(workdir.name, "index")
+        print(f"building a {args.chunks}-chunk index...", flush=True)
+        build_index(FakeEmbeddings(), 1536, index_path, synthetic_chunks(rng, vocabulary, args.chunks))
+
+    def questions():
+        # Never repeated, so no cache along the way can answer one.
+        return [f"{i} " + " ".join(rng.choice(vocabulary) for _ in range(rng.randint(3, 8)))
+                for i in range(args.questions)]
+
+    results = {"chunks": None, "clients": args.clients, "mode": args.mode, "api_latency_s": args.latency,
+               "api_max_rps": args.max_rps}
+    paths = [path for path in args.paths.split(",") if path]
+    if "in-process" in paths:
+        vector_store = load_search_store(embeddings, index_path)
+        lexical_index = load_lexical_index(vector_store, index_path)
+        results["chunks"] = len(vector_store.index_to_docstore_id)
+
+        def ask(question):
+            vector = embeddings.embed_query(question)
+            retrieve_context(vector_store, lexical_index, question, vector, args.mode)
+
+        before = dict(api.stats)
+        results["in-process"] = _drive(ask, questions(), args.clients)
+        results["in-process"].update({key: api.stats[key] - before[key] for key in ("requests", "rate_limited")})
+        vector_store.docstore.close()
+    if "service" in paths:
+        service = RetrievalService(embeddings, index_path, args.wait_ms / 1000, args.max_batch, reload_interval=0)
+        server = start_service(service, port=0)
+        client = RetrievalClient(f"http://127.0.0.1:{server.server_port}")
+        results["chunks"] = client.health()["vectors"]
+
+        def ask(question):
+            client.retrieve_context(question, client.embed(question), args.mode)
+
+        before = dict(api.stats)
+        metrics.REGISTRY.reset()
+        results["service"] = _drive(ask, questions(), args.clients)
+        results["service"].update({key: api.stats[key] - before[key] for key in ("requests", "rate_limited")})
+        counters = {(c["name"], c["labels"].get("kind")): c["value"] for c in metrics.REGISTRY.snapshot()["counters"]}
+        for kind in ("embed", "search"):
+            batches = counters.get(("service_batches", kind), 0)
+            results["service"][f"mean_{kind}_batch"] = (
+                counters.get(("service_batched_requests", kind), 0) / batches if batches else 0.0)
+        server.shutdown()
+    api.shutdown()
+    if workdir:
+        workdir.cleanup()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Shared retrieval service: one loaded index for many app processes.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    serve = commands.add_parser("serve", help="serve the index (the app uses it when RETRIEVAL_SERVICE_URL is set)")
+    serve.add_argument("--index", default=FAISS_INDEX_PATH)
+    serve.add_argument("--host", default=RETRIEVAL_SERVICE_HOST)
+    serve.add_argument("--port", type=int, default=RETRIEVAL_SERVICE_PORT)
+    test = commands.add_parser("loadtest", help="compare in-process retrieval with the service under concurrent load")
+    test.add_argument("--index", help="existing index to query (default: build a synthetic one)")
+    test.add_argument("--chunks", type=int, default=10000, help="size of the synthetic index")
+    test.add_argument("--clients", type=int, default=16, help="concurrent users")
+    test.add_argument("--questions", type=int, default=800, help="questions per path")
+    test.add_argument("--mode", choices=["vector", "hybrid", "lexical"], default="hybrid")
+    test.add_argument("--latency", type=float, default=0.05, help="fake embeddings API latency per request (s)")
+    test.add_argument("--max-rps", type=float, default=0, help="fake API requests/s before it answers 429")
+    test.add_argument("--wait-ms", type=float, default=RETRIEVAL_BATCH_WAIT_MS, help="batching window")
+    test.add_argument("--max-batch", type=int, default=RETRIEVAL_MAX_BATCH)
+    test.add_argument("--paths", default="in-process,service")
+    test.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if args.command == "loadtest":
+        print(json.dumps(load_test(args), indent=1))
+        return
+
+    from env_setup import API_BASE_URL, get_api_key, make_embeddings, setup_environment
+
+    setup_environment()
+    metrics.start_exporters()
+    service = RetrievalService(make_embeddings(get_api_key(), API_BASE_URL), args.index)
+    server = start_service(service, args.port, args.host)
+    print(f"Retrieval service on http://{args.host}:{server.server_port} ({service.stats()['vectors']} vectors)")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
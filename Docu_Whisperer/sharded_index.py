@@ -0,0 +1,310 @@
+# Sharded index layout: one FAISS index + chunk store per shard, searched in parallel and updated or dropped per shard.
+import argparse
+import hashlib
+import os
+import re
+import shutil
+import tempfile
+import time
+from urllib.parse import urlparse
+
+import faiss
+import numpy as np
+from langchain_community.docstore.base import Docstore
+from langchain_community.vectorstores import FAISS
+
+import metrics
+from ann_index import synthetic_vectors
+from chunk_store import ChunkStore
+from dedup import backfill_fingerprints
+from index_log import FAISS_SEARCH_THREADS, SHARDS_DIR, MultiIndex
+from index_manager import (add_planned, delete_chunks, load_search_store, load_vector_store, open_vector_store,
+                           plan_chunks, save_manifest)
+
+# "source" gives every file, and every web site, a shard of its own; "size" fills shards of
+# FAISS_SHARD_SIZE vectors one after the other. Read when an index is created: an existing
+# index keeps the layout it was built with until `cli.py index build` rebuilds it.
+FAISS_SHARD_BY = os.environ.get("FAISS_SHARD_BY", "none")
+SHARD_MODES = ["none", "source", "size"]
+FAISS_SHARD_SIZE = int(os.environ.get("FAISS_SHARD_SIZE", "50000"))
+
+_UNSAFE_RE = re.compile(r"[^A-Za-z0-9._-]+")
+
+
+def shard_path(index_path, name):
+    return os.path.join(index_path, SHARDS_DIR, name)
+
+
+def source_shard(key):
+    """The shard of a file or web page in "source" mode: the file's own, or its web site's."""
+    if key.startswith(("http://", "https://")):
+        key = urlparse(key).netloc.lower()
+        label = f"web-{key}"
+    else:
+        label = f"file-{os.path.basename(key)}"
+    # The hash keeps apart files with the same name in different folders.
+    return f"{_UNSAFE_RE.sub('_', label)[:48]}-{hashlib.sha1(key.encode('utf-8')).hexdigest()[:8]}"
+
+
+def shard_names(manifest):
+    return sorted({entry["shard"] for entry in manifest["sources"].values() if entry.get("shard")})
+
+
+class ShardedIndex:
+    """
+    Stands in for the vector store in index_manager's update functions
+    when the index is sharded: index_chunks, delete_chunks and
+    save_vector_store hand their work to it, and it passes each call on to
+    the shards involved, opening them on first use. Only those shards are
+    written on save. Removing the last source of a shard deletes the
+    shard's directory without opening it.
+
+    Duplicate chunks are only linked within a shard.
+    """
+
+    sharded = True
+
+    def __init__(self, embeddings, index_path, manifest):
+        self.embeddings = embeddings
+        self.index_path = index_path
+        self.manifest = manifest
+        self.by = manifest["shard_by"]
+        if self.by not in SHARD_MODES[1:]:
+            raise ValueError(f"Unknown FAISS_SHARD_BY {self.by!r}; expected one of {', '.join(SHARD_MODES)}")
+        self.size = manifest.setdefault("shard_size", FAISS_SHARD_SIZE) if self.by == "size" else None
+        self.stores = {}  # shard -> vector store (None until its first chunk), for shards opened here
+        self.assigned = {}  # source key -> shard, for sources added here
+        self.dropped = set()
+        self._sizes = None
+
+    def _shard_of(self, key):
+        return self.assigned.get(key) or self.manifest["sources"].get(key, {}).get("shard")
+
+    def _has_sources(self, name):
+        return any(self._shard_of(key) == name for key in self.manifest["sources"])
+
+    def _open_shard(self):
+        """In "size" mode: the newest shard while it has room, else a new one."""
+        if self._sizes is None:
+            self._sizes = {}
+            for key, entry in self.manifest["sources"].items():
+                name = self._shard_of(key)
+                if name:
+                    self._sizes[name] = self._sizes.get(name, 0) + len(entry["ids"])
+        newest = max(self._sizes, default=None)
+        if newest is None or self._sizes[newest] >= self.size:
+            newest = f"{int(newest) + 1 if newest else 0:04d}"
+            self._sizes[newest] = 0
+        return newest
+
+    def shard_for(self, key):
+        """The shard source key is (or goes) in; a source stays in its shard when it is updated."""
+        name = self._shard_of(key)
+        if name is None:
+            name = source_shard(key) if self.by == "source" else self._open_shard()
+        self.assigned[key] = name
+        return name
+
+    def store(self, name):
+        """The vector store of shard name, loaded on first use; None for a shard with nothing in it yet."""
+        if name not in self.stores:
+            vector_store = None
+            # A directory no source refers to is left over from an update that never saved; it is overwritten.
+            if name not in self.dropped and self._has_sources(name):
+                vector_store = open_vector_store(self.embeddings, shard_path(self.index_path, name))
+                if vector_store is not None:
+                    backfill_fingerprints(vector_store.docstore)
+            self.dropped.discard(name)
+            self.stores[name] = vector_store
+        return self.stores[name]
+
+    def index_chunks(self, embeddings, batches):
+        groups = {}
+        for key, ids, chunks in batches:
+            name = self.shard_for(key)
+            groups.setdefault(name, []).append((key, ids, chunks))
+            # Counted as each source is routed, so the next one sees the shard fill up.
+            if self._sizes is not None:
+                self._sizes[name] = self._sizes.get(name, 0) + len(ids)
+        plans = {name: plan_chunks(self.store(name), group) for name, group in groups.items()}
+        # One embeddings call for all shards, so the scheduler still gets one large batch to split up.
+        texts = [plan[1][i].page_content for plan in plans.values() for i in plan[4]]
+        vectors = embeddings.embed_documents(texts) if texts else []
+        start, linked = 0, 0
+        for name, plan in plans.items():
+            end = start + len(plan[4])
+            self.stores[name] = add_planned(self.stores[name], embeddings, plan, vectors[start:end],
+                                            shard_path(self.index_path, name))
+            start, linked = end, linked + len(plan[3])
+        return self, linked
+
+    def delete_chunks(self, ids, shard=None):
+        if shard is not None and shard not in self.stores and not self._has_sources(shard):
+            # Its last source is gone: the whole shard goes on save, without reading it.
+            self.dropped.add(shard)
+            return self
+        for name in [shard] if shard is not None else list(self.stores):
+            if self.store(name) is not None:
+                self.stores[name] = delete_chunks(self.stores[name], ids)
+        return self
+
+    def save(self, manifest):
+        """
+        Writes the shards changed here, then the manifest, and only then
+        deletes dropped shards, so a crash in between leaves a stray
+        directory rather than a manifest pointing at a missing shard.
+        """
+        for key, entry in manifest["sources"].items():
+            if key in self.assigned:
+                entry["shard"] = self.assigned[key]
+        live = set(shard_names(manifest))
+        self.dropped.update(name for name in self.stores if name not in live)
+        for name, vector_store in self.stores.items():
+            if name not in self.dropped and vector_store is not None:
+                vector_store.publish()
+                metrics.count("shards_written")
+        save_manifest(manifest, self.index_path)
+
+        shards_dir = os.path.join(self.index_path, SHARDS_DIR)
+        stray = set(os.listdir(shards_dir)) - live if os.path.isdir(shards_dir) else set()
+        removed = self.dropped | stray
+        for name in removed:
+            vector_store = self.stores.pop(name, None)
+            if vector_store is not None and isinstance(vector_store.docstore, ChunkStore):
+                vector_store.docstore.close()
+            shutil.rmtree(shard_path(self.index_path, name), ignore_errors=True)
+            if self._sizes is not None:
+                self._sizes.pop(name, None)
+        if removed:
+            metrics.count("shards_dropped", len(removed))
+        self.dropped.clear()
+
+
+class ShardedDocstore(Docstore):
+    """The shards' chunk stores as one read-only docstore; each lookup goes to the shard that holds the id."""
+
+    def __init__(self, stores, shard_of_id):
+        self.stores = stores
+        self._shard_of_id = shard_of_id
+
+    def __len__(self):
+        return sum(len(store) for store in self.stores)
+
+    def search(self, search):
+        doc = self.mget([search])[0]
+        return doc if doc is not None else f"ID {search} not found."
+
+    def mget(self, ids):
+        """Documents for ids, in order; None for ids that are not stored."""
+        wanted = {}
+        for position, doc_id in enumerate(ids):
+            shard = self._shard_of_id.get(doc_id)
+            if shard is not None:
+                wanted.setdefault(shard, []).append(position)
+        docs = [None] * len(ids)
+        for shard, positions in wanted.items():
+            for position, doc in zip(positions, self.stores[shard].mget([ids[p] for p in positions])):
+                docs[position] = doc
+        return docs
+
+    def alias_count(self):
+        return sum(store.alias_count() for store in self.stores)
+
+    def close(self):
+        for store in self.stores:
+            store.close()
+
+
+def load_sharded_store(embeddings, index_path, manifest, mmap=False, search=False):
+    """
+    The shards of index_path as one read-only vector store, or None if it
+    has none. search=True searches each shard's IVF/HNSW index where it
+    has an up-to-date one (see load_search_store). .shards holds the
+    shards' own stores by directory.
+    """
+    loader = load_search_store if search else load_vector_store
+    shards = {}
+    for name in shard_names(manifest):
+        path = shard_path(index_path, name)
+        vector_store = loader(embeddings, path, mmap)
+        if vector_store is not None and vector_store.index_to_docstore_id:
+            shards[path] = vector_store
+    if not shards:
+        return None
+    stores = list(shards.values())
+    index = MultiIndex([store.index for store in stores],
+                       [getattr(store, "flat_index", store.index) for store in stores])
+    index_to_docstore_id, shard_of_id = {}, {}
+    for shard, store in enumerate(stores):
+        offset = int(index.offsets[shard])
+        for position, doc_id in store.index_to_docstore_id.items():
+            index_to_docstore_id[offset + position] = doc_id
+            shard_of_id[doc_id] = shard
+    vector_store = FAISS(embeddings, index, ShardedDocstore([store.docstore for store in stores], shard_of_id),
+                         index_to_docstore_id)
+    vector_store.flat_index = index
+    vector_store.shards = shards
+    return vector_store
+
+
+def _latency_ms(index, queries, k):
+    latencies = []
+    for query in queries:
+        started = time.perf_counter()
+        index.search(query[None, :], k)
+        latencies.append(time.perf_counter() - started)
+    latencies = np.array(latencies) * 1000
+    return float(latencies.mean()), float(np.percentile(latencies, 95))
+
+
+def main():
+    """Single-query latency of one flat index against the same vectors in shards, and the cost of removing a shard's worth."""
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument("--synthetic", type=int, default=200000, help="corpus size")
+    parser.add_argument("--dim", type=int, default=1536)
+    parser.add_argument("--shards", type=int, default=8)
+    parser.add_argument("--threads", default=f"1,{FAISS_SEARCH_THREADS}", help="fan-out threads to try")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("-k", type=int, default=10)
+    args = parser.parse_args()
+
+    vectors = synthetic_vectors(args.synthetic, args.dim)
+    n = len(vectors)
+    queries = vectors[np.random.default_rng(1).choice(n, args.queries, replace=False)]
+    flat = faiss.IndexFlatL2(args.dim)
+    flat.add(vectors)
+    bounds = np.linspace(0, n, args.shards + 1).astype(int)
+    parts = []
+    for start, end in zip(bounds, bounds[1:]):
+        part = faiss.IndexFlatL2(args.dim)
+        part.add(vectors[start:end])
+        parts.append(part)
+    _, truth = flat.search(queries, args.k)
+
+    print(f"{n} vectors x {args.dim} dims, {args.queries} queries, k={args.k}, {os.cpu_count()} CPUs\n")
+    print(f"{'search':<28}{'mean ms':>9}{'p95 ms':>8}{'same top k':>12}")
+    mean_ms, p95_ms = _latency_ms(flat, queries, args.k)
+    print(f"{'one flat index':<28}{mean_ms:>9.2f}{p95_ms:>8.2f}{'':>12}", flush=True)
+    for threads in sorted({int(value) for value in args.threads.split(",")}):
+        sharded = MultiIndex(parts, parts, threads)
+        _, found = sharded.search(queries, args.k)
+        mean_ms, p95_ms = _latency_ms(sharded, queries, args.k)
+        label = f"{args.shards} shards, {threads} thread{'s' if threads > 1 else ''}"
+        print(f"{label:<28}{mean_ms:>9.2f}{p95_ms:>8.2f}{np.mean(found == truth):>12.3f}", flush=True)
+
+    # Removing one shard's worth of vectors: delete them from one index and rewrite it, or drop the shard.
+    with tempfile.TemporaryDirectory() as tmp:
+        started = time.perf_counter()
+        flat.remove_ids(np.arange(bounds[0], bounds[1], dtype=np.int64))
+        faiss.write_index(flat, os.path.join(tmp, "index.faiss"))
+        rewrite_s = time.perf_counter() - started
+        os.makedirs(os.path.join(tmp, "shard"))
+        faiss.write_index(parts[0], os.path.join(tmp, "shard", "index.faiss"))
+        started = time.perf_counter()
+        shutil.rmtree(os.path.join(tmp, "shard"))
+        drop_s = time.perf_counter() - started
+    print(f"\nremove {bounds[1]} vectors: delete + rewrite {rewrite_s * 1000:.0f} ms, drop shard {drop_s * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
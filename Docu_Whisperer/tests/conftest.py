@@ -0,0 +1,23 @@
+# Shared pytest setup: the app's modules live one level up, and tests use the documents in data/.
+import os
+import shutil
+import sys
+
+import pytest
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, APP_DIR)
+
+SAMPLE_DOCX = "Group-Cloud-Policy_28388.docx"
+SAMPLE_PDF = "Vulnerablity Scanning - Technical Scope V1.pdf"
+
+
+@pytest.fixture
+def sample_docs(tmp_path):
+    """Copies of one .docx and one .pdf from data/, as (docx path, pdf path)."""
+    paths = []
+    for name in (SAMPLE_DOCX, SAMPLE_PDF):
+        path = tmp_path / name
+        shutil.copy(os.path.join(APP_DIR, "data", name), path)
+        paths.append(str(path))
+    return tuple(paths)
@@ -0,0 +1,102 @@
+import numpy as np
+import pytest
+from langchain_core.embeddings import Embeddings
+from langchain_openai import OpenAIEmbeddings
+
+from embedding_scheduler import AdaptiveLimiter, ScheduledEmbeddings, make_batches
+from fake_openai import fake_vector, start_server
+
+DIM = 16
+
+
+@pytest.fixture
+def server():
+    """The fake API, answering the first three requests 429."""
+    server = start_server(dimensions=DIM, reject_first=3)
+    yield server
+    server.shutdown()
+
+
+def _client(server):
+    return OpenAIEmbeddings(model="text-embedding-ada-002_v2", openai_api_base=f"http://127.0.0.1:{server.server_port}/v1",
+                            api_key="fake", max_retries=0, check_embedding_ctx_length=False)
+
+
+class FlakyEmbeddings(Embeddings):
+    """Raises a non-rate-limit error on the first `failures` calls."""
+
+    def __init__(self, failures):
+        self.failures = failures
+
+    def embed_documents(self, texts):
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError("connection reset")
+        return [fake_vector(text, DIM) for text in texts]
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+
+def test_make_batches_respects_token_and_size_limits():
+    assert make_batches([5, 5, 5, 20, 1, 1, 1], max_tokens=10, max_size=2) == [[0, 1], [2], [3], [4, 5], [6]]
+    # A text over the token limit still gets a batch of its own.
+    assert make_batches([50, 1], max_tokens=10, max_size=8) == [[0], [1]]
+
+
+def test_limiter_halves_on_rate_limit_and_recovers():
+    limiter = AdaptiveLimiter(8, recover_after=2)
+    for expected in (4, 2, 1, 1):
+        limiter.on_rate_limit()
+        assert limiter.limit == expected
+    limiter.on_success()
+    assert limiter.limit == 1
+    limiter.on_success()
+    assert limiter.limit == 2
+
+
+def test_rate_limited_batches_are_retried(server):
+    scheduled = ScheduledEmbeddings(_client(server), max_batch_size=4, max_in_flight=4, base_delay=0.01)
+    texts = [f"chunk {i}" for i in range(20)]
+
+    vectors = scheduled.embed_documents(texts)
+
+    assert np.allclose(vectors, [fake_vector(text, DIM) for text in texts], atol=1e-6)
+    assert server.stats["rate_limited"] == 3
+    assert scheduled.last_run["chunks"] == 20
+    assert scheduled.last_run["batches"] == 5
+    assert scheduled.last_run["rate_limited"] == 3
+    assert scheduled.last_run["retries"] == 3
+    assert scheduled.limiter.limit < 4
+
+
+def test_retries_are_counted_per_call(server):
+    scheduled = ScheduledEmbeddings(_client(server), max_batch_size=4, base_delay=0.01)
+    scheduled.embed_documents(["a", "b"])
+    assert scheduled.last_run["rate_limited"] == 3
+
+    scheduled.embed_documents(["c", "d"])
+    assert scheduled.last_run["retries"] == 0
+    assert scheduled.last_run["rate_limited"] == 0
+
+
+def test_other_errors_are_retried_but_not_counted_as_rate_limits():
+    scheduled = ScheduledEmbeddings(FlakyEmbeddings(2), base_delay=0.01)
+    scheduled.embed_documents(["a"])
+    assert scheduled.last_run["retries"] == 2
+    assert scheduled.last_run["rate_limited"] == 0
+    assert scheduled.limiter.limit == scheduled.limiter.max_in_flight
+
+    with pytest.raises(ConnectionError):
+        ScheduledEmbeddings(FlakyEmbeddings(5), max_retries=2, base_delay=0.01).embed_documents(["a"])
+
+
+def test_questions_leave_the_last_ingest_alone(server):
+    scheduled = ScheduledEmbeddings(_client(server), base_delay=0.01)
+    scheduled.embed_documents(["a", "b", "c"])
+    last_run = scheduled.last_run
+
+    scheduled.embed_query("question")
+    scheduled.embed_queries(["question one", "question two"])
+
+    assert scheduled.last_run is last_run
@@ -0,0 +1,252 @@
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+import numpy as np
+import pytest
+from langchain_community.vectorstores import FAISS
+from langchain_core.documents import Document
+
+from conftest import APP_DIR
+from fake_openai import FakeEmbeddings, fake_vector
+from index_log import IndexWriter, compact, load_published, published_sources, wait_for_compaction, writer_lock
+from index_manager import load_vector_store, open_vector_store
+
+DIM = 8
+EMBEDDINGS = FakeEmbeddings(DIM)
+
+
+@pytest.fixture
+def index_path(tmp_path):
+    path = str(tmp_path / "index")
+    yield path
+    wait_for_compaction(path)
+
+
+def _add(writer, ids):
+    writer.add_embeddings(zip([f"text of {doc_id}" for doc_id in ids], [fake_vector(doc_id, DIM) for doc_id in ids]),
+                          ids=ids)
+
+
+def _build(index_path, ids):
+    """A published index holding ids, compacted into a base."""
+    with writer_lock(index_path):
+        writer = IndexWriter(EMBEDDINGS, index_path)
+        writer.clear(DIM)
+        _add(writer, ids)
+        writer.publish({"sources": {"data/a.pdf": {"type": "file", "ids": ids}}})
+        writer.docstore.close()
+    wait_for_compaction(index_path)
+
+
+def _published(index_path):
+    """(version number, {position: id}, vectors by id) of the latest published version."""
+    vector_store = load_published(EMBEDDINGS, index_path)
+    try:
+        positions = dict(vector_store.index_to_docstore_id)
+        order = sorted(positions)
+        vectors = dict(zip((positions[p] for p in order), vector_store.flat_index.reconstruct_batch(order)))
+        return vector_store.version["number"], positions, vectors
+    finally:
+        vector_store.docstore.close()
+
+
+def _run_child(code):
+    return subprocess.run([sys.executable, "-c", f"import sys; sys.path.insert(0, {APP_DIR!r})\n{code}"],
+                          capture_output=True, text=True, timeout=120)
+
+
+# Publishes an update, but the process dies right before the SQLite commit that makes it the latest version.
+CRASHING_UPDATE = """
+import os
+from chunk_store import ChunkStore
+from fake_openai import FakeEmbeddings, fake_vector
+from index_log import IndexWriter, writer_lock
+
+class CrashOnCommit:
+    def __init__(self, conn):
+        self.conn = conn
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+    def commit(self):
+        os._exit(3)
+
+publish = ChunkStore.publish
+def crashing_publish(self, *args, **kwargs):
+    self._conn = CrashOnCommit(self._conn)
+    publish(self, *args, **kwargs)
+ChunkStore.publish = crashing_publish
+
+with writer_lock({path!r}):
+    writer = IndexWriter(FakeEmbeddings({dim}), {path!r})
+    writer.add_embeddings([("new", fake_vector("new", {dim}))], ids=["new"])
+    writer.delete(["a0"])
+    writer.publish({{"sources": {{}}}})
+"""
+
+
+def test_interrupted_publish_leaves_the_previous_version(index_path):
+    ids = [f"a{i}" for i in range(10)]
+    _build(index_path, ids)
+    before = _published(index_path)
+
+    result = _run_child(CRASHING_UPDATE.format(path=index_path, dim=DIM))
+    assert result.returncode == 3, result.stderr
+
+    number, positions, vectors = _published(index_path)
+    assert (number, positions) == before[:2]
+    assert set(vectors) == set(ids)
+    assert list(published_sources(index_path)) == ["data/a.pdf"]
+
+    # The dead writer's lock is gone, and the next update publishes over its leftovers.
+    with writer_lock(index_path, timeout=5):
+        writer = IndexWriter(EMBEDDINGS, index_path)
+        _add(writer, ["b0"])
+        writer.publish()
+        writer.docstore.close()
+    number, positions, _ = _published(index_path)
+    assert number == before[0] + 1
+    assert set(positions.values()) == set(ids) | {"b0"}
+
+
+def test_writers_take_turns(index_path):
+    _build(index_path, ["a0", "a1"])
+    spans, errors = [], []
+
+    def update(name):
+        try:
+            with writer_lock(index_path):
+                started = time.monotonic()
+                writer = IndexWriter(EMBEDDINGS, index_path)
+                _add(writer, [f"{name}{i}" for i in range(3)])
+                time.sleep(0.2)
+                writer.publish()
+                writer.docstore.close()
+                spans.append((started, time.monotonic()))
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=update, args=(name,)) for name in ("x", "y")]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert not errors
+    first, second = sorted(spans)
+    assert first[1] <= second[0]
+    wait_for_compaction(index_path)
+    assert set(_published(index_path)[1].values()) == {"a0", "a1", "x0", "x1", "x2", "y0", "y1", "y2"}
+
+
+def test_writer_refuses_to_publish_over_a_newer_version(index_path):
+    _build(index_path, ["a0", "a1"])
+    # Opened without writer_lock, so another writer gets in first.
+    stale = IndexWriter(EMBEDDINGS, index_path)
+    try:
+        with writer_lock(index_path):
+            writer = IndexWriter(EMBEDDINGS, index_path)
+            _add(writer, ["x0"])
+            writer.publish()
+            writer.docstore.close()
+        # The unlocked writer's pending chunks would hold up the compaction that publish started.
+        wait_for_compaction(index_path)
+        _add(stale, ["y0"])
+        with pytest.raises(RuntimeError, match="changed by another writer"):
+            stale.publish()
+    finally:
+        stale.docstore.rollback()
+        stale.docstore.close()
+    assert "y0" not in _published(index_path)[1].values()
+
+
+def test_lock_is_held_across_processes(index_path):
+    os.makedirs(index_path)
+    holder = subprocess.Popen(
+        [sys.executable, "-c", f"import sys, time; sys.path.insert(0, {APP_DIR!r})\n"
+                               f"from index_log import writer_lock\n"
+                               f"with writer_lock({index_path!r}):\n"
+                               f"    print('locked', flush=True)\n"
+                               f"    time.sleep(2)\n"],
+        stdout=subprocess.PIPE, text=True)
+    try:
+        assert holder.stdout.readline().strip() == "locked"
+        locked = time.monotonic()
+        with pytest.raises(TimeoutError, match="another process"):
+            with writer_lock(index_path, timeout=0.3):
+                pass
+        with writer_lock(index_path, timeout=30):
+            assert time.monotonic() - locked > 1.5
+    finally:
+        holder.wait()
+
+
+def test_compaction_keeps_live_vectors_deletes_and_renames(index_path):
+    ids = [f"a{i}" for i in range(10)]
+    _build(index_path, ids)
+    with writer_lock(index_path):
+        writer = IndexWriter(EMBEDDINGS, index_path)
+        writer.delete(["a1", "a2"])
+        _add(writer, ["b0", "b1"])
+        # a3's vector passes to another chunk, as when a duplicate takes over from a removed original.
+        writer.docstore.add({"a3-heir": Document(id="a3-heir", page_content="heir of a3")})
+        writer.rename(next(p for p, doc_id in writer.index_to_docstore_id.items() if doc_id == "a3"), "a3-heir")
+        writer.publish()
+        writer.docstore.close()
+    wait_for_compaction(index_path)
+    compact(index_path, EMBEDDINGS)
+
+    vector_store = load_published(EMBEDDINGS, index_path)
+    try:
+        live = {"a0", "a3-heir", "a4", "a5", "a6", "a7", "a8", "a9", "b0", "b1"}
+        version = vector_store.version
+        assert version["segments"] == [] and version["ntotal"] == version["live"] == len(live)
+        assert sorted(vector_store.index_to_docstore_id) == list(range(len(live)))
+        assert set(vector_store.index_to_docstore_id.values()) == live
+        _, _, vectors = _published(index_path)
+        for doc_id, vector in vectors.items():
+            assert np.allclose(vector, fake_vector("a3" if doc_id == "a3-heir" else doc_id, DIM), atol=1e-6)
+        assert vector_store.docstore.mget(["a1", "a3-heir"])[0] is None
+        assert vector_store.docstore.mget(["a3-heir"])[0].page_content == "heir of a3"
+        _, found = vector_store.index.search(np.array([fake_vector("b1", DIM)], dtype=np.float32), 1)
+        assert vector_store.index_to_docstore_id[int(found[0][0])] == "b1"
+    finally:
+        vector_store.docstore.close()
+
+
+def test_legacy_index_is_migrated_by_the_first_writer(index_path):
+    ids = [f"a{i}" for i in range(6)]
+    legacy = FAISS.from_texts([f"text of {doc_id}" for doc_id in ids], EMBEDDINGS, ids=ids)
+    legacy.save_local(index_path)
+    sources = {"data/a.pdf": {"type": "file", "sha256": "0" * 64, "ids": ids}}
+    with open(os.path.join(index_path, "manifest.json"), "w") as f:
+        json.dump({"sources": sources}, f)
+    files = sorted(os.listdir(index_path))
+
+    # Readers use the old layout as it is.
+    reader = load_vector_store(EMBEDDINGS, index_path)
+    assert set(reader.index_to_docstore_id.values()) == set(ids)
+    assert sorted(os.listdir(index_path)) == files
+
+    writer = open_vector_store(EMBEDDINGS, index_path)
+    writer.docstore.close()
+    names = set(os.listdir(index_path))
+    assert {"chunks.sqlite", "base-000001"} <= names
+    assert not names & {"index.faiss", "index.pkl", "manifest.json"}
+    assert published_sources(index_path) == sources
+
+    number, positions, vectors = _published(index_path)
+    assert number == 1
+    assert positions == reader.index_to_docstore_id
+    for doc_id in ids:
+        assert np.allclose(vectors[doc_id], fake_vector(f"text of {doc_id}", DIM), atol=1e-6)
+
+    with writer_lock(index_path):
+        writer = open_vector_store(EMBEDDINGS, index_path)
+        _add(writer, ["b0"])
+        writer.publish()
+        writer.docstore.close()
+    assert set(_published(index_path)[1].values()) == set(ids) | {"b0"}
@@ -0,0 +1,116 @@
+import sqlite3
+import threading
+
+import pytest
+
+from job_queue import JOB_MAX_ATTEMPTS, JOB_STALE_SECONDS, JobQueue
+
+
+@pytest.fixture
+def queue_path(tmp_path):
+    return str(tmp_path / "jobs.sqlite")
+
+
+@pytest.fixture
+def queue(queue_path):
+    queue = JobQueue(queue_path)
+    yield queue
+    queue.close()
+
+
+def _age_heartbeat(queue_path, job_id, seconds=JOB_STALE_SECONDS + 1):
+    """Makes the job look as if its worker stopped checking in seconds ago."""
+    conn = sqlite3.connect(queue_path)
+    with conn:
+        conn.execute("UPDATE jobs SET heartbeat = heartbeat - ? WHERE id = ?", (seconds, job_id))
+    conn.close()
+
+
+def test_queued_reindex_absorbs_file_jobs(queue):
+    ingest = queue.submit("ingest", "data/a.pdf")
+    remove = queue.submit("remove", "data/b.docx")
+    page = queue.submit("ingest", "https://example.com/policy")
+
+    reindex = queue.submit("reindex")
+
+    for job_id in (ingest, remove):
+        job = queue.get(job_id)
+        assert job["state"] == "merged"
+        assert job["result"] == {"merged_into": reindex}
+    # Adding a web page needs the page fetched, which a re-index does not do.
+    assert queue.get(page)["state"] == "queued"
+    # Later file jobs fold into the queued re-index too, and so does a second re-index.
+    assert queue.submit("ingest", "data/c.pdf") == reindex
+    assert queue.submit("reindex") == reindex
+    assert [job["id"] for job in queue.jobs() if job["state"] == "queued"] == [page, reindex]
+
+
+def test_later_request_for_a_source_replaces_the_queued_one(queue):
+    job_id = queue.submit("ingest", "data/a.pdf")
+    assert queue.submit("remove", "data/a.pdf") == job_id
+    assert queue.get(job_id)["kind"] == "remove"
+
+
+def test_stale_job_is_requeued_once(queue_path, queue):
+    job_id = queue.submit("reindex")
+    assert queue.claim()["id"] == job_id
+    _age_heartbeat(queue_path, job_id)
+
+    # The next claim, from any worker, recovers the job and runs it again; the one after finds it running.
+    other = JobQueue(queue_path)
+    try:
+        job = other.claim()
+        assert job["id"] == job_id
+        assert job["attempts"] == 2
+        assert queue.claim() is None
+        assert other.claim() is None
+        assert queue.get(job_id)["state"] == "running"
+        assert queue.get(job_id)["attempts"] == 2
+    finally:
+        other.close()
+
+
+def test_job_that_keeps_dying_fails(queue_path, queue):
+    job_id = queue.submit("refresh")
+    for _ in range(JOB_MAX_ATTEMPTS):
+        assert queue.claim()["id"] == job_id
+        _age_heartbeat(queue_path, job_id)
+    assert queue.claim() is None
+    job = queue.get(job_id)
+    assert job["state"] == "failed"
+    assert job["attempts"] == JOB_MAX_ATTEMPTS
+
+
+def test_two_queues_share_one_database(queue_path, queue):
+    other = JobQueue(queue_path)
+    try:
+        first = queue.submit("ingest", "data/a.pdf")
+        assert other.submit("ingest", "data/a.pdf") == first
+        second = other.submit("refresh")
+
+        # Only one job runs at a time, whichever instance claims it.
+        assert other.claim()["id"] == first
+        assert queue.claim() is None
+        queue.finish(first, {"chunks": 3})
+        assert other.get(first)["state"] == "done"
+        assert queue.claim()["id"] == second
+        other.finish(second, error="ValueError: boom")
+
+        # Concurrent submissions of the same job from both instances end up as one.
+        ids = []
+        threads = [threading.Thread(target=lambda q=q: ids.append(q.submit("reindex"))) for q in (queue, other) * 4]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert len(set(ids)) == 1
+    finally:
+        other.close()
+
+    reopened = JobQueue(queue_path)
+    try:
+        assert reopened.last_job("refresh")["state"] == "failed"
+        assert reopened.last_job("reindex")["id"] == ids[0]
+        assert reopened.last_finished() == first
+    finally:
+        reopened.close()
@@ -0,0 +1,45 @@
+from parallel_loader import iter_file_parts
+
+
+def _broken(tmp_path, name):
+    path = tmp_path / name
+    path.write_bytes(b"not a document")
+    return str(path)
+
+
+def _run(paths, max_workers):
+    return [(path, [chunk.page_content for chunk in chunks], error, last)
+            for path, chunks, error, last in iter_file_parts(paths, max_workers=max_workers, pages_per_task=5)]
+
+
+def test_failures_stay_with_their_file(tmp_path, sample_docs):
+    docx, pdf = sample_docs
+    broken_pdf, broken_docx = _broken(tmp_path, "broken.pdf"), _broken(tmp_path, "broken.docx")
+    parts = _run([docx, broken_pdf, pdf, broken_docx], max_workers=2)
+
+    errors = {path: error for path, _, error, _ in parts if error}
+    assert set(errors) == {broken_pdf, broken_docx}
+    for path in (docx, pdf):
+        assert all(error is None for part_path, _, error, _ in parts if part_path == path)
+        assert sum(len(chunks) for part_path, chunks, _, _ in parts if part_path == path) > 0
+
+
+def test_parts_arrive_in_input_order(tmp_path, sample_docs):
+    docx, pdf = sample_docs
+    paths = [pdf, _broken(tmp_path, "broken.pdf"), docx]
+    parts = _run(paths, max_workers=2)
+
+    # The 21-page PDF is split into 5-page ranges; only its last part is marked last.
+    assert [path for path, _, _, _ in parts] == [pdf] * 5 + paths[1:]
+    assert [last for _, _, _, last in parts] == [False] * 4 + [True, True, True]
+    assert _run(paths, max_workers=2) == parts
+
+
+def test_parallel_matches_serial(sample_docs):
+    def chunks_by_file(parts):
+        files = {}
+        for path, chunks, _, _ in parts:
+            files.setdefault(path, []).extend(chunks)
+        return files
+
+    assert chunks_by_file(_run(list(sample_docs), max_workers=2)) == chunks_by_file(_run(list(sample_docs), max_workers=1))
@@ -0,0 +1,37 @@
+from langchain_core.documents import Document
+from langchain_core.messages import AIMessageChunk
+from langchain_core.outputs import ChatGenerationChunk
+
+import metrics
+from context_packer import count_tokens
+from fake_openai import FakeChatModel
+from qa import stream_answer
+
+
+class UsageChatModel(FakeChatModel):
+    """Streams one piece of text, then a chunk with the gateway's usage and no text."""
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        yield ChatGenerationChunk(message=AIMessageChunk(content="Controls are reviewed annually."))
+        yield ChatGenerationChunk(message=AIMessageChunk(
+            content="", usage_metadata={"input_tokens": 50, "output_tokens": 42, "total_tokens": 92}))
+
+
+def _counters():
+    return {counter["name"]: counter["value"] for counter in metrics.REGISTRY.snapshot()["counters"]}
+
+
+def test_tokens_are_counted_with_the_tokenizer():
+    metrics.REGISTRY.reset()
+    docs = [Document(page_content="Vulnerability scans run weekly on all production hosts. " * 10)]
+    answer = "".join(stream_answer(FakeChatModel(), "How often are scans run?", docs, {}))
+
+    counters = _counters()
+    assert counters["llm_completion_tokens"] == count_tokens(answer)
+    assert counters["llm_prompt_tokens"] > count_tokens(docs[0].page_content)
+
+
+def test_completion_tokens_come_from_usage_when_streamed():
+    metrics.REGISTRY.reset()
+    "".join(stream_answer(UsageChatModel(), "question", [], {}))
+    assert _counters()["llm_completion_tokens"] == 42
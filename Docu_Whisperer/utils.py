@@ -3,9 +3,12 @@ import os
 import zipfile
 import json
 import re
+import sys
 
 DATA_FOLDER = "data"
 WEB_URLS_FILE = "web_urls.json"
+# The "[doc.pdf - page 3]\n" line the loaders put in front of every chunk.
+CHUNK_HEADER_RE = re.compile(r"^\[(?P<doc>.+?) - page (?P<page>[^\]]*)\]\n")
 
 def save_web_urls(urls):
     with open(WEB_URLS_FILE, "w") as f:
@@ -20,6 +23,31 @@ def load_web_urls():
             return []
     return []
 
+def split_header(text):
+    """(doc name, page, body) for a chunk with a loader header, else (None, None, text)."""
+    match = CHUNK_HEADER_RE.match(text)
+    if not match:
+        return None, None, text
+    return match["doc"], match["page"], text[match.end():]
+
+def peak_rss_mb(children=False):
+    """Peak resident memory of this process (or of its finished child processes) in MB; None where unsupported."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF)
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS.
+    return usage.ru_maxrss / (1e6 if sys.platform == "darwin" else 1e3)
+
+def list_doc_paths(folder=DATA_FOLDER):
+    """(docx_paths, pdf_paths) of the valid documents in folder."""
+    docx_files = [f for f in os.listdir(folder) if f.lower().endswith(".docx")]
+    pdf_files = [f for f in os.listdir(folder) if f.lower().endswith(".pdf")]
+    docx_paths = [os.path.join(folder, f) for f in docx_files if is_valid_docx(os.path.join(folder, f))]
+    pdf_paths = [os.path.join(folder, f) for f in pdf_files if is_valid_pdf(os.path.join(folder, f))]
+    return docx_paths, pdf_paths
+
 def is_valid_docx(path):
     try:
         with zipfile.ZipFile(path, 'r') as zf:
@@ -0,0 +1,144 @@
+# Optional compressed storage of the index's vectors (float16, 8-bit scalar quantization, PCA), plus a memory/recall report.
+import argparse
+import os
+import time
+
+import faiss
+import numpy as np
+
+from ann_index import synthetic_vectors
+
+# How the flat index stores each vector: "float32" (exact), "float16" (half the memory) or "sq8" (a quarter).
+FAISS_STORAGE = os.environ.get("FAISS_STORAGE", "float32")
+STORAGE_TYPES = {"float32": "Flat", "float16": "SQfp16", "sq8": "SQ8"}
+# 0 keeps every dimension; otherwise vectors are first projected onto this many principal components of the corpus.
+FAISS_PCA_DIM = int(os.environ.get("FAISS_PCA_DIM", "0"))
+# SQ8 value ranges and PCA are trained on the index's own vectors once it has at least this many.
+FAISS_CODEC_MIN_VECTORS = int(os.environ.get("FAISS_CODEC_MIN_VECTORS", "10000"))
+
+CODEC_FILE = "codec.faiss"
+# Training sees at most this many vectors; PCA's covariance and SQ8's ranges settle long before.
+TRAIN_SAMPLE = 50000
+
+
+def codec_spec(dim, storage=FAISS_STORAGE, pca_dim=FAISS_PCA_DIM):
+    """The FAISS factory string vectors of dim dimensions are stored with, or None for plain float32."""
+    if storage not in STORAGE_TYPES:
+        raise ValueError(f"Unknown FAISS storage {storage!r}; expected one of {', '.join(STORAGE_TYPES)}")
+    if pca_dim and not 0 < pca_dim < dim:
+        raise ValueError(f"FAISS_PCA_DIM must be between 1 and {dim - 1} for {dim}-d embeddings, not {pca_dim}")
+    if storage == "float32" and not pca_dim:
+        return None
+    return f"PCA{pca_dim},{STORAGE_TYPES[storage]}" if pca_dim else STORAGE_TYPES[storage]
+
+
+def needs_training(spec):
+    return spec is not None and spec != "SQfp16"
+
+
+def wanted_codec(data, n):
+    """
+    What compaction should store the n live vectors of version data with:
+    the configured codec, the one the base already uses if that is it
+    (so it is not retrained on its own output), or None (float32) while
+    there are too few vectors to train one.
+    """
+    spec = codec_spec(data["dim"])
+    if spec == data.get("codec") or not needs_training(spec) or n >= FAISS_CODEC_MIN_VECTORS:
+        return spec
+    return None
+
+
+def train_codec(vectors, spec, seed=1234):
+    """An empty index that stores vectors the way spec says, trained on (a sample of) vectors."""
+    index = faiss.index_factory(vectors.shape[1], spec, faiss.METRIC_L2)
+    if not index.is_trained:
+        rng = np.random.default_rng(seed)
+        n = len(vectors)
+        index.train(vectors[np.sort(rng.choice(n, TRAIN_SAMPLE, replace=False))] if n > TRAIN_SAMPLE else vectors)
+    return index
+
+
+def read_codec(base_path):
+    return faiss.read_index(os.path.join(base_path, CODEC_FILE))
+
+
+def new_storage(codec, dim):
+    """An empty index to add vectors to: a copy of the trained codec, or a float32 flat index when there is none."""
+    return faiss.clone_index(codec) if codec is not None else faiss.IndexFlatL2(dim)
+
+
+def bytes_per_vector(spec, dim):
+    if spec is None:
+        return 4 * dim
+    transform, _, storage = spec.rpartition(",")
+    dim = int(transform[3:]) if transform else dim
+    return {"Flat": 4, "SQfp16": 2, "SQ8": 1}[storage] * dim
+
+
+def _recall(index, queries, truth, k):
+    started = time.perf_counter()
+    _, found = index.search(queries, k)
+    elapsed_ms = (time.perf_counter() - started) * 1000 / len(queries)
+    hits = sum(len(set(row) & set(expected)) for row, expected in zip(found, truth))
+    return hits / truth.size, elapsed_ms
+
+
+def main():
+    """Memory per vector and recall@k of each storage option against the uncompressed float32 index."""
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument("--index", help="use the vectors of this saved index (default: synthetic data)")
+    parser.add_argument("--synthetic", type=int, default=100000, help="synthetic corpus size")
+    parser.add_argument("--dim", type=int, default=1536)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("-k", type=int, default=10)
+    parser.add_argument("--storage", default="float16,sq8", help=f"any of {', '.join(STORAGE_TYPES)}")
+    parser.add_argument("--pca", default="0,512,256", help="PCA dimensions to try (0: none)")
+    args = parser.parse_args()
+
+    if args.index:
+        from index_manager import load_vector_store
+        vector_store = load_vector_store(None, args.index, mmap=True)
+        # A legacy or pre-segments index has only the one flat index.
+        flat_index = getattr(vector_store, "flat_index", vector_store.index)
+        vectors = flat_index.reconstruct_batch(sorted(vector_store.index_to_docstore_id))
+    else:
+        vectors = synthetic_vectors(args.synthetic, args.dim)
+    n, dim = vectors.shape
+    rng = np.random.default_rng(1)
+    # Queries are perturbed corpus vectors: near real content, but not exact copies of it.
+    queries = vectors[rng.choice(n, args.queries, replace=False)]
+    queries = queries + 0.1 * queries.std() * rng.standard_normal(queries.shape, dtype=np.float32)
+
+    flat = faiss.IndexFlatL2(dim)
+    flat.add(vectors)
+    _, truth = flat.search(queries, args.k)
+    _, flat_ms = _recall(flat, queries, truth, args.k)
+    print(f"{n} vectors x {dim} dims, {args.queries} queries, recall@{args.k}")
+    # PCA can only reduce the dimension: sizes at or above it are left out rather than failing the run.
+    pca_dims = [int(value) for value in args.pca.split(",")]
+    skipped = [str(pca_dim) for pca_dim in pca_dims if pca_dim >= dim]
+    pca_dims = [pca_dim for pca_dim in pca_dims if pca_dim < dim]
+    if skipped:
+        print(f"skipping PCA to {', '.join(skipped)} dims")
+    print()
+    print(f"{'storage':<18}{'train s':>9}{'B/vector':>10}{'size MB':>9}{'saving':>8}{'recall':>8}{'ms/query':>10}")
+    print(f"{'float32 (exact)':<18}{0:>9.1f}{4 * dim:>10}{vectors.nbytes / 1e6:>9.1f}{'1.0x':>8}{1:>8.3f}"
+          f"{flat_ms:>10.2f}", flush=True)
+
+    for pca_dim in pca_dims:
+        for storage in (["float32"] + args.storage.split(",")) if pca_dim else args.storage.split(","):
+            spec = codec_spec(dim, storage, pca_dim)
+            started = time.perf_counter()
+            index = train_codec(vectors, spec)
+            train_s = time.perf_counter() - started
+            index.add(vectors)
+            size_mb = faiss.serialize_index(index).nbytes / 1e6
+            recall, ms = _recall(index, queries, truth, args.k)
+            saving = f"{vectors.nbytes / 1e6 / size_mb:.1f}x"
+            print(f"{spec:<18}{train_s:>9.1f}{bytes_per_vector(spec, dim):>10}{size_mb:>9.1f}{saving:>8}{recall:>8.3f}"
+                  f"{ms:>10.2f}", flush=True)
+
+
+if __name__ == "__main__":
+    main()
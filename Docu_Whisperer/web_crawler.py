@@ -0,0 +1,226 @@
+# Bulk web ingestion: URL lists, sitemaps and same-site crawls, fetched concurrently and indexed as they arrive.
+import contextlib
+import threading
+import time
+import xml.etree.ElementTree as ET
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from urllib.parse import urldefrag, urljoin, urlparse
+from urllib.robotparser import RobotFileParser
+
+from bs4 import BeautifulSoup
+
+from index_log import writer_lock
+from index_manager import FAISS_INDEX_PATH, add_sources, open_index, save_vector_store, web_page_source
+from web_loader import extract_html_content, fetch_html, fetch_static
+
+CRAWL_WORKERS = 8
+CRAWL_PER_HOST = 2
+# Minimum seconds between two requests to the same host.
+CRAWL_HOST_DELAY = 0.25
+# Pages are embedded and added to the index in groups of this many chunks...
+CRAWL_INDEX_BATCH = 500
+# ...and the index is written to disk after this many groups (and at the end).
+CRAWL_SAVE_EVERY = 10
+
+_SKIP_EXTENSIONS = (
+    ".pdf", ".docx", ".doc", ".xlsx", ".pptx", ".zip", ".gz", ".png", ".jpg", ".jpeg",
+    ".gif", ".svg", ".ico", ".css", ".js", ".mp4", ".mp3", ".woff", ".woff2",
+)
+
+
+def normalize_url(url):
+    url, _ = urldefrag(url.strip())
+    return url
+
+
+def crawlable(url):
+    parsed = urlparse(url)
+    return parsed.scheme in ("http", "https") and not parsed.path.lower().endswith(_SKIP_EXTENSIONS)
+
+
+def extract_links(html, base_url):
+    soup = BeautifulSoup(html, "html.parser")
+    links = []
+    for anchor in soup.find_all("a", href=True):
+        link = normalize_url(urljoin(base_url, anchor["href"]))
+        if crawlable(link):
+            links.append(link)
+    return links
+
+
+def read_sitemap(url, limit=100000):
+    """All page URLs in a sitemap, following nested sitemap indexes."""
+    urls, pending, seen = [], [url], set()
+    while pending and len(urls) < limit:
+        sitemap = pending.pop(0)
+        if sitemap in seen:
+            continue
+        seen.add(sitemap)
+        root = ET.fromstring(fetch_static(sitemap).content)
+        namespace = root.tag.split("}")[0] + "}" if root.tag.startswith("{") else ""
+        locations = [loc.text.strip() for loc in root.iter(f"{namespace}loc") if loc.text]
+        if root.tag.endswith("sitemapindex"):
+            pending.extend(locations)
+        else:
+            urls.extend(normalize_url(location) for location in locations)
+    return urls[:limit]
+
+
+class HostPoliteness:
+    """At most per_host concurrent requests per host, spaced at least delay seconds apart."""
+
+    def __init__(self, per_host=CRAWL_PER_HOST, delay=CRAWL_HOST_DELAY, respect_robots=True):
+        self.per_host = per_host
+        self.delay = delay
+        self.respect_robots = respect_robots
+        self._lock = threading.Lock()
+        self._slots = {}
+        self._next_time = {}
+        self._robots = {}
+
+    def allowed(self, url):
+        if not self.respect_robots:
+            return True
+        parsed = urlparse(url)
+        host = f"{parsed.scheme}://{parsed.netloc}"
+        with self._lock:
+            parser = self._robots.get(host)
+        if parser is None:
+            parser = RobotFileParser()
+            try:
+                response = fetch_static(f"{host}/robots.txt", timeout=10)
+                parser.parse(response.text.splitlines())
+            except Exception:
+                # No (readable) robots.txt: everything is allowed.
+                parser.parse([])
+            with self._lock:
+                self._robots[host] = parser
+        return parser.can_fetch("DocuWhisperer", url)
+
+    def acquire(self, url):
+        host = urlparse(url).netloc
+        with self._lock:
+            slot = self._slots.setdefault(host, threading.Semaphore(self.per_host))
+        slot.acquire()
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next_time.get(host, now))
+            self._next_time[host] = start + self.delay
+        time.sleep(start - now)
+        return slot
+
+    def fetch(self, url, pool=None):
+        slot = self.acquire(url)
+        try:
+            return fetch_html(url, pool)
+        finally:
+            slot.release()
+
+
+def crawl(urls=(), sitemap=None, seed=None, max_depth=1, same_domain=True, max_pages=500,
+          embeddings=None, index_path=FAISS_INDEX_PATH, pool=None, skip=(), workers=CRAWL_WORKERS,
+          politeness=None, on_progress=None, on_indexed=None):
+    """
+    Fetches pages concurrently and streams their chunks into the index while
+    later pages are still downloading.
+
+    Pages come from urls, every URL in sitemap, and/or a breadth-first crawl
+    from seed following links up to max_depth hops (restricted to the seed's
+    host when same_domain). At most max_pages pages are fetched; URLs in
+    skip are never fetched. on_progress(progress) is called after every page
+    and on_indexed(urls) after every index write, so callers can persist
+    their URL list. Returns the final progress dict.
+    """
+    politeness = politeness or HostPoliteness()
+    progress = {"queued": 0, "fetched": 0, "failed": 0, "indexed_pages": 0, "indexed_chunks": 0,
+                "errors": [], "started": time.time()}
+
+    start = [(normalize_url(url), 0) for url in urls]
+    if sitemap:
+        start.extend((url, 0) for url in read_sitemap(sitemap))
+    if seed:
+        start.append((normalize_url(seed), 0))
+    seed_host = urlparse(seed).netloc if seed else None
+
+    seen = set(skip)
+    frontier = []
+    for url, depth in start:
+        if url not in seen and crawlable(url):
+            seen.add(url)
+            frontier.append((url, depth))
+
+    # The index is opened, under its writer lock, when the first group of pages is ready and closed again
+    # once they are saved, so other updates and compaction get their turn while pages download.
+    held = contextlib.ExitStack()
+    vector_store, manifest = None, None
+    pending, pending_chunks, indexed_urls, unsaved_batches = [], 0, [], 0
+
+    def flush(save):
+        nonlocal vector_store, manifest, pending, pending_chunks, unsaved_batches, indexed_urls
+        if pending:
+            if manifest is None:
+                held.enter_context(writer_lock(index_path))
+                vector_store, manifest = open_index(embeddings, index_path)
+            vector_store = add_sources(vector_store, embeddings, manifest, pending, index_path)
+            progress["indexed_pages"] += len(pending)
+            progress["indexed_chunks"] += pending_chunks
+            indexed_urls.extend(url for url, _, _ in pending)
+            pending, pending_chunks = [], 0
+            unsaved_batches += 1
+        if vector_store is not None and unsaved_batches and (save or unsaved_batches >= CRAWL_SAVE_EVERY):
+            save_vector_store(vector_store, manifest)
+            held.close()
+            vector_store, manifest = None, None
+            unsaved_batches = 0
+            if on_indexed:
+                on_indexed(indexed_urls)
+            indexed_urls = []
+
+    def fetch(url):
+        if not politeness.allowed(url):
+            raise PermissionError("disallowed by robots.txt")
+        return politeness.fetch(url, pool)
+
+    with held, ThreadPoolExecutor(max_workers=workers) as executor:
+        running = {}
+        submitted = 0
+        while frontier or running:
+            # Keep a bounded number of fetches in flight.
+            while frontier and len(running) < workers * 2 and submitted < max_pages:
+                url, depth = frontier.pop(0)
+                running[executor.submit(fetch, url)] = (url, depth)
+                submitted += 1
+            progress["queued"] = len(frontier) + len(running)
+            if not running:
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                url, depth = running.pop(future)
+                try:
+                    html, final_url, _ = future.result()
+                except Exception as e:
+                    progress["failed"] += 1
+                    progress["errors"].append((url, f"{type(e).__name__}: {e}"))
+                    continue
+                progress["fetched"] += 1
+                chunks = extract_html_content(html, url)
+                if chunks:
+                    pending.append(web_page_source(url, chunks))
+                    pending_chunks += len(chunks)
+                if seed and depth < max_depth:
+                    for link in extract_links(html, final_url):
+                        if link in seen or (same_domain and urlparse(link).netloc != seed_host):
+                            continue
+                        seen.add(link)
+                        frontier.append((link, depth + 1))
+            if pending_chunks >= CRAWL_INDEX_BATCH:
+                flush(save=False)
+            if on_progress:
+                progress["queued"] = len(frontier) + len(running)
+                on_progress(progress)
+        flush(save=True)
+    progress["queued"] = 0
+    progress["seconds"] = time.time() - progress["started"]
+    if on_progress:
+        on_progress(progress)
+    return progress
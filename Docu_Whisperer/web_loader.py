@@ -1,42 +1,84 @@
-import time
-from bs4 import BeautifulSoup
-
-from selenium import webdriver
-from selenium.webdriver.chrome.service import Service
-from selenium.webdriver.chrome.options import Options
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
-from selenium.webdriver.common.by import By
-from selenium.common.exceptions import WebDriverException
-from webdriver_manager.chrome import ChromeDriverManager
-
-from langchain_text_splitters import RecursiveCharacterTextSplitter
+import functools
+import queue
+import re
+import threading
+from contextlib import contextmanager
+
+import httpx
+
+# selenium and webdriver_manager are imported where a browser is actually
+# needed, so plain-HTTP fetches (and the app's startup) don't load them.
+
 from langchain_core.documents import Document
 
+import metrics
+from html_extractor import extract_sections, section_chunks, visible_text
+
+# Pages with less visible text than this over plain HTTP are assumed to need JavaScript.
+STATIC_MIN_TEXT = 200
+BROWSER_POOL_SIZE = 2
+USER_AGENT = "Mozilla/5.0 (compatible; DocuWhisperer/1.0)"
+
+# Empty mount points of client-side apps (React, Vue, Next.js, Nuxt, Angular).
+_JS_APP_ROOT_RE = re.compile(
+    r'<div[^>]*\bid=["\']?(?:root|app|__next|__nuxt)(?=["\'\s>])[^>]*>\s*</div>|<app-root[^>]*>\s*</app-root>', re.I
+)
+_NOSCRIPT_RE = re.compile(r"<noscript[^>]*>.*?(enable|requires?|turn on)\s+javascript", re.I | re.S)
 
-def extract_page_content(driver, url):
+
+def extract_html_content(html, url):
     """
-    Pull the rendered HTML from Selenium, strip out all text,
-    then chunk into LangChain Documents.
+    The page's main content (no menus, banners or footers) chunked along
+    its headings into LangChain Documents, with the page title and each
+    chunk's heading path as metadata.
     """
-    soup = BeautifulSoup(driver.page_source, "html.parser")
-    text = soup.get_text(separator="\n")
-    splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
-    chunks = splitter.split_text(text)
+    with metrics.span("parse", kind="html"):
+        title, sections = extract_sections(html)
+    with metrics.span("split", kind="html"):
+        chunks = section_chunks(title, sections)
+    metrics.count("chunks_created", len(chunks), kind="html")
     return [
-        Document(page_content=chunk.strip(), metadata={"source": url})
-        for chunk in chunks
-        if chunk.strip()
+        Document(page_content=text.strip(), metadata={"source": url, "title": title, "section": section})
+        for text, section in chunks
+        if text.strip()
     ]
 
 
-def open_web_page(url, session_state, headless=True, timeout=20):
-    """
-    1) Launch Chrome
-    2) Navigate to URL
-    3) Wait for <body> to exist, for readyState=complete, and for some text
-    4) Store driver & url in session_state for later finalization
-    """
+def looks_js_rendered(html):
+    """Heuristic: True when a plainly fetched page probably needs a browser to show its content."""
+    if _JS_APP_ROOT_RE.search(html):
+        return True
+    text_length = len(visible_text(html))
+    if text_length < STATIC_MIN_TEXT:
+        return True
+    # "Please enable JavaScript" banners on otherwise thin pages.
+    return text_length < 5 * STATIC_MIN_TEXT and bool(_NOSCRIPT_RE.search(html))
+
+
+def fetch_static(url, timeout=10, headers=None):
+    """Plain HTTP GET. Returns the httpx response; raises on network errors or non-2xx status."""
+    request_headers = {"User-Agent": USER_AGENT, "Accept": "text/html,application/xhtml+xml"}
+    request_headers.update(headers or {})
+    with metrics.span("fetch", method="static"):
+        response = httpx.get(url, headers=request_headers, timeout=timeout, follow_redirects=True)
+    metrics.count("web_fetches", method="static", status=response.status_code)
+    response.raise_for_status()
+    return response
+
+
+@functools.lru_cache(maxsize=1)
+def chromedriver_path():
+    from webdriver_manager.chrome import ChromeDriverManager
+
+    # ChromeDriverManager checks (and possibly downloads) the driver; once per process is enough.
+    return ChromeDriverManager().install()
+
+
+def new_chrome_driver(headless=True):
+    from selenium import webdriver
+    from selenium.webdriver.chrome.options import Options
+    from selenium.webdriver.chrome.service import Service
+
     options = Options()
     if headless:
         options.add_argument("--headless")
@@ -47,150 +89,154 @@ def open_web_page(url, session_state, headless=True, timeout=20):
     # If Chrome/Chromium isn’t on your PATH, uncomment & point here:
     # options.binary_location = "/Applications/Google Chrome.app/Contents/MacOS/Google Chrome"
 
-    try:
-        service = Service(ChromeDriverManager().install())
-        driver = webdriver.Chrome(service=service, options=options)
-    except WebDriverException as e:
-        return None, f"Could not start Chrome WebDriver: {e}"
+    return webdriver.Chrome(service=Service(chromedriver_path()), options=options)
 
-    try:
-        driver.get(url)
 
-        # a) Wait for the body element to exist
-        WebDriverWait(driver, timeout).until(
-            EC.presence_of_element_located((By.TAG_NAME, "body"))
-        )
+class BrowserPool:
+    """
+    Keeps up to size headless Chrome instances warm and hands them out one
+    caller at a time, so JS-rendered pages don't pay for a browser launch.
+    """
 
-        # b) Wait until all resources are loaded
+    def __init__(self, size=BROWSER_POOL_SIZE, headless=True):
+        self.size = size
+        self.headless = headless
+        self._idle = queue.Queue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def driver(self, timeout=60):
+        from selenium.common.exceptions import WebDriverException
+
+        driver = self._checkout(timeout)
+        healthy = True
+        try:
+            yield driver
+        except WebDriverException:
+            healthy = False
+            raise
+        finally:
+            if healthy:
+                self._idle.put(driver)
+            else:
+                self._discard(driver)
+
+    def _checkout(self, timeout):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            create = self._created < self.size
+            if create:
+                self._created += 1
+        if create:
+            try:
+                return new_chrome_driver(self.headless)
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+        return self._idle.get(timeout=timeout)
+
+    def _discard(self, driver):
+        try:
+            driver.quit()
+        except Exception:
+            pass
+        with self._lock:
+            self._created -= 1
+
+    def close(self):
+        while True:
+            try:
+                self._discard(self._idle.get_nowait())
+            except queue.Empty:
+                return
+
+
+def render_with_browser(url, pool, timeout=20):
+    """Load url in a pooled browser and return the rendered HTML."""
+    from selenium.webdriver.common.by import By
+    from selenium.webdriver.support.ui import WebDriverWait
+
+    with pool.driver() as driver, metrics.span("fetch", method="browser"):
+        metrics.count("web_fetches", method="browser")
+        driver.get(url)
         WebDriverWait(driver, timeout).until(
             lambda d: d.execute_script("return document.readyState") == "complete"
         )
-
-        # c) Wait for at least some text to appear (avoid empty JS loads)
+        # Wait for at least some text to appear (avoid empty JS loads)
         WebDriverWait(driver, timeout).until(
             lambda d: len(d.find_element(By.TAG_NAME, "body").text.strip()) > 20
         )
+        return driver.page_source
 
-        # d) Last small pause for any late JS
-        time.sleep(1)
-
-        # Store for finalize step
-        session_state["pending_web_url"] = url
-        session_state["selenium_driver"] = driver
-
-        return driver, None
-
-    except Exception as e:
-        driver.quit()
-        return None, f"Failed to load web page: {e}"
-
-
-# def finalize_web_page(session_state, store_chunks_in_faiss, save_web_urls):
-#     """
-#     1) Extract content from the stored driver
-#     2) Chunk + store in FAISS
-#     3) Persist URL list
-#     4) Cleanup driver & session_state
-#     """
-#     # Ensure our seen‐URL list exists
-#     session_state.setdefault("web_urls", [])
-#
-#     driver = session_state.get("selenium_driver")
-#     url = session_state.get("pending_web_url")
-#     if not driver or not url:
-#         return "No pending web page or driver found."
-#
-#     try:
-#         web_chunks = extract_page_content(driver, url)
-#         if not web_chunks:
-#             return "No content extracted from the web page after loading."
-#
-#         # 2) store in your vector index
-#         store_chunks_in_faiss(web_chunks)
-#
-#         # 3) update + persist URL list
-#         if url not in session_state["web_urls"]:
-#             session_state["web_urls"].append(url)
-#             save_web_urls(session_state["web_urls"])
-#
-#         return f"Added {len(web_chunks)} chunks from {url}. Index updated."
-#
-#     except Exception as e:
-#         return f"Error extracting content: {e}"
-
-# def finalize_web_page(session_state, store_chunks_in_faiss, save_web_urls):
-#     driver = session_state.get("selenium_driver")
-#     url = session_state.get("pending_web_url")
-#     try:
-#         web_chunks = extract_page_content(driver, url)
-#         if not web_chunks:
-#             return "Failed to extract any text from the page."
-#
-#         try:
-#             store_chunks_in_faiss(web_chunks)
-#         except Exception as e:
-#             return f"Error storing chunks in FAISS: {e}"
-#
-#         session_state.setdefault("web_urls", [])
-#         if url not in session_state["web_urls"]:
-#             session_state["web_urls"].append(url)
-#             try:
-#                 save_web_urls(session_state["web_urls"])
-#             except Exception as e:
-#                 return f"Error saving URL list: {e}"
-#
-#         return f"Indexed {len(web_chunks)} chunks from {url}."
-#     finally:
-#         # Always clean up
-#         if driver:
-#             try:
-#                 driver.quit()
-#             except Exception:
-#                 pass
-#         session_state["selenium_driver"] = None
-#         session_state["pending_web_url"] = None
-#         session_state["show_reindex_msg"] = True
-
-def finalize_web_page(session_state, save_web_urls, faiss_index_path):
-    import os
-    from langchain_openai import OpenAIEmbeddings
-    from langchain_community.vectorstores import FAISS
-
-    driver = session_state.get("selenium_driver")
-    url = session_state.get("pending_web_url")
-
-    web_chunks = extract_page_content(driver, url)
-    if not web_chunks:
-        return "Failed to extract any text from the page."
-
-    embeddings = OpenAIEmbeddings(
-        model="text-embedding-ada-002_v2",
-        openai_api_base=os.environ.get("OPENAI_BASE_URL"),
-        api_key=os.environ.get("OPENAI_API_KEY"),
-    )
-    if os.path.exists(faiss_index_path) and os.listdir(faiss_index_path):
-        vs = FAISS.load_local(
-            faiss_index_path,
-            embeddings,
-            allow_dangerous_deserialization=True,
-        )
-        vs.add_documents(web_chunks)
-    else:
-        vs = FAISS.from_documents(web_chunks, embeddings)
-    vs.save_local(faiss_index_path)
-
-    session_state.setdefault("web_urls", [])
-    if url not in session_state["web_urls"]:
-        session_state["web_urls"].append(url)
-        save_web_urls(session_state["web_urls"])
 
+def fetch_html(url, pool=None, timeout=20):
+    """
+    Fetch url over plain HTTP and only fall back to a pooled browser when
+    the page looks JS-rendered (or the connection fails). An error status
+    (404, 500, ...) is raised as httpx.HTTPStatusError, never rendered.
+    Returns (html, final_url, method) where method is "static" or "browser".
+    """
+    try:
+        response = fetch_static(url, timeout=timeout)
+        html = response.text
+        if "html" in response.headers.get("content-type", "html") and not looks_js_rendered(html):
+            return html, str(response.url), "static"
+    except httpx.HTTPStatusError:
+        # The server answered; a browser would only render its error page.
+        raise
+    except httpx.HTTPError:
+        if pool is None:
+            raise
+    if pool is None:
+        raise ValueError("Page needs JavaScript to render and no browser pool was given.")
+    return render_with_browser(url, pool, timeout), url, "browser"
+
+
+def fetch_if_modified(url, validators=None, pool=None, timeout=20):
+    """
+    Conditional version of fetch_html: validators is the {"etag",
+    "last_modified"} dict from an earlier fetch. Returns None when the
+    server answers 304 Not Modified, else (html, method, validators) with
+    the page's new validators (empty for browser-rendered pages, whose
+    static shell says nothing about the content).
+    """
+    validators = validators or {}
+    headers = {}
+    if validators.get("etag"):
+        headers["If-None-Match"] = validators["etag"]
+    if validators.get("last_modified"):
+        headers["If-Modified-Since"] = validators["last_modified"]
     try:
-        driver.quit()
-    except Exception:
-        pass
-    session_state["selenium_driver"] = None
-    session_state["pending_web_url"] = None
-    # Appended directly into FAISS – no manual Re-index required
-    session_state["show_reindex_msg"] = False
-
-    return f"Appended {len(web_chunks)} chunks from {url} to FAISS index."
\ No newline at end of file
+        response = fetch_static(url, timeout=timeout, headers=headers)
+    except httpx.HTTPStatusError as e:
+        if e.response.status_code == 304:
+            return None
+        # A page that is gone or failing is reported, not rendered in the browser and re-indexed.
+        raise
+    except httpx.HTTPError:
+        if pool is None:
+            raise
+    else:
+        html = response.text
+        if "html" in response.headers.get("content-type", "html") and not looks_js_rendered(html):
+            new_validators = {
+                "etag": response.headers.get("etag"),
+                "last_modified": response.headers.get("last-modified"),
+            }
+            return html, "static", {k: v for k, v in new_validators.items() if v}
+    if pool is None:
+        raise ValueError("Page needs JavaScript to render and no browser pool was given.")
+    return render_with_browser(url, pool, timeout), "browser", {}
+
+
+def load_web_chunks(url, pool=None, timeout=20):
+    """Like fetch_html, but returns (chunks, method)."""
+    html, _, method = fetch_html(url, pool, timeout)
+    # Chunks carry the URL as given, which is also the page's manifest key.
+    return extract_html_content(html, url), method
+
@@ -0,0 +1,134 @@
+# Periodic refresh of indexed web pages: conditional requests, and re-embedding only for pages whose text changed.
+import argparse
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from index_log import writer_lock
+from index_manager import (FAISS_INDEX_PATH, add_sources, load_manifest, open_index, save_source_entries,
+                           save_vector_store, text_sha256)
+from web_crawler import CRAWL_WORKERS, HostPoliteness
+from web_loader import extract_html_content, fetch_if_modified
+
+# Pages checked less than this many seconds ago are skipped.
+WEB_REFRESH_INTERVAL = float(os.environ.get("WEB_REFRESH_INTERVAL", str(24 * 3600)))
+
+
+def due_pages(manifest, urls=None, max_age=WEB_REFRESH_INTERVAL, now=None):
+    """Indexed web pages (optionally limited to urls) not checked within max_age seconds."""
+    now = now or time.time()
+    wanted = set(urls) if urls is not None else None
+    return [
+        key for key, entry in manifest["sources"].items()
+        if entry.get("type") == "web" and (wanted is None or key in wanted)
+        and now - entry.get("checked", 0) >= max_age
+    ]
+
+
+def refresh_web_pages(embeddings, urls=None, index_path=FAISS_INDEX_PATH, max_age=WEB_REFRESH_INTERVAL,
+                      pool=None, workers=CRAWL_WORKERS, politeness=None):
+    """
+    Revisits the indexed web pages that are due. Each page is requested
+    with the ETag / Last-Modified it last answered with; a 304 costs no
+    download, and a page whose extracted text hashes the same as before
+    costs no embedding. Only pages with new text get their vectors
+    replaced and published; when none did, the check times are saved
+    without a new index version. Pages are fetched before the writer lock
+    is taken. Returns (vector_store, report).
+    """
+    politeness = politeness or HostPoliteness()
+    manifest = load_manifest(index_path)
+    due = due_pages(manifest, urls, max_age)
+    validators = {url: manifest["sources"][url].get("validators") for url in due}
+    report = {"checked": 0, "not_modified": 0, "unchanged": 0, "updated": 0, "chunks": 0, "failed": []}
+
+    def check(url):
+        slot = politeness.acquire(url)
+        try:
+            return fetch_if_modified(url, validators[url], pool)
+        finally:
+            slot.release()
+
+    # Fetched without the writer lock: slow or polite fetches don't hold up uploads, jobs or compaction.
+    fetched = {}  # url -> (checked, validators, chunks); validators None for a 304
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(check, url): url for url in due}
+        for future in as_completed(futures):
+            url = futures[future]
+            report["checked"] += 1
+            try:
+                result = future.result()
+            except Exception as e:
+                report["failed"].append((url, f"{type(e).__name__}: {e}"))
+                continue
+            if result is None:
+                report["not_modified"] += 1
+                fetched[url] = (time.time(), None, None)
+                continue
+            html, _, new_validators = result
+            fetched[url] = (time.time(), new_validators, extract_html_content(html, url))
+
+    if not fetched:
+        return None, report
+    with writer_lock(index_path):
+        # Re-read under the lock: pages may have been removed or re-added while they were fetched.
+        vector_store, manifest = open_index(embeddings, index_path)
+        sources = manifest["sources"]
+        changed = []
+        for url, (checked, new_validators, chunks) in fetched.items():
+            entry = sources.get(url)
+            if entry is None or entry.get("type") != "web":
+                continue
+            entry["checked"] = checked
+            if new_validators is None:
+                continue
+            entry["validators"] = new_validators
+            sha256 = text_sha256(chunks)
+            if sha256 == entry.get("sha256") or not chunks:
+                # Same text (or an empty page, which is more likely a glitch than a real change).
+                report["unchanged"] += 1
+                continue
+            info = {"type": "web", "sha256": sha256, "validators": new_validators, "checked": checked}
+            changed.append((url, chunks, info))
+            report["updated"] += 1
+            report["chunks"] += len(chunks)
+
+        if changed:
+            vector_store = add_sources(vector_store, embeddings, manifest, changed, index_path)
+            save_vector_store(vector_store, manifest)
+        elif vector_store is not None:
+            # Only check times and validators changed: readers keep the index version they loaded.
+            save_source_entries(vector_store, manifest)
+    return vector_store, report
+
+
+def main():
+    """Refresh due web pages once, or every --every seconds (for cron-less scheduling)."""
+    from env_setup import make_embeddings, setup_environment
+
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument("--index", default=FAISS_INDEX_PATH)
+    parser.add_argument("--max-age", type=float, default=WEB_REFRESH_INTERVAL,
+                        help="only check pages not checked within this many seconds")
+    parser.add_argument("--every", type=float, default=0, help="keep running, refreshing every N seconds")
+    args = parser.parse_args()
+
+    setup_environment()
+    embeddings = make_embeddings()
+    while True:
+        started = time.time()
+        _, report = refresh_web_pages(embeddings, index_path=args.index, max_age=args.max_age)
+        print(
+            f"checked {report['checked']}: {report['not_modified']} not modified, {report['unchanged']} unchanged, "
+            f"{report['updated']} updated ({report['chunks']} chunks), {len(report['failed'])} failed "
+            f"in {time.time() - started:.1f}s"
+        )
+        for url, error in report["failed"]:
+            print(f"  {url}: {error}")
+        if not args.every:
+            break
+        time.sleep(args.every)
+
+
+if __name__ == "__main__":
+    main()